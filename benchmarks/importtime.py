@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#    Import time benchmark
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+"""Report what 'import pgpgram' costs, as 'python -X importtime' does.
+
+Exits with an error if importing pgpgram loads a module which should
+only be loaded by the commands needing it, or if it takes longer
+than the given budget.
+
+    python3 benchmarks/importtime.py [--budget MILLISECONDS] [--top N]
+"""
+
+from argparse import ArgumentParser
+from os.path import abspath, dirname
+from subprocess import run, PIPE
+from sys import executable, exit
+
+forbidden = ['argparse',
+             'ctypes',
+             'pgpgram.td',
+             'pprint',
+             'setproctitle',
+             'sqlitedict',
+             'subprocess',
+             'trovotutto']
+"""Modules that importing pgpgram must not load"""
+
+
+def importtime(module, runs=5):
+    """Measure import time of a module in fresh interpreters
+
+    Args:
+        module (str): module to import
+        runs (int): number of interpreters to start; the best run is kept
+    Returns:
+        (dict) cumulative microseconds by imported module of the best run
+    """
+    best = None
+    for _ in range(runs):
+        process = run([executable, "-X", "importtime", "-c", "import {}".format(module)],
+                      stdout=PIPE, stderr=PIPE, universal_newlines=True,
+                      cwd=dirname(dirname(abspath(__file__))))
+        times = {}
+        for line in process.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            self_time, cumulative, name = line[len("import time:"):].split("|")
+            times[name.strip()] = int(cumulative)
+        if best is None or times.get(module, 0) < best.get(module, 0):
+            best = times
+    return best
+
+
+def main():
+    parser = ArgumentParser(description="import time report for pgpgram")
+    parser.add_argument('--budget', dest='budget', type=float, default=50,
+                        help="maximum import time in milliseconds; default: 50")
+    parser.add_argument('--top', dest='top', type=int, default=15,
+                        help="how many of the slowest modules to display; default: 15")
+    args = parser.parse_args()
+
+    times = importtime("pgpgram")
+    for name, cumulative in sorted(times.items(), key=lambda t: -t[1])[:args.top]:
+        print("{:>10.1f} ms  {}".format(cumulative / 1000, name))
+
+    errors = ["{} imported".format(name) for name in forbidden if name in times]
+    total = times.get("pgpgram", 0) / 1000
+    if total > args.budget:
+        errors.append("import took {:.1f} ms (budget: {} ms)".format(total, args.budget))
+
+    for error in errors:
+        print("error: {}".format(error))
+    exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -23,45 +23,33 @@
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 
-import inspect
-import logging
-import string
 # from concurrent.futures import ProcessPoolExecutor as ppe
 # from concurrent.futures import wait
-from copy import deepcopy as cp
+from contextlib import contextmanager
+from copy import deepcopy
 from datetime import datetime
-from getpass import getpass
-from os.path import abspath, basename, exists, dirname, getsize, isfile, isdir, realpath
+from os.path import abspath, exists, dirname, getsize, isfile, isdir, realpath
 from os.path import join as path_join
 from os import chdir as cd
 from os import listdir as ls
 from os import remove as rm
-from os import getcwd, makedirs, mkdir, symlink, umask
+from os import getcwd, getpid, makedirs, mkdir, replace, stat, symlink, umask
 from os import walk
 from pickle import dump as pickle_dump
 from pickle import load as pickle_load
-from pprint import pprint
 from random import SystemRandom as random
-from subprocess import Popen, PIPE
-from subprocess import check_output as sh
-from subprocess import getoutput
+from time import perf_counter, time
 
-from appdirs import user_cache_dir, user_config_dir, user_data_dir
-from argparse import ArgumentParser
-from setproctitle import setproctitle
-from sqlitedict import SqliteDict
-from trovotutto import PGPgramDb, Index
+# Heavier modules (subprocess, sqlitedict, the tdlib binding, ...) are
+# imported where they are used, to keep the command line start-up fast
 
 from .color import Color
 from .config import Config
-from .td import Td
 
 name = "pgpgram"
 version = "0.4"
 
-setproctitle(name)
-
-config = Config()
+config = Config(setup=False)
 color = Color()
 
 
@@ -83,9 +71,12 @@ def save(variable, path):
         variable: what to save
         path (str): path of the output
     """
-    with open(path, 'wb') as f:
+    # Written aside and renamed, so that other processes
+    # never read a partially written file
+    temporary = "{}.{}".format(path, getpid())
+    with open(temporary, 'wb') as f:
         pickle_dump(variable, f)
-    f.close()
+    replace(temporary, path)
 
 def load(path):
     """Load variable from Pickle file
@@ -109,8 +100,50 @@ def random_id(N):
     Returns:
         (str) random alphanumeric string 
     """
+    import string
+
     return ''.join(random().choice(string.ascii_letters + string.digits) for _ in range(N))
 
+def sha256_digest(path, block_size=1048576, release=False):
+    """sha256 hex digest of a file
+
+    Args:
+        path (str): path of the file
+        release (bool): in low impact mode, drop the file from
+                        the page cache as it is read (see lowimpact)
+    Returns:
+        (str) hex digest
+    """
+    from hashlib import sha256
+    from .lowimpact import blocks
+
+    digest = sha256()
+    with open(path, 'rb') as f:
+        for block in (blocks(f, block_size=block_size) if release else iter(lambda: f.read(block_size), b'')):
+            digest.update(block)
+    return digest.hexdigest()
+
+def check_manifest(document, index, path):
+    """Check a downloaded chunk against the manifest of its document
+
+    Args:
+        document (dict): the document;
+        index (int): position of the chunk in the document;
+        path (str): path of the downloaded chunk.
+    Returns:
+        (str) the problem found, None if the chunk matches or
+        the document has no manifest
+    """
+    chunks = document.get('chunks', [])
+    if index >= len(chunks):
+        return None
+    expected = chunks[index]
+    size = getsize(path)
+    if size != expected['size']:
+        return "{}: chunk {} is {} bytes instead of {}".format(document['name'], index, size, expected['size'])
+    if 'sha256' in expected and sha256_digest(path) != expected['sha256']:
+        return "{}: chunk {} does not match its digest".format(document['name'], index)
+
 class MessageInException(Exception):
     def __init__(self, msg):
         print("{0}".format(msg))
@@ -121,6 +154,8 @@ class Db:
 
     Args:
         verbose (int): level of
+        readonly (bool): open storage lazily, on first access, and never
+                         write to it; for commands only reading the database
     """
 
     config_path = config.get_config_dir()
@@ -129,24 +164,42 @@ class Db:
     executable_path = dirname(realpath(__file__))
     files_db_path = path_join(config.get_config_dir(), "files.db")
     names_db_path = path_join(config.get_config_dir(), "names.db")
+    stat_db_path = path_join(config.get_cache_dir(), "stat.db")
 
-    def __init__(self, verbose=0):
+    def __init__(self, verbose=0, readonly=False):
         self.verbose = verbose
+        self.readonly = readonly
+
+        if readonly:
+            # Storage is opened on first access (see __getattr__)
+            return
+
+        from pprint import pprint
+        from sqlitedict import SqliteDict
+
+        config.setup_dirs()
 
+        # Write-ahead logging lets several processes share the catalog,
+        # rows are changed through writers (see update)
+        self.writers = {}
         if exists(self.files_db_path):
-            self.files = SqliteDict(self.files_db_path, autocommit=False)
+            self.files = SqliteDict(self.files_db_path, autocommit=False, journal_mode="WAL")
         else:
-            self.files = SqliteDict(self.files_db_path, autocommit=False)
+            self.files = SqliteDict(self.files_db_path, autocommit=False, journal_mode="WAL")
             self.from_pickle_to_db()
                     
         if exists(self.names_db_path):
-            self.file_names = SqliteDict(self.names_db_path, autocommit=False)
+            self.file_names = SqliteDict(self.names_db_path, autocommit=False, journal_mode="WAL")
         else:
             self.rebuild_names_db()
+
+        self.stat_cache = SqliteDict(self.stat_db_path, autocommit=False, journal_mode="WAL")
        
-        # Load configuration from disk into 'config' attribute
+        # Load configuration from disk into 'config' attribute;
+        # 'config base' is what it was when loaded (see merge_config)
         try:
             self.config = load(path_join(self.config_path, "config.pkl"))
+            self.config_base = deepcopy(self.config)
 
         except FileNotFoundError as e:
             # Init configuration
@@ -154,6 +207,7 @@ class Db:
                 pprint("Config file not found in path, initializing")
 
             self.config = {"db key":random_id(20)}
+            self.config_base = {}
 
             # Paths
             index_dir = path_join(self.data_path, "index")
@@ -183,6 +237,36 @@ class Db:
 
     
 
+    def __getattr__(self, name):
+        """Open storage of a read-only database on first access"""
+        if not self.__dict__.get('readonly'):
+            raise AttributeError(name)
+
+        from .catalog import ReadOnlySqliteDict
+
+        if name == 'files':
+            value = ReadOnlySqliteDict(self.files_db_path)
+        elif name == 'file_names':
+            if exists(self.names_db_path):
+                value = ReadOnlySqliteDict(self.names_db_path)
+            else:
+                value = {}
+                for k, documents in self.files.items():
+                    for document in documents:
+                        value.setdefault(document['name'], []).append(document)
+        elif name == 'stat_cache':
+            value = {}
+        elif name == 'config':
+            try:
+                value = load(path_join(self.config_path, "config.pkl"))
+            except FileNotFoundError as e:
+                value = {}
+        else:
+            raise AttributeError(name)
+
+        setattr(self, name, value)
+        return value
+
     def from_pickle_to_db(self):
             files_pickle_path = path_join(self.config_path, "files.pkl")
             if exists(files_pickle_path):
@@ -193,12 +277,18 @@ class Db:
                     self.files[f['hash']] = [f]
 
     def rebuild_names_db(self):
+        from sqlitedict import SqliteDict
+
         print("Building names database")
-        try:
-            rm(self.names_db_path)
-        except FileNotFoundError as e:
-            pass
-        self.file_names = SqliteDict(self.names_db_path, autocommit=False)
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                rm(self.names_db_path + suffix)
+            except FileNotFoundError as e:
+                pass
+        writer = self.__dict__.get('writers', {}).pop(self.names_db_path, None)
+        if writer is not None:
+            writer.close()
+        self.file_names = SqliteDict(self.names_db_path, autocommit=False, journal_mode="WAL")
         for hash in self.files:
             for document in self.files[hash]:
                 try:
@@ -224,9 +314,66 @@ class Db:
         #pgpgram_db = PGPgramDb(self, filetype="any", exclude=[], update=True)
         #self.index = Index(pgpgram_db, slb=3, verbose=self.verbose)
         #save(self.index, path_join(self.data_path, "index.pkl"))
+        if self.readonly:
+            return
         self.files.commit()
         self.file_names.commit()
+        self.stat_cache.commit()
+        with self.config_lock():
+            self.merge_config()
+            self.write_config()
+
+    @contextmanager
+    def config_lock(self):
+        """Hold the lock of the configuration file, for read-modify-write"""
+        from fcntl import flock, LOCK_EX
+
+        with open(path_join(self.config_path, "config.lock"), 'w') as lock:
+            flock(lock, LOCK_EX)
+            yield
+
+    def merge_config(self):
+        """Bring in the configuration saved by other processes
+
+        Keys changed by this process since it loaded the configuration
+        keep its values, the others take the saved ones; to be called
+        holding the configuration lock.
+        """
+        try:
+            saved = load(path_join(self.config_path, "config.pkl"))
+        except FileNotFoundError as e:
+            return
+        missing = object()
+        for key in set(saved) | set(self.config) | set(self.config_base):
+            if self.config.get(key, missing) != self.config_base.get(key, missing):
+                continue
+            if key in saved:
+                self.config[key] = saved[key]
+            else:
+                self.config.pop(key, None)
+
+    def write_config(self):
+        """Write the configuration; to be called holding the configuration lock"""
         save(self.config, path_join(self.config_path, "config.pkl"))
+        self.config_base = deepcopy(self.config)
+
+    def update_config(self, key, function):
+        """Change a configuration key from its saved value
+
+        The configuration is read, changed and written holding its lock,
+        so that keys written meanwhile by other processes are not lost.
+
+        Args:
+            key (str): the key
+            function (fun): new value from the current one, None if missing
+        Returns:
+            the new value
+        """
+        with self.config_lock():
+            self.merge_config()
+            self.config[key] = function(self.config.get(key))
+            self.write_config()
+        return self.config[key]
 
     def search(self, query, 
                      path=getcwd(), 
@@ -244,6 +391,7 @@ class Db:
                                  'update': True}
 
         # To update for db usage
+            #from trovotutto import PGPgramDb, Index
             #pgpgram_db = PGPgramDb(self, **pgpgram_db_kwargs)
             #self.index = Index(pgpgram_db, slb=word_shortest, verbose=verbose)
 
@@ -276,26 +424,136 @@ class Db:
             print(result['title'])
             print(result['subtitle'])
 
+    def update(self, path, functions):
+        """Atomically replace rows of the catalog
+
+        Other processes may be writing to the same rows, so rows are
+        read and written back in a single transaction instead of
+        through the SqliteDict, which would write values read earlier.
+
+        Args:
+            path (str): files_db_path or names_db_path
+            functions (dict): for every key, a function of its current
+                              documents (None if missing) returning the
+                              new ones (None to remove the key)
+        """
+        from .catalog import Writer
+
+        if not path in self.writers:
+            self.writers[path] = Writer(path)
+        self.writers[path].update(functions)
+
+    def add_document(self, document):
+        """Index a backed up document by hash and by name
+
+        Args:
+            document (dict): document to add to the database
+        """
+        # See https://github.com/RaRe-Technologies/sqlitedict/issues/110
+
+        # Indexing with hash
+        self.update(self.files_db_path, {document['hash']: lambda documents: (documents or []) + [document]})
+
+        # Indexing with name
+        self.index_names([document])
+
+    def index_names(self, documents):
+        """Add documents to the name index
+
+        Args:
+            documents (list): documents to index
+        """
+        names = {}
+        for document in documents:
+            names.setdefault(document['name'], []).append(document)
+        self.update(self.names_db_path,
+                    {name: lambda documents, new=new: (documents or []) + new
+                     for name, new in names.items()})
+
+    def remove_document(self, document):
+        """Remove a document from the hash and name indexes
+
+        Args:
+            document (dict): document to remove from the database
+        """
+        def remove(documents):
+            if documents is None:
+                return None
+            return [d for d in documents if d['id'] != document['id']] or None
+
+        self.update(self.files_db_path, {document['hash']: remove})
+        self.update(self.names_db_path, {document['name']: remove})
+
     def import_file(self, filename):
+        """Merge the catalog of another installation
+
+        Hashes missing here are copied set-wise in SQL (see catalog.merge)
+        and only their documents are added to the name index; for hashes
+        known to both catalogs, documents missing here are appended.
+
+        Args:
+            filename (str): path of a files.db or of a legacy files.pkl
+        Returns:
+            (tuple) number of added, skipped and conflicting hashes
+        """
+        from .catalog import merge
+
+        def added(rows):
+            self.index_names([d for key, documents in rows for d in documents])
+            if self.verbose:
+                for key, documents in rows:
+                    for d in documents:
+                        print("adding {}".format(d['name']))
+
+        # Hashes whose documents are all known already are not conflicts
+        known = [0]
+
+        def conflicting(rows):
+            new = []
+
+            def append(theirs):
+                def function(ours):
+                    ours = ours or []
+                    ids = {d['id'] for d in ours}
+                    missing = [d for d in theirs if not d['id'] in ids]
+                    if missing:
+                        new.extend(missing)
+                    else:
+                        known[0] += 1
+                    return ours + missing
+                return function
+
+            self.update(self.files_db_path, {key: append(theirs) for key, theirs, ours in rows})
+            self.index_names(new)
+
         if filename.endswith("pkl"):
-            files = load(filename)
-            for f in files:
-                try: 
-                    self.files[f['hash']]
+            counts = [0, 0, 0]
+            documents = {}
+            for f in load(filename):
+                documents.setdefault(f['hash'], []).append(f)
+            for key, theirs in documents.items():
+                try:
+                    ours = self.files[key]
                 except KeyError as e:
-                    self.files[f['hash']] = [f]
-                    print("adding {}".format(f['name']))
+                    self.update(self.files_db_path, {key: lambda ours, theirs=theirs: (ours or []) + theirs})
+                    added([(key, theirs)])
+                    counts[0] += 1
+                    continue
+                if theirs == ours:
+                    counts[1] += 1
+                else:
+                    conflicting([(key, theirs, ours)])
+                    counts[2] += 1
         else:
-            files = SqliteDict(filename, autocommit=False)
-            for k in files:
-                try: 
-                    self.files[k]
-                except KeyError as e:
-                    self.files[k] = files[k]
-                    print("adding {}".format(f['name']))
-            self.rebuild_names_db()
-               
+            # Pending writes have to be visible to the merge connection
+            self.files.commit()
+            counts = list(merge(self.files_db_path, abspath(filename), added, conflicting))
+        counts[1] += known[0]
+        counts[2] -= known[0]
+
         self.save()
+        print("{} added, {} skipped, {} conflicting".format(*counts))
+        return tuple(counts)
 
 
 class Backup:
@@ -308,14 +566,29 @@ class Backup:
     Args:
         f (str): path of the file to backup;
         ignore_duplicate (bool): create duplicate backup;
-        size (int): specify size of the chunks the file will be split; 
+        size (int): specify size of the chunks the file will be split
+                    (in MB), or 'auto' (see auto_chunk_size); 
         verbose (int): integer indicating level of verbose
             * 1 just pgpgram verbose
             * 2 include tdjson verbose
-            * 3 to 5 are specific to tdjson.
+            * 3 to 5 are specific to tdjson;
+        metrics (Metrics): where to record timings of the backup stages;
+        profiler (Profiler): where to time the telegram client event loop;
+        throttle (Throttle): upload and download rate limits;
+        td (Td): connected telegram client to use instead of creating one.
     """
 
-    def __init__(self, f, ignore_duplicate=False, size='100', verbose=0):
+    upload_window = 4
+    """Most chunks uploaded at the same time (see auto_chunk_size)"""
+
+    def __init__(self, f, ignore_duplicate=False, size='100', verbose=0, metrics=None, profiler=None, throttle=None, td=None):
+        from . import crypto
+        from .metrics import Metrics
+        from .td import Td
+
+        self.metrics = metrics if metrics is not None else Metrics("backup")
+        self.profiler = profiler
+        self.throttle = throttle
 
         try:
             current_path = getcwd()
@@ -325,11 +598,14 @@ class Backup:
             """Database class instance"""
             cd(self.db.config_path)
 
-            # Instantiates telegram client
-            td = Td(tdjson_path=self.db.executable_path, db_key=self.db.config["db key"], verbosity_level=verbose)
+            # Telegram client is instantiated only when needed,
+            # so that files already backed up are skipped quickly
+            shared = td is not None
 
             # If not already, select backup chat
             if not "backup chat id" in self.db.config.keys():
+                if td is None:
+                    td = Td(tdjson_path=self.db.executable_path, db_key=self.db.config["db key"], verbosity_level=verbose, metrics=self.metrics, profiler=self.profiler)
                 print(color.set(color.BLUE, "\nInstructions: ") +
                       ("send the message 'telegram "
                        "will not allow this' in the chat you want your "
@@ -337,89 +613,90 @@ class Backup:
                 td.cycle(self.find_backup_chat)
             chat_id = self.db.config['backup chat id']
  
-            # Process document
-            self.document = self.process_file(f, ignore_duplicate=ignore_duplicate, verbose=verbose)
+            # Process document: chunks of independent AES-GCM segments
+            # (format version 6), gpg encrypted chunks without
+            # cryptography (format version 4)
+            self.document = self.process_file(f, ignore_duplicate=ignore_duplicate, verbose=verbose,
+                                              format_version=6 if crypto.available else 4)
             if not self.document:
                 raise MessageInException('{}: already backed up'.format(f))
 
-            # Encrypt document
-            encrypted = path_join(self.db.cache_path, '.'.join([self.document["name"], "gpg"]))
-            self.encrypt(self.document['path'], self.document["passphrase"], output=encrypted)
-
-            # Split document
-            if 'format version' in self.document.keys():
-                if self.document['format version'] >= 2:
-                    digits = 6
+            # Instantiates telegram client
+            if td is None:
+                td = Td(tdjson_path=self.db.executable_path, db_key=self.db.config["db key"], verbosity_level=verbose, metrics=self.metrics, profiler=self.profiler)
+
+            # Chunks are encrypted independently (format version 6,
+            # or 4), so that they can be restored one by one
+            digits = 6
+            # Files with holes are sent as their data extents (see sparse)
+            data_size = self.document.get('data size', self.document['size'])
+            if size == 'auto':
+                chunk_size = auto_chunk_size(data_size, self.db.config.get('upload stats'))
             else:
-                digits = 2
+                chunk_size = int(float(size) * 1000000)
+            chunk_size = self.paced_chunk_size(chunk_size)
             chunk_prefix = path_join(self.db.cache_path, self.document["id"])
-            split = {'args':[encrypted],
-                     'kwargs':{'output': chunk_prefix,
-                               'size': size,
-                               'digits': digits}}
-            self.document["pieces"] = self.split(*split['args'], **split['kwargs']) 
-
-            td.cycle(self.connected)
-
-            # Send files
-            for i in range(self.document["pieces"]):
-                self.current_upload = chunk_prefix + str(i).zfill(digits)
-                self.uploaded = False
-                td.send_file_message(chat_id, self.current_upload)
-                td.cycle(self.sent)
-
-            # Cleaning
-            rm(encrypted)
-            for i in range(self.document["pieces"]):
-                rm(chunk_prefix + str(i).zfill(digits))
-               
+            self.document['chunk size'] = chunk_size
+            self.document['pieces'] = max(1, -(-data_size // chunk_size))
+            self.document['chunks'] = []
+
+            with self.metrics.stage('connect'):
+                if not td.connected:
+                    td.cycle(self.connected)
+
+            # Encrypt and send chunks, up to the upload window at a time
+            self.document['messages id'] = self.upload(td, chat_id,
+                                                       self.sealed_chunks(chunk_prefix, digits),
+                                                       self.document['id'])
+
             # Saving 
-            # See https://github.com/RaRe-Technologies/sqlitedict/issues/110
-            
-            # Indexing with hash
-            db_hash_document = self.db.files[self.document['hash']]
-            db_hash_document.append(self.document)
-            self.db.files[self.document['hash']] = db_hash_document
-            
-            # Indexing with name
-            try:
-                db_names_document = self.db.file_names[self.document['name']]
-            except KeyError as e:
-                db_names_document = []
-            db_names_document.append(self.document)
-            self.db.file_names[self.document['name']] = db_names_document
- 
+            self.db.add_document(self.document)
             self.db.save()
+            self.metrics.files += 1
     
             # Close client
-            td.destroy(td.client)
+            if not shared:
+                td.destroy(td.client)
             cd(current_path)
 
         except MessageInException as e:
+            # Remember hashes of files already backed up
+            self.db.stat_cache.commit()
+
             # Close client
             cd(current_path)
 
-    def process_file(self, f, ignore_duplicate=False, verbose=0):
+    def process_file(self, f, ignore_duplicate=False, verbose=0, format_version=4, extents=True):
         """Extract data from the file for insert in the database
 
         Args:
             f (str): path of the file to be processed
             override (bool): whether to include a file already backed up
             verbose (int): explanation in class declaration
+            format_version (int): 3 for a single gpg stream, 4 for independently
+                                  gpg encrypted chunks, 5 for AES-GCM chunks,
+                                  6 for chunks of independent AES-GCM segments
+            extents (bool): record the data extents of a file with holes
         Returns:
             document (dict):
         """
         document = {'name': f.split("/")[-1],
                     'path': f,
-                    'hash': self.hash(f),
+                    'hash': self.cached_hash(f),
                     'real path': realpath(f),
                     'id': random_id(20),
-                    'passphrase': random_id(200),
                     'chat id': self.db.config['backup chat id'],
                     'messages id': [],
                     'size': getsize(f),
-                    'format version': 3,
+                    'format version': format_version,
                     'date backed up': datetime.now()}
+        if format_version >= 5:
+            from .crypto import new_key, SEGMENT_SIZE
+            document['key'] = new_key()
+            if format_version >= 6:
+                document['segment size'] = SEGMENT_SIZE
+        else:
+            document['passphrase'] = random_id(200)
 
         if verbose >= 1:
             for k in document.keys():
@@ -427,14 +704,50 @@ class Backup:
 
         if not ignore_duplicate:
             try:
-                if not self.db.files[document['hash']]:
-                    return document
-                else:
+                if self.db.files[document['hash']]:
                     return False
             except KeyError as e:
-                self.db.files[document['hash']] = []
+                self.db.update(self.db.files_db_path, {document['hash']: lambda documents: documents or []})
+
+        # Only for files to upload, since looking for zero blocks reads them
+        if format_version >= 4 and extents:
+            from .sparse import data_extents, data_size
+            extents = data_extents(f)
+            if extents is not None:
+                document['extents'] = extents
+                document['data size'] = data_size(extents)
+                if verbose >= 1:
+                    print(color.set(color.BLUE, "extents: ") + str(extents))
         return document
 
+    def cached_hash(self, f):
+        """Evaluate sha256sum for a file unless it did not change since last time
+
+        The stat cache maps device and inode of a file to its size, mtime,
+        ctime and hash, so unchanged files (and hardlinks to an inode
+        already seen) are not read again.
+
+        Args:
+            f (str): path of the file to hash
+        Returns:
+            (str) sha256sum of the file
+        """
+        st = stat(f)
+        key = "{}:{}".format(st.st_dev, st.st_ino)
+        signature = (st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+        try:
+            cached = self.db.stat_cache[key]
+            if cached[:3] == signature:
+                return cached[3]
+        except KeyError as e:
+            pass
+        with self.metrics.stage('hash', size=st.st_size):
+            file_hash = self.hash(f)
+        self.db.stat_cache[key] = signature + (file_hash,)
+        # Do not keep the stat cache locked while uploading
+        self.db.stat_cache.commit()
+        return file_hash
+
     def hash(self, f):
         """Evaluate sha256sum for a file
 
@@ -443,6 +756,13 @@ class Backup:
         Returns:
             (str) sha256sum of the file
         """
+        from subprocess import check_output as sh
+        from .lowimpact import enabled
+
+        if enabled():
+            # Read it here, so that it can be dropped from the page cache;
+            # catalog keys are the digest as sha256sum output was parsed
+            return "b'" + sha256_digest(f, release=True)
         out = sh(['sha256sum', f])
         out = str(out)
         out = out.split(' ')
@@ -457,6 +777,8 @@ class Backup:
         Returns:
             nothing
         """
+        from subprocess import check_output as sh
+
         return sh(['gpg',
                    '--output',
                    output,
@@ -477,6 +799,107 @@ class Backup:
                    'AES256',
                    f])
 
+    def sealed_chunks(self, chunk_prefix, digits=6):
+        """Encrypt the chunks of the document, each one when it is asked for
+
+        Args:
+            chunk_prefix (str): path of the chunks but their number
+            digits (int): digits of the chunk numbers
+        Returns:
+            (iterator) position and path of the chunks
+        """
+        chunk_size = self.document['chunk size']
+        data_size = self.document.get('data size', self.document['size'])
+        for i in range(self.document['pieces']):
+            path = chunk_prefix + str(i).zfill(digits)
+            with self.metrics.stage('encrypt',
+                                    size=min(chunk_size, data_size - i * chunk_size),
+                                    chunk=i,
+                                    document=self.document['id']):
+                self.seal_chunk(self.document,
+                                i,
+                                offset=i * chunk_size,
+                                length=chunk_size,
+                                output=path)
+            with self.metrics.stage('digest', size=getsize(path), chunk=i, document=self.document['id']):
+                self.document['chunks'].append({'size': getsize(path),
+                                                'sha256': sha256_digest(path)})
+            yield i, path
+
+    def seal_chunk(self, document, index, offset, length, output):
+        """Encrypt a chunk of a document according to its format version
+
+        Args:
+            document (dict): the document
+            index (int): position of the chunk in the document
+            offset (int): position of the chunk in the file, or in the
+                          data stream of a file with holes
+            length (int): size of the chunk
+            output (str): path of the encrypted chunk
+        """
+        path = document['path']
+        if 'extents' in document:
+            # Gather the data of the chunk, skipping the holes
+            from .sparse import gather
+            path = output + ".data"
+            gather(document['path'], document['extents'], offset, length, path)
+            offset = 0
+        try:
+            if document['format version'] >= 6:
+                from .crypto import seal_chunk
+                seal_chunk(path, document['key'], document['id'], index, offset, length, output,
+                           segment_size=document['segment size'])
+            elif document['format version'] >= 5:
+                from .crypto import chunk_aad, seal
+                seal(path, document['key'], chunk_aad(document['id'], index), offset, length, output)
+            else:
+                self.encrypt_chunk(path, document['passphrase'], offset, length, output)
+        finally:
+            if path != document['path']:
+                rm(path)
+
+    def encrypt_chunk(self, f, passphrase, offset, length, output, block_size=1048576):
+        """GPG encrypt a slice of the file at path f with a passphrase
+
+        Args:
+            f (str): path of the file to encrypt
+            passphrase (str): secret key with which encrypt the chunk
+            offset (int): position of the chunk in the file
+            length (int): size of the chunk
+            output (str): path of the encrypted chunk
+        Returns:
+            nothing
+        """
+        from subprocess import Popen, PIPE
+        from .lowimpact import blocks
+
+        gpg = ['gpg',
+               '--output',
+               output,
+               '--symmetric',
+               '--batch',
+               '--yes',
+               '--passphrase',
+               passphrase,
+               '--cipher-algo',
+               'AES256',
+               '--s2k-mode',
+               '{}'.format(3),
+               '--s2k-count',
+               '{}'.format(65011712),
+               '--s2k-digest-algo',
+               'SHA512',
+               '--s2k-cipher-algo',
+               'AES256']
+        process_gpg = Popen(gpg, stdin=PIPE, shell=False)
+        with open(f, 'rb') as source:
+            source.seek(offset)
+            for data in blocks(source, length, block_size):
+                process_gpg.stdin.write(data)
+        process_gpg.stdin.close()
+        if process_gpg.wait():
+            raise Exception("gpg failed encrypting {}".format(output))
+
     def compress(self, f, output=None):
         """Compress file with GNU tar
         
@@ -484,6 +907,8 @@ class Backup:
             f (str): path of the file
             output (str): name of the resulting file (optional)
         """
+        from subprocess import check_output as sh
+
         if output == None:
             output = f
         return sh(['nocache',
@@ -503,6 +928,8 @@ class Backup:
             output (str): name of the output files (they will be outputXX with XX numbers)
             size (float): size of the splitted chunks (optional)
         """
+        from subprocess import check_output as sh
+
         try:
             out = sh(['split',
                              '--bytes',
@@ -532,54 +959,434 @@ class Backup:
         if message == False:
             print("\nMessage not pertaining.")
 
+    def upload(self, td, chat_id, chunks, document_id):
+        """Upload chunks keeping up to the upload window in flight
+
+        Chunks are taken from 'chunks' only when there is room in the
+        window (see scheduler.py), so that at most a window of them is on
+        disk. Failed uploads are sent again, after the time asked by the
+        server for rate limit errors; uploaded chunks are removed.
+
+        Args:
+            td (Td): connected telegram client
+            chat_id (int): id of the backup chat
+            chunks (iterator): position and path of the chunks
+            document_id (str): id of the document or pack, for metrics
+        Returns:
+            (list) message ids of the chunks, in order
+        """
+        from collections import deque
+        from .scheduler import scheduler
+
+        self.chat_id = chat_id
+        self.chunk_source = iter(chunks)
+        self.chunks_left = True
+        self.upload_document_id = document_id
+        self.uploads = {}
+        self.sending = {}
+        self.retry = deque()
+        self.messages = {}
+        self.upload_error = None
+        self.upload_count = 0
+        self.upload_paused_until = 0
+        self.window = scheduler.window('upload', self.upload_window)
+        try:
+            self.top_up_uploads(td)
+            if self.uploads or self.retry or self.chunks_left:
+                td.cycle(self.sent, tick=True)
+        finally:
+            for path in [u[1] for u in self.uploads.values()] + [r[1] for r in self.retry]:
+                if exists(path):
+                    rm(path)
+        if self.upload_error is not None:
+            raise Exception(self.upload_error)
+        return [self.messages[i] for i in sorted(self.messages)]
+
+    def top_up_uploads(self, td):
+        """Send chunks while there is room in the upload window"""
+        from time import monotonic
+
+        while self.upload_error is None and self.window.room(len(self.uploads)):
+            if monotonic() < self.upload_paused_until:
+                # Waiting for the upload rate limit
+                break
+            if self.retry:
+                index, path, attempts = self.retry.popleft()
+            else:
+                chunk = next(self.chunk_source, None) if self.chunks_left else None
+                if chunk is None:
+                    self.chunks_left = False
+                    break
+                index, path = chunk
+                attempts = 0
+            wait = self.pace_upload(path)
+            if wait:
+                self.retry.appendleft((index, path, attempts))
+                self.upload_paused_until = monotonic() + wait
+                break
+            extra = "upload {} {}".format(self.upload_document_id, self.upload_count)
+            self.upload_count += 1
+            self.uploads[extra] = (index, path, perf_counter(), attempts)
+            td.send_file_message(self.chat_id, path, extra=extra)
+
     def sent(self, td, event):
-        """Check if the document argument of this class has been saved on telegram cloud
+        """Follow the uploads of the chunks; finishes when all are done
 
         td.cycle argument (see td.py)
 
         """
-        if event['@type'] == 'error' and event['message'] == 'Chat not found':
+        extra = event.get('@extra')
+        if event['@type'] == 'message' and extra in self.uploads:
+            # The message is sent once the upload completes
+            self.sending[event['id']] = extra
+
+        elif event['@type'] == 'error' and extra in self.uploads:
+            self.upload_failed(extra, event)
+
+        elif event['@type'] == 'updateMessageSendSucceeded' and event['old_message_id'] in self.sending:
+            index, path, started, attempts = self.uploads.pop(self.sending.pop(event['old_message_id']))
+            seconds = perf_counter() - started
+            self.metrics.add('upload', seconds, getsize(path), chunk=index, document=self.upload_document_id)
+            self.update_upload_stats(getsize(path), seconds)
+            self.window.success()
+            self.messages[index] = event['message']['id']
+            if self.verbose > 0:
+                print(color.BOLD + path + color.END + ": upload completed")
+            rm(path)
+
+        elif event['@type'] == 'updateMessageSendFailed' and event['old_message_id'] in self.sending:
+            self.upload_failed(self.sending.pop(event['old_message_id']), event)
+
+        self.top_up_uploads(td)
+        if self.upload_error is not None:
+            return True
+        return not (self.uploads or self.retry or self.chunks_left)
+
+    def upload_failed(self, extra, event, attempts=5):
+        """Send a chunk again, unless it failed too many times"""
+        from .scheduler import retry_after
+
+        index, path, started, tried = self.uploads.pop(extra)
+        retry = retry_after(event)
+        message = event.get('message') or event.get('error_message')
+        self.window.failure(retry)
+        self.update_upload_stats(getsize(path), perf_counter() - started, failed=True)
+        if message == 'Chat not found':
             instructions_string = ("{}\n Instructions: {}"
                                    "send the message 'telegram "
                                    "will not allow this' in the "
                                    "chat you want your backups"
                                    "to be stored.").format(color.BOLD + color.BLUE, color.END)
             print(instructions_string)
-            found = self.find_backup_chat(td, event)
-            #if found:
-            #     return True
-            
-        if event['@type'] == 'updateMessageSendSucceeded':
-            if self.verbose >= 1:
-                pprint(event)
-            content = event['message']['content']
-            if content['@type'] == 'messageDocument' and content['document']['@type'] == 'document':
-                document = content['document']['document']
-                if document['@type'] == 'file': 
-                    if self.hash(self.current_upload) == self.hash(document['local']['path']):
-                        if document['remote']['is_uploading_completed']:
-                            if self.verbose > 0:
-                                print(color.BOLD + self.current_upload + color.END + ": upload completed")
-                            self.document['messages id'].append(event['message']['id'])
-                            return True
+            self.upload_error = message
+            return
+        if retry is None:
+            tried += 1
+            if tried >= attempts:
+                self.upload_error = "{}: {}".format(path, message)
+                return
+        print(color.set(color.RED, "{}: {}, sending it again{}".format(
+              path, message, " in {}s".format(retry) if retry else "")))
+        self.retry.append((index, path, tried))
 
     def connected(self, td, event):
         """Check if td instance is connected to telegram network"""
         if td.connected:
             return True
 
+    def update_upload_stats(self, size, seconds, failed=False):
+        """Update the moving averages of upload throughput and failure rate
+
+        They are saved in the configuration and used by auto_chunk_size.
+
+        Args:
+            size (int): bytes uploaded
+            seconds (float): time the upload took
+            failed (bool): whether the upload failed
+        """
+        stats = self.db.config.setdefault('upload stats', {'throughput': None, 'failure rate': 0.0})
+        alpha = 0.2
+        stats['failure rate'] = (1 - alpha) * stats['failure rate'] + alpha * (1 if failed else 0)
+        if not failed and seconds > 0:
+            throughput = size / seconds
+            if stats['throughput'] is None:
+                stats['throughput'] = throughput
+            else:
+                stats['throughput'] = (1 - alpha) * stats['throughput'] + alpha * throughput
+
+    def pace_upload(self, f):
+        """Ask the upload rate limit to send a file
+
+        Args:
+            f (str): path of the file to send
+        Returns:
+            (float) seconds to wait before asking again, 0 if the
+            file can be sent now
+        """
+        if self.throttle is None:
+            return 0
+        wait = self.throttle.before_upload(getsize(f))
+        if wait:
+            self.metrics.add('throttle', wait)
+        return wait
+
+    def paced_chunk_size(self, chunk_size):
+        """Shrink the chunk size to what the upload rate limit lets through at once
+
+        A chunk is sent by tdlib at full speed once its upload starts,
+        so with a rate limit chunks are not bigger than the burst of
+        the limit (see TokenBucket.capacity), and not smaller than 1MB.
+
+        Args:
+            chunk_size (int): chunk size in bytes
+        Returns:
+            (int) chunk size in bytes
+        """
+        burst = self.throttle.upload_burst() if self.throttle is not None else None
+        if burst is None:
+            return chunk_size
+        return max(1000000, min(chunk_size, int(burst) // 1000000 * 1000000))
+
+class PackBackup(Backup):
+    """Backup many small files on telegram as a single pack
+
+    Files are concatenated in a pack which is then encrypted in
+    independent chunks and uploaded like a single file (format version
+    6, or 4 without cryptography), so that they share the same messages.
+    Every document records the 'pack id', which authenticates the chunks
+    in place of the document id, and the 'pack offset' and 'pack length'
+    of its slice inside the pack. Packs of format version 3 are a single
+    gpg stream.
+
+    Args:
+        files (list): paths of the files to backup;
+        ignore_duplicate (bool): create duplicate backup;
+        size (int): specify size of the chunks the pack will be split;
+        verbose (int): integer indicating level of verbose (see Backup);
+        metrics (Metrics): where to record timings of the backup stages;
+        profiler (Profiler): where to time the telegram client event loop;
+        throttle (Throttle): upload and download rate limits;
+        td (Td): connected telegram client to use instead of creating one.
+    """
+
+    def __init__(self, files, ignore_duplicate=False, size='100', verbose=0, metrics=None, profiler=None, throttle=None, td=None):
+        from . import crypto
+        from .metrics import Metrics
+        from .td import Td
+
+        self.metrics = metrics if metrics is not None else Metrics("backup")
+        self.profiler = profiler
+        self.throttle = throttle
+
+        try:
+            current_path = getcwd()
+            self.verbose = verbose
+            self.db = Db(verbose)
+            """Database class instance"""
+            cd(self.db.config_path)
+
+            # Telegram client is instantiated only when needed,
+            # so that files already backed up are skipped quickly
+            shared = td is not None
+
+            # If not already, select backup chat
+            if not "backup chat id" in self.db.config.keys():
+                if td is None:
+                    td = Td(tdjson_path=self.db.executable_path, db_key=self.db.config["db key"], verbosity_level=verbose, metrics=self.metrics, profiler=self.profiler)
+                print(color.set(color.BLUE, "\nInstructions: ") +
+                      ("send the message 'telegram "
+                       "will not allow this' in the chat you want your "
+                       "backups to be stored."))
+                td.cycle(self.find_backup_chat)
+            chat_id = self.db.config['backup chat id']
+
+            # Process documents; the pack is read whole, holes included
+            format_version = 6 if crypto.available else 4
+            self.documents = []
+            hashes = set()
+            for f in files:
+                document = self.process_file(abspath(f), ignore_duplicate=ignore_duplicate, verbose=verbose,
+                                             format_version=format_version, extents=False)
+                if document and not document['hash'] in hashes:
+                    hashes.add(document['hash'])
+                    self.documents.append(document)
+            if not self.documents:
+                raise MessageInException('{} files: already backed up'.format(len(files)))
+
+            # Instantiates telegram client
+            if td is None:
+                td = Td(tdjson_path=self.db.executable_path, db_key=self.db.config["db key"], verbosity_level=verbose, metrics=self.metrics, profiler=self.profiler)
+
+            # Build pack
+            pack_id = random_id(20)
+            pack = path_join(self.db.cache_path, pack_id)
+            with self.metrics.stage('pack', size=sum(d['size'] for d in self.documents)):
+                self.pack(self.documents, pack)
+
+            # The pack is encrypted like a document of its own, with the
+            # key (or passphrase) of the first file
+            self.document = {'id': pack_id,
+                             'path': pack,
+                             'size': getsize(pack),
+                             'format version': format_version,
+                             'chunks': []}
+            for key in ('key', 'segment size', 'passphrase'):
+                if key in self.documents[0]:
+                    self.document[key] = self.documents[0][key]
+            if size == 'auto':
+                # Packs are already about the chunk size
+                chunk_size = max(1, -(-self.document['size'] // 1000000)) * 1000000
+            else:
+                chunk_size = int(float(size) * 1000000)
+            chunk_size = self.paced_chunk_size(chunk_size)
+            self.document['chunk size'] = chunk_size
+            self.document['pieces'] = max(1, -(-self.document['size'] // chunk_size))
+
+            with self.metrics.stage('connect'):
+                if not td.connected:
+                    td.cycle(self.connected)
+
+            # Encrypt and send chunks, up to the upload window at a time
+            digits = 6
+            chunk_prefix = path_join(self.db.cache_path, "{}-".format(pack_id))
+            try:
+                messages_id = self.upload(td, chat_id, self.sealed_chunks(chunk_prefix, digits), pack_id)
+            finally:
+                rm(pack)
+
+            # Saving
+            for document in self.documents:
+                document['pack id'] = pack_id
+                for key in ('key', 'segment size', 'passphrase', 'chunk size', 'pieces'):
+                    if key in self.document:
+                        document[key] = self.document[key]
+                document['messages id'] = list(messages_id)
+                document['chunks'] = [dict(chunk) for chunk in self.document['chunks']]
+                self.db.add_document(document)
+            self.db.save()
+            self.metrics.files += len(self.documents)
+
+            if verbose > 0:
+                print(color.BOLD + pack_id + color.END + ": packed {} files".format(len(self.documents)))
+
+            # Close client
+            if not shared:
+                td.destroy(td.client)
+            cd(current_path)
+
+        except MessageInException as e:
+            # Remember hashes of files already backed up
+            self.db.stat_cache.commit()
+
+            # Close client
+            cd(current_path)
+
+    def pack(self, documents, output, block_size=1048576):
+        """Concatenate documents files recording their position in the pack
+
+        Args:
+            documents (list): documents whose 'path' has to be packed
+            output (str): path of the pack
+        """
+        from .lowimpact import blocks
+
+        offset = 0
+        with open(output, 'wb') as pack:
+            for document in documents:
+                with open(document['path'], 'rb') as f:
+                    length = 0
+                    for data in blocks(f, block_size=block_size):
+                        pack.write(data)
+                        length += len(data)
+                document['pack offset'] = offset
+                document['pack length'] = length
+                offset += length
+
+def auto_chunk_size(file_size, stats=None, window=4,
+                    chunk_seconds=60, minimum=1000000, maximum=2000000000):
+    """Choose the chunk size for a file
+
+    Chunks are sized so that a file fills the upload window, but not
+    bigger than what the upload throughput measured in previous runs
+    sends in about a minute, shrunk when uploads fail often (a failed
+    chunk is uploaded again from scratch); never bigger than the
+    telegram file size limit.
+
+    Args:
+        file_size (int): size of the file; None to size a pack
+        stats (dict): 'throughput' (bytes/s) and 'failure rate' moving
+                      averages of previous uploads (see Backup.update_upload_stats)
+        window (int): uploads that can be in flight at the same time
+        chunk_seconds (float): target upload time of a chunk
+        minimum (int): smallest chunk size in bytes
+        maximum (int): biggest chunk size in bytes
+    Returns:
+        (int) chunk size in bytes (a multiple of 1MB)
+    """
+    size = 100000000
+    if stats and stats.get('throughput'):
+        size = stats['throughput'] * chunk_seconds * (1 - min(stats.get('failure rate', 0), 0.9))
+    if file_size is not None:
+        size = min(size, -(-file_size // window))
+    size = max(minimum, min(maximum, int(size)))
+    return -(-size // 1000000) * 1000000
+
+def pack_batches(files, size):
+    """Group small files in batches not bigger than a pack
+
+    Args:
+        files (list): paths of the files to group
+        size (int): maximum size in bytes of a pack
+    Returns:
+        (list) lists of paths
+    """
+    batches = []
+    batch, batch_size = [], 0
+    for f in files:
+        file_size = getsize(f)
+        if batch and batch_size + file_size > size:
+            batches.append(batch)
+            batch, batch_size = [], 0
+        batch.append(f)
+        batch_size += file_size
+    if batch:
+        batches.append(batch)
+    return batches
+
 class Restore:
-    """Restore backed up files according to various criteria"""
+    """Restore backed up files according to various criteria
+
+    Args:
+        filename (str): exact name, complete path or hash of the file;
+        download_directory (str): directory in which to save the file;
+        verbose (int): integer indicating level of verbose (see Backup);
+        byte_range (tuple): (start, end) restore only this slice of the file;
+                            end can be None for the end of the file;
+        metrics (Metrics): where to record timings of the restore stages;
+        profiler (Profiler): where to time the telegram client event loop;
+        throttle (Throttle): upload and download rate limits;
+        td (Td): connected telegram client to use instead of creating one;
+        cache_size (int): byte cap of the downloaded chunks cache,
+                          default the 'cache size' configuration or 1 GB.
+    """
     executable_path = dirname(abspath(__file__))
 
-    def __init__(self, filename, download_directory=getcwd(), verbose=2):
+    def __init__(self, filename, download_directory=getcwd(), verbose=2, byte_range=None, metrics=None, profiler=None, throttle=None, td=None, cache_size=None):
+        from pprint import pprint
+        from .metrics import Metrics
+        from .td import Td
 
+        self.metrics = metrics if metrics is not None else Metrics("restore")
+        self.profiler = profiler
+        self.throttle = throttle
         self.verbose = verbose
         current_path = getcwd()
         self.download_directory = download_directory
+        self.document = None
 
         # Open 'database'
         self.db = Db(verbose=self.verbose)
+        self.cache = self.open_cache(cache_size)
 
         cd(self.db.config_path)
 
@@ -606,31 +1413,70 @@ class Restore:
 
             self.download_paths = []
 
-            # Instantiates telegram client
-            td = Td(tdjson_path=self.db.executable_path, db_key=self.db.config["db key"], verbosity_level=verbose)
-            td.cycle(self.connected)
-
-            # Download file chunks
-            for message_id in self.document['messages id']:
-                self.message_id = message_id
-                td.send({'@type':'getMessage',
-                         'chat_id':self.document["chat id"],
-                         'message_id':message_id})
-                td.cycle(self.download_file)
-                td.cycle(self.downloaded)
-
-            # Concatenate file chunks
+            # Requested slice of the file
+            start, end = byte_range if byte_range else (0, None)
+            size = self.document.get('size')
+            if end is None or (size is not None and end > size):
+                end = size
+
             output = path_join(self.download_directory, self.document["name"])
-            encrypted = output + ".gpg"
-            self.cat(self.download_paths, encrypted)
+            if byte_range:
+                output = "{}.{}-{}".format(output, start, end if end is not None else "")
 
-            # Decrypt file
-            self.decrypt(encrypted, self.document['passphrase'], output)
+            # Instantiates telegram client
+            shared = td is not None
+            if not shared:
+                td = Td(tdjson_path=self.db.executable_path, db_key=self.db.config["db key"], verbosity_level=verbose, metrics=self.metrics, profiler=self.profiler)
+            with self.metrics.stage('connect'):
+                if not td.connected:
+                    td.cycle(self.connected)
+
+            if self.document.get('format version', 0) >= 4:
+                # Download and decrypt only the chunks containing the slice,
+                # for files in a pack the slice is within the pack
+                offset = self.document.get('pack offset', 0)
+                self.restore_chunks(td, offset + start, offset + end, output)
 
-            # Clean
-            for path in self.download_paths:
-                rm(path)
-            rm(encrypted)
+            else:
+                # Download file chunks
+                for i, message_id in enumerate(self.document['messages id']):
+                    self.fetch_chunk(td, i)
+
+                # Concatenate file chunks
+                if 'pack id' in self.document:
+                    decrypted = path_join(self.db.cache_path, self.document['pack id'])
+                elif byte_range:
+                    decrypted = path_join(self.db.cache_path, self.document['id'])
+                else:
+                    decrypted = output
+                encrypted = decrypted + ".gpg"
+                with self.metrics.stage('cat', size=sum(getsize(path) for path in self.download_paths)):
+                    self.cat(self.download_paths, encrypted)
+
+                # Decrypt file
+                with self.metrics.stage('decrypt', size=getsize(encrypted)):
+                    self.decrypt(encrypted, self.document['passphrase'], decrypted)
+
+                # Extract file from pack or requested slice
+                if decrypted != output:
+                    offset = self.document.get('pack offset', 0)
+                    length = self.document.get('pack length', getsize(decrypted))
+                    if end is not None:
+                        length = min(length, end)
+                    self.extract(decrypted, offset + start, max(0, length - start), output)
+                    rm(decrypted)
+
+                # Clean
+                for path in self.download_paths:
+                    self.cache.discard(path)
+                rm(encrypted)
+
+            self.metrics.files += 1
+            self.cache.trim()
+
+            # Close client
+            if not shared:
+                td.destroy(td.client)
 
             # Come back into current folder
             cd(current_path)
@@ -638,6 +1484,200 @@ class Restore:
         except FileNotFoundError as e:
            cd(current_path) 
 
+    def download_chunk(self, td, message_id, index=None):
+        """Download the chunk attached to a message
+
+        Args:
+            td (Td): telegram client
+            message_id (int): id of the message containing the chunk
+            index (int): position of the chunk in the document
+        Returns:
+            (str) local path of the downloaded chunk
+        """
+        self.message_id = message_id
+        self.chunk_index = index
+        self.cached = None
+        with self.metrics.stage('get message'):
+            self.request(td, lambda: td.send({'@type':'getMessage',
+                                              'chat_id':self.document["chat id"],
+                                              'message_id':message_id,
+                                              '@extra':"restore {}".format(message_id)}))
+            td.cycle(self.download_file, tick=True)
+        if self.cached is not None:
+            self.download_paths.append(self.cached)
+            self.metrics.add('cache hit', 0, getsize(self.cached), chunk=index, document=self.document['id'])
+            return self.cached
+        start = perf_counter()
+        td.cycle(self.downloaded, tick=True)
+        path = self.download_paths[-1]
+        self.metrics.add('download', perf_counter() - start, getsize(path), chunk=index, document=self.document['id'])
+
+        # Keep the chunk for later restores
+        cached = self.cache.put(self.cache_key, path)
+        if cached != path:
+            self.download_paths[-1] = cached
+            td.deleteFile(self.file_id)
+        return cached
+
+    def open_cache(self, cache_size=None):
+        """Chunk cache of the restore"""
+        from .cache import ChunkCache, default_size
+
+        if cache_size is None:
+            cache_size = self.db.config.get('cache size', default_size)
+        return ChunkCache(path_join(self.db.cache_path, "chunks"),
+                          cache_size,
+                          downloads=path_join(self.db.cache_path, "documents"))
+
+    def fetch_chunk(self, td, index, attempts=3):
+        """Download a chunk, fetching it again while it does not match the manifest
+
+        Args:
+            td (Td): telegram client
+            index (int): position of the chunk in the document
+            attempts (int): downloads tried before giving up
+        Returns:
+            (str) local path of the downloaded chunk
+        """
+        for attempt in range(attempts):
+            path = self.download_chunk(td, self.document['messages id'][index], index=index)
+            problem = check_manifest(self.document, index, path)
+            if problem is None:
+                return path
+            print(color.set(color.RED, problem))
+            self.download_paths.remove(path)
+            self.cache.discard(path, damaged=True)
+            td.deleteFile(self.file_id)
+        raise Exception("{}: chunk {} is damaged".format(self.document['name'], index))
+
+    def restore_chunks(self, td, start, end, output):
+        """Restore a slice of an independently encrypted chunks document
+
+        Args:
+            td (Td): telegram client
+            start (int): position of the first byte to restore
+            end (int): position after the last byte to restore
+            output (str): path of the output file
+        """
+        if 'extents' in self.document:
+            # Restore the data of the slice, then put it at its place
+            # leaving the holes unallocated
+            from .sparse import scatter, to_data
+            extents = self.document['extents']
+            data_start, data_end = to_data(extents, start), to_data(extents, end)
+            data = output + ".data"
+            with open(output, 'wb') as out:
+                out.truncate(end - start)
+            if data_end > data_start:
+                try:
+                    self.restore_stream(td, data_start, data_end, data, release=False)
+                    with self.metrics.stage('scatter', size=data_end - data_start):
+                        scatter(data, extents, data_start, data_end, output, origin=start)
+                finally:
+                    if exists(data):
+                        rm(data)
+        else:
+            self.restore_stream(td, start, end, output)
+
+    def restore_stream(self, td, start, end, output, release=True):
+        """Restore a slice of the bytes sent for a chunks document
+
+        They are the file itself, or its data extents if it has holes.
+
+        Args:
+            td (Td): telegram client
+            start (int): position of the first byte to restore
+            end (int): position after the last byte to restore
+            output (str): path of the output file
+            release (bool): in low impact mode, drop the output from
+                            the page cache as it is written (see lowimpact)
+        """
+        from .lowimpact import release as release_pages
+
+        chunk_size = self.document['chunk size']
+        first = start // chunk_size
+        last = max(first, (end - 1) // chunk_size) if end else first
+
+        with open(output, 'wb') as out:
+            for i in range(first, min(last + 1, len(self.document['messages id']))):
+                chunk = self.fetch_chunk(td, i)
+                chunk_start = i * chunk_size
+                position = out.tell()
+                with self.metrics.stage('decrypt', size=getsize(chunk), chunk=i, document=self.document['id']):
+                    self.open_chunk(self.document,
+                                    i,
+                                    chunk,
+                                    out,
+                                    skip=max(0, start - chunk_start),
+                                    length=min(chunk_size, end - chunk_start) - max(0, start - chunk_start))
+                if release:
+                    out.flush()
+                    release_pages(out.fileno(), position, out.tell() - position, written=True)
+                self.cache.discard(chunk)
+
+    def open_chunk(self, document, index, f, out, skip=0, length=None):
+        """Decrypt a chunk of a document according to its format version
+
+        Args:
+            document (dict): the document
+            index (int): position of the chunk in the document
+            f (str): path of the encrypted chunk
+            out (file): opened output file
+            skip (int): bytes of the decrypted chunk to skip
+            length (int): bytes of the decrypted chunk to write
+        """
+        # Chunks of a pack are authenticated with the pack id
+        sealed_id = document.get('pack id', document['id'])
+        if document['format version'] >= 6:
+            # Segments are written at their offsets by the crypto pool
+            from .crypto import unseal_chunk
+            out.flush()
+            position = out.tell()
+            written = unseal_chunk(f, document['key'], sealed_id, index, out.name, position,
+                                   skip=skip, length=length, segment_size=document['segment size'])
+            out.seek(position + written)
+        elif document['format version'] >= 5:
+            from .crypto import chunk_aad, unseal
+            unseal(f, document['key'], chunk_aad(sealed_id, index), out, skip=skip, length=length)
+        else:
+            self.decrypt_chunk(f, document['passphrase'], out, skip=skip, length=length)
+
+    def decrypt_chunk(self, f, passphrase, out, skip=0, length=None, block_size=1048576):
+        """GPG decrypt a chunk writing a slice of it
+
+        Args:
+            f (str): path of the encrypted chunk
+            passphrase (str): secret key which decrypts the chunk
+            out (file): opened output file
+            skip (int): bytes of the decrypted chunk to skip
+            length (int): bytes of the decrypted chunk to write
+        """
+        from subprocess import Popen, PIPE
+
+        gpg = ['gpg']
+        if self.verbose < 1:
+            gpg = gpg + ['--quiet']
+        gpg = gpg + ['--decrypt', '--batch', '--passphrase', passphrase, f]
+
+        process_gpg = Popen(gpg, stdout=PIPE, shell=False)
+        while skip > 0:
+            data = process_gpg.stdout.read(min(block_size, skip))
+            if not data:
+                break
+            skip -= len(data)
+        while length is None or length > 0:
+            data = process_gpg.stdout.read(block_size if length is None else min(block_size, length))
+            if not data:
+                break
+            out.write(data)
+            if length is not None:
+                length -= len(data)
+        while process_gpg.stdout.read(block_size):
+            pass
+        process_gpg.stdout.close()
+        if process_gpg.wait():
+            raise Exception("gpg failed decrypting {}".format(f))
+
     def cat(self, files, output):
         """concatenate files
 
@@ -645,6 +1685,8 @@ class Restore:
             files (list): files to join
             output (str): path of the output file
         """
+        from subprocess import Popen, PIPE
+
         cat = ['cat'] + files
         dd = ['dd',  "of=" + output]
         if self.verbose < 1:
@@ -656,6 +1698,32 @@ class Restore:
         process_cat.stdout.close()
         return process_dd.communicate()[0]
 
+    def extract(self, f, offset, length, output, position=None, block_size=1048576):
+        """Copy a slice of a pack in a file
+
+        Args:
+            f (str): path of the decrypted pack
+            offset (int): position of the slice in the pack
+            length (int): length of the slice
+            output (str): path of the output file
+            position (int): where to write the slice in an existing
+                            output, None to write a new file
+        """
+        from .lowimpact import release
+
+        with open(f, 'rb') as pack, open(output, 'wb' if position is None else 'r+b') as out:
+            pack.seek(offset)
+            if position is not None:
+                out.seek(position)
+            while length > 0:
+                data = pack.read(min(block_size, length))
+                if not data:
+                    break
+                out.write(data)
+                length -= len(data)
+            out.flush()
+            release(out.fileno(), written=True)
+
     def decrypt(self, f, passphrase, output):
         """GPG decrypt file at path f with a passphrase
 
@@ -666,6 +1734,9 @@ class Restore:
         Returns:
             nothing
         """
+        from subprocess import Popen, PIPE
+        from .lowimpact import command
+
         dd = ['dd',  "of=" + output]
         gpg = ['gpg']
         dd = ['dd',  "of=" + output]
@@ -673,6 +1744,7 @@ class Restore:
             dd = dd + ['status=none']
             gpg = gpg + ['--quiet']
         gpg = gpg + ['--decrypt', '--batch', '--passphrase', passphrase, f]
+        dd = command(dd)
 
         process_gpg = Popen(gpg, stdout=PIPE,
                                     shell=False)
@@ -682,11 +1754,61 @@ class Restore:
         return process_dd.communicate()[0]
 
 
+    def request(self, td, send, size=None):
+        """Send a request, remembering how to send it again
+
+        Args:
+            td (Td): telegram client
+            send (fun): sends the request, with '@extra' "restore <id>"
+            size (int): bytes downloaded by the request, to pace it
+                        with the download rate limit
+        """
+        from time import monotonic
+
+        self.send_request = send
+        self.request_size = size
+        self.resend_at = None
+        wait = self.throttle.before_download(size) if self.throttle is not None and size else 0
+        if wait:
+            # Sent by request_failed once the rate limit allows it
+            self.metrics.add('throttle', wait)
+            self.resend_at = monotonic() + wait
+            return
+        self.request_size = None
+        send()
+
+    def request_failed(self, td, event):
+        """Send the request again after a rate limit error, raise on others
+
+        Called by the event handlers, for every event; they have to be
+        cycled with ticks.
+        """
+        from time import monotonic
+        from .scheduler import retry_after, scheduler
+
+        if event['@type'] == 'error' and str(event.get('@extra')).startswith("restore "):
+            retry = retry_after(event)
+            if retry is None:
+                raise Exception("{}: {}".format(self.document['path'], event.get('message')))
+            scheduler.failure('download', retry)
+            print(color.set(color.RED, "{}: {}, trying again in {}s".format(
+                  self.document['path'], event.get('message'), retry)))
+            self.resend_at = monotonic() + retry
+        elif self.resend_at is not None and monotonic() >= self.resend_at:
+            self.request(td, self.send_request, self.request_size)
+
     def download_file(self, td, event):
+        self.request_failed(td, event)
         if event['@type'] == 'message':
             if event['id'] == self.message_id:
-                self.file_id = event['content']['document']['document']['id']
-                td.downloadFile(self.file_id)
+                file = event['content']['document']['document']
+                self.file_id = file['id']
+                self.cache_key = self.cache.key(file, self.document, self.chunk_index)
+                self.cached = self.cache.get(self.cache_key)
+                if self.cached is not None:
+                    return True
+                file_id = self.file_id
+                self.request(td, lambda: td.downloadFile(file_id, extra="restore {}".format(file_id)), size=file['size'])
                 return True
 
     def connected(self, td, event):
@@ -695,8 +1817,11 @@ class Restore:
             return True
 
     def downloaded(self, td, event):
+        from pprint import pprint
+
+        self.request_failed(td, event)
         if event['@type'] == 'updateFile':
-            if event['file']['local']['is_downloading_completed']:
+            if event['file']['id'] == self.file_id and event['file']['local']['is_downloading_completed']:
                 self.download_paths.append(event['file']['local']['path'])
                 return True
         if event['@type'] == 'file':
@@ -706,6 +1831,455 @@ class Restore:
                 self.download_paths.append(event['local']['path'])
                 return True
 
+class BulkRestore(Restore):
+    """Restore every file backed up under a path prefix
+
+    Matching documents are resolved in a single pass over the catalog
+    (the most recent backup of each path wins) and restored over a single
+    telegram session: up to 'concurrency' chunks are downloaded at the
+    same time, while downloaded chunks are decrypted and written by a
+    pool of workers. Files keep their layout relative to the prefix.
+
+    Args:
+        prefix (str): restore files whose path starts with this directory;
+        download_directory (str): directory in which to recreate the tree;
+        concurrency (int): maximum number of downloads in flight;
+        workers (int): decryption workers, default the number of cpus;
+        verbose (int): integer indicating level of verbose (see Backup);
+        metrics (Metrics): where to record timings of the restore stages;
+        profiler (Profiler): where to time the telegram client event loop;
+        throttle (Throttle): upload and download rate limits;
+        td (Td): connected telegram client to use instead of creating one;
+        cache_size (int): byte cap of the downloaded chunks cache (see Restore).
+    """
+
+    def __init__(self, prefix, download_directory=getcwd(), concurrency=8, workers=None, verbose=0, metrics=None, profiler=None, throttle=None, td=None, cache_size=None):
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+        from os import cpu_count
+        from os.path import relpath
+        from threading import Lock
+        from .metrics import Metrics
+        from .scheduler import scheduler
+        from .td import Td
+
+        self.metrics = metrics if metrics is not None else Metrics("restore")
+        self.profiler = profiler
+        self.throttle = throttle
+        self.verbose = verbose
+        self.concurrency = max(1, concurrency)
+        self.window = scheduler.window('download', self.concurrency)
+        self.lock = Lock()
+        current_path = getcwd()
+        prefix = abspath(prefix).rstrip("/")
+        self.download_directory = abspath(download_directory)
+        self.db = Db(verbose=self.verbose, readonly=True)
+        self.cache = self.open_cache(cache_size)
+
+        # Latest backup of every path under the prefix
+        latest = {}
+        for documents in self.db.files.values():
+            for d in documents:
+                if d['path'] == prefix or d['path'].startswith(prefix + "/"):
+                    if not d['path'] in latest or d['date backed up'] > latest[d['path']]['date backed up']:
+                        latest[d['path']] = d
+        self.documents = sorted(latest.values(), key=lambda d: d['path'])
+        self.outputs = {}
+        for d in self.documents:
+            relative = relpath(d['path'], prefix) if d['path'] != prefix else d['name']
+            self.outputs[d['path']] = path_join(self.download_directory, relative)
+        print(color.set(color.BLUE, "{} files to restore".format(len(self.documents))))
+
+        # Chunks to download: (message id, document, index)
+        self.queue = []
+        self.groups = {}
+        for d in self.documents:
+            makedirs(dirname(self.outputs[d['path']]), exist_ok=True)
+            if d.get('format version', 0) >= 4:
+                with open(self.outputs[d['path']], 'wb') as out:
+                    out.truncate(d['size'])
+            if d.get('format version', 0) >= 4 and not 'pack id' in d:
+                for i, message_id in enumerate(d['messages id']):
+                    self.queue.append((message_id, d, i))
+            else:
+                # Files of a pack share its messages, which are downloaded
+                # once: chunks of independently encrypted packs are written
+                # as they come, whole stream documents and packs are
+                # decrypted once all of their pieces are downloaded
+                key = tuple(d['messages id'])
+                if not key in self.groups:
+                    self.groups[key] = {'documents': [], 'paths': {}}
+                    for i, message_id in enumerate(d['messages id']):
+                        self.queue.append((message_id, d, i))
+                self.groups[key]['documents'].append(d)
+        self.queue.reverse()
+
+        self.requested = {}
+        self.downloading = {}
+        self.futures = set()
+        self.retry = deque()
+        self.throttled = deque()
+        self.throttled_until = 0
+        self.attempts = {}
+        self.failed = {}
+        self.restored_bytes = 0
+        start = perf_counter()
+
+        shared = td is not None
+        if not shared and self.queue:
+            cd(self.db.config_path)
+            td = Td(tdjson_path=self.db.executable_path, db_key=self.db.config["db key"], verbosity_level=verbose, metrics=self.metrics, profiler=self.profiler)
+        self.pool = ThreadPoolExecutor(max_workers=workers or cpu_count() or 1)
+        try:
+            if self.queue:
+                with self.metrics.stage('connect'):
+                    if not td.connected:
+                        td.cycle(self.connected)
+                self.top_up(td)
+                if self.queue or self.requested or self.downloading:
+                    td.cycle(self.transfer, tick=True)
+        finally:
+            self.pool.shutdown(wait=True)
+            self.cache.trim()
+            if td is not None and not shared:
+                td.destroy(td.client)
+            cd(current_path)
+
+        # Partially written files are not left behind
+        for path, error in sorted(self.failed.items()):
+            print(color.set(color.RED, "{}: {}".format(path, error)))
+            if exists(self.outputs[path]):
+                rm(self.outputs[path])
+        self.metrics.failures += len(self.failed)
+
+        elapsed = perf_counter() - start
+        restored = len(self.documents) - len(self.failed)
+        print(color.set(color.BLUE, "{} files restored, {} failed, {} bytes in {:.1f}s ({:.2f} MB/s)".format(
+              restored, len(self.failed), self.restored_bytes, elapsed,
+              self.restored_bytes / elapsed / 1000000 if elapsed else 0)))
+
+    def top_up(self, td):
+        """Start downloads until the download window is full
+
+        The window (see scheduler.py) adapts to the rate limits of the
+        server, up to 'concurrency'.
+
+        Downloaded chunks waiting to be decrypted count against a second
+        cap, so that downloads can not fill the disk faster than workers
+        empty it.
+        """
+        from concurrent.futures import wait, FIRST_COMPLETED
+        from time import monotonic
+
+        # Downloads waiting for the download rate limit
+        while self.throttled and monotonic() >= self.throttled_until:
+            file_id, size = self.throttled[0]
+            pause = self.throttle.before_download(size) if self.throttle is not None else 0
+            if pause:
+                self.metrics.add('throttle', pause)
+                self.throttled_until = monotonic() + pause
+                break
+            self.throttled.popleft()
+            td.downloadFile(file_id, extra="download {}".format(file_id))
+
+        # Chunks which did not match the manifest are downloaded again
+        while self.retry:
+            file_id, message_id, document, index = self.retry.popleft()
+            td.deleteFile(file_id)
+            self.queue.append((message_id, document, index))
+
+        while self.queue and self.window.room(len(self.requested) + len(self.downloading)):
+            self.futures = {f for f in self.futures if not f.done()}
+            if len(self.futures) >= 2 * self.concurrency:
+                if self.requested or self.downloading:
+                    break
+                wait(self.futures, return_when=FIRST_COMPLETED)
+                continue
+            message_id, document, index = self.queue.pop()
+            if document['path'] in self.failed:
+                continue
+            self.requested[message_id] = (document, index, perf_counter())
+            td.send({'@type': 'getMessage',
+                     'chat_id': document['chat id'],
+                     'message_id': message_id,
+                     '@extra': message_id})
+
+    def transfer(self, td, event):
+        """Drive all the downloads; finishes when all are done"""
+        if event['@type'] == 'message' and event['id'] in self.requested:
+            document, index, started = self.requested.pop(event['id'])
+            file = event['content']['document']['document']
+            key = self.cache.key(file, document, index)
+            cached = self.cache.get(key)
+            self.downloading[file['id']] = (document, index, started, key)
+            if cached is not None:
+                self.metrics.add('cache hit', 0, getsize(cached), chunk=index, document=document['id'])
+                self.downloaded_chunk(td, file['id'], cached)
+            elif file['local']['is_downloading_completed'] and file['local']['path']:
+                self.downloaded_chunk(td, file['id'], file['local']['path'])
+            else:
+                # Sent by top_up, once the download rate limit allows it
+                self.throttled.append((file['id'], file['size']))
+
+        elif event['@type'] == 'error' and event.get('@extra') in self.requested:
+            document, index, started = self.requested.pop(event['@extra'])
+            self.download_failed(event, document, index, event.get('message', 'message not found'))
+
+        elif event['@type'] == 'error' and str(event.get('@extra')).startswith("download "):
+            file_id = int(event['@extra'].split()[1])
+            if file_id in self.downloading:
+                document, index, started, key = self.downloading.pop(file_id)
+                self.download_failed(event, document, index, event.get('message', 'download failed'))
+
+        elif event['@type'] in ('updateFile', 'file'):
+            file = event['file'] if event['@type'] == 'updateFile' else event
+            if file['id'] in self.downloading and file['local']['is_downloading_completed'] and file['local']['path']:
+                self.downloaded_chunk(td, file['id'], file['local']['path'])
+
+        self.top_up(td)
+        if not (self.queue or self.requested or self.downloading):
+            # Workers may still ask for chunks to be downloaded again
+            from concurrent.futures import wait
+            wait(self.futures)
+            self.top_up(td)
+        return not (self.queue or self.requested or self.downloading)
+
+    def download_failed(self, event, document, index, problem, attempts=3):
+        """Queue a chunk again after a failed request, unless it failed too often
+
+        Rate limited requests are always queued again, once the pause
+        asked by the server is over.
+        """
+        from .scheduler import retry_after
+
+        retry = retry_after(event)
+        self.window.failure(retry)
+        if retry is None and event.get('code') in (400, 404):
+            self.failed[document['path']] = problem
+            return
+        if retry is None:
+            key = (document['id'], index)
+            self.attempts[key] = self.attempts.get(key, 0) + 1
+            if self.attempts[key] >= attempts:
+                self.failed[document['path']] = problem
+                return
+        if self.verbose or retry:
+            print(color.set(color.RED, "{}: {}, downloading it again{}".format(
+                  document['path'], problem, " in {}s".format(retry) if retry else "")))
+        self.queue.append((document['messages id'][index], document, index))
+
+    def downloaded_chunk(self, td, file_id, path):
+        """Hand a downloaded chunk over to the workers, keeping it in the cache"""
+        document, index, started, key = self.downloading.pop(file_id)
+        if dirname(path) != self.cache.directory:
+            self.window.success()
+            self.metrics.add('download', perf_counter() - started, getsize(path), chunk=index, document=document['id'])
+            cached = self.cache.put(key, path)
+            if cached != path:
+                path = cached
+                td.deleteFile(file_id)
+        if document.get('format version', 0) >= 4 and not 'pack id' in document:
+            self.futures.add(self.pool.submit(self.write_chunk, document, index, path, file_id))
+        elif document.get('format version', 0) >= 4:
+            group = self.groups[tuple(document['messages id'])]
+            self.futures.add(self.pool.submit(self.write_pack_chunk, group, index, path, file_id))
+        else:
+            group = self.groups[tuple(document['messages id'])]
+            group['paths'][index] = (path, file_id)
+            if len(group['paths']) == len(document['messages id']):
+                self.futures.add(self.pool.submit(self.write_group, group))
+
+    def refetch(self, document, index, file_id, problem, attempts=3):
+        """Ask the event loop to download a damaged chunk again"""
+        print(color.set(color.RED, problem))
+        with self.lock:
+            key = (document['id'], index)
+            self.attempts[key] = self.attempts.get(key, 0) + 1
+            if self.attempts[key] >= attempts:
+                self.failed[document['path']] = problem
+            else:
+                self.retry.append((file_id, document['messages id'][index], document, index))
+
+    def write_chunk(self, document, index, path, file_id):
+        """Decrypt a chunk of an independently encrypted document at its offset"""
+        problem = None
+        try:
+            if document['path'] in self.failed:
+                return
+            problem = check_manifest(document, index, path)
+            if problem is not None:
+                self.refetch(document, index, file_id, problem)
+                return
+            chunk_size = document['chunk size']
+            output = self.outputs[document['path']]
+            start = perf_counter()
+            if 'extents' in document:
+                # Chunks of a file with holes are slices of its data
+                # extents: the output is already truncated to the size
+                # of the file, so the holes are left unallocated
+                from .sparse import scatter
+                data = "{}.{}.data".format(output, index)
+                try:
+                    with open(data, 'wb') as out:
+                        self.open_chunk(document, index, path, out)
+                    scatter(data, document['extents'], index * chunk_size, index * chunk_size + getsize(data), output)
+                finally:
+                    if exists(data):
+                        rm(data)
+            else:
+                from .lowimpact import release
+                with open(output, 'r+b') as out:
+                    out.seek(index * chunk_size)
+                    self.open_chunk(document, index, path, out)
+                    out.flush()
+                    release(out.fileno(), index * chunk_size, out.tell() - index * chunk_size, written=True)
+            with self.lock:
+                self.metrics.add('decrypt', perf_counter() - start, getsize(path), chunk=index, document=document['id'])
+                self.restored_bytes += min(chunk_size, document.get('data size', document['size']) - index * chunk_size)
+                if index == len(document['messages id']) - 1:
+                    self.metrics.files += 1
+        except Exception as e:
+            with self.lock:
+                self.failed[document['path']] = str(e)
+        finally:
+            self.cache.discard(path, damaged=problem is not None)
+
+    def write_pack_chunk(self, group, index, path, file_id):
+        """Decrypt a chunk of an independently encrypted pack, writing the slices of its files"""
+        first = group['documents'][0]
+        decrypted = "{}.{}".format(path_join(self.db.cache_path, first['pack id']), index)
+        problem = None
+        try:
+            if all(d['path'] in self.failed for d in group['documents']):
+                return
+            problem = check_manifest(first, index, path)
+            if problem is not None:
+                self.refetch(first, index, file_id, problem)
+                with self.lock:
+                    if first['path'] in self.failed:
+                        for d in group['documents']:
+                            self.failed[d['path']] = self.failed[first['path']]
+                return
+            start = perf_counter()
+            with open(decrypted, 'wb') as out:
+                self.open_chunk(first, index, path, out)
+            chunk_start = index * first['chunk size']
+            chunk_end = chunk_start + getsize(decrypted)
+            for d in group['documents']:
+                slice_start = max(chunk_start, d['pack offset'])
+                slice_end = min(chunk_end, d['pack offset'] + d['pack length'])
+                if slice_start < slice_end:
+                    self.extract(decrypted, slice_start - chunk_start, slice_end - slice_start,
+                                 self.outputs[d['path']], position=slice_start - d['pack offset'])
+                    with self.lock:
+                        self.restored_bytes += slice_end - slice_start
+                        if slice_end == d['pack offset'] + d['pack length']:
+                            self.metrics.files += 1
+            with self.lock:
+                self.metrics.add('decrypt', perf_counter() - start, getsize(path), chunk=index, document=first['pack id'])
+        except Exception as e:
+            with self.lock:
+                for d in group['documents']:
+                    self.failed[d['path']] = str(e)
+        finally:
+            self.cache.discard(path, damaged=problem is not None)
+            if exists(decrypted):
+                rm(decrypted)
+
+    def write_group(self, group):
+        """Decrypt a whole stream document or a pack, extracting its files"""
+        first = group['documents'][0]
+        damaged = False
+        for i, (path, file_id) in sorted(group['paths'].items()):
+            problem = check_manifest(first, i, path)
+            if problem is not None:
+                damaged = True
+                del group['paths'][i]
+                self.cache.discard(path, damaged=True)
+                self.refetch(first, i, file_id, problem)
+        if damaged:
+            if first['path'] in self.failed:
+                for i, (path, file_id) in group['paths'].items():
+                    self.cache.discard(path)
+                for d in group['documents']:
+                    self.failed[d['path']] = self.failed[first['path']]
+            return
+        paths = [group['paths'][i][0] for i in sorted(group['paths'])]
+        decrypted = path_join(self.db.cache_path, first.get('pack id', first['id']))
+        encrypted = decrypted + ".gpg"
+        try:
+            start = perf_counter()
+            self.cat(paths, encrypted)
+            self.decrypt(encrypted, first['passphrase'], decrypted)
+            with self.lock:
+                self.metrics.add('decrypt', perf_counter() - start, getsize(encrypted), document=first['id'])
+            for d in group['documents']:
+                length = d.get('pack length', getsize(decrypted))
+                self.extract(decrypted, d.get('pack offset', 0), length, self.outputs[d['path']])
+                with self.lock:
+                    self.restored_bytes += length
+                    self.metrics.files += 1
+        except Exception as e:
+            with self.lock:
+                for d in group['documents']:
+                    self.failed[d['path']] = str(e)
+        finally:
+            for path in paths:
+                self.cache.discard(path)
+            for path in [encrypted, decrypted]:
+                if exists(path):
+                    rm(path)
+
+def expand_paths(filenames):
+    """Files given as argument, walking directories
+
+    Args:
+        filenames (list): paths of files and directories
+    Returns:
+        (list) paths of the files
+    """
+    paths = []
+    for f in filenames:
+        if not isfile(f):
+            if isdir(f):
+                for path, directory, files in walk(f):
+                    for f2 in files:
+                        paths.append(path_join(path, f2))
+        else:
+            paths.append(f)
+    return paths
+
+def parse_range(byte_range):
+    """Parse a START:END byte range
+
+    Args:
+        byte_range (str): range in the form START:END; END can be omitted
+    Returns:
+        (tuple) (start, end) or None if byte_range is None
+    """
+    if byte_range is None:
+        return None
+    start, _, end = byte_range.partition(":")
+    start = int(start) if start else 0
+    end = int(end) if end else None
+    if start < 0 or (end is not None and end < start):
+        raise ValueError("invalid range {}".format(byte_range))
+    return (start, end)
+
+def parse_keep(keep):
+    """Parse the versions of every file kept by gc, at least one
+
+    Args:
+        keep (str): the number of versions
+    Returns:
+        (int) the number of versions
+    """
+    from argparse import ArgumentTypeError
+
+    if int(keep) < 1:
+        raise ArgumentTypeError("at least one version of every file has to be kept")
+    return int(keep)
+
 def video_url_backup(ydl, url, verbose=False):
     video_info = ydl.extract_info(url, download=True)
     
@@ -729,6 +2303,8 @@ def video_url_backup(ydl, url, verbose=False):
  
 
 def youtube_backup(url, verbose):
+    from copy import deepcopy as cp
+
     try:
         from youtube_dl import YoutubeDL as youtube_dl
     except ModuleNotFoundError as e:
@@ -807,8 +2383,11 @@ def youtube_backup(url, verbose):
         else:
             print("Video already backed up")
 
-def get_info(file=None):
-    db = Db()
+def get_info(file=None, db=None):
+    from pprint import pprint
+
+    if db is None:
+        db = Db(readonly=True)
 
     if file:
         try:
@@ -837,9 +2416,89 @@ def get_info(file=None):
         print(info)
 
 
+def list_files(pattern, verbose=0, db=None):
+    """Print the backed up files whose path starts with pattern
+
+    Args:
+        pattern (str): start of the paths
+        verbose (int): print the whole documents
+        db (Db): catalog to use instead of opening it
+    """
+    from pprint import pprint
+
+    if db is None:
+        db = Db(verbose, readonly=True)
+    path = abspath(pattern)
+    docs = [d for documents in db.files.values() for d in documents if d['path'].startswith(path)]
+    if verbose:
+        pprint(docs)
+    else:
+        results = ""
+        for d in docs:
+            results = results + d['path'] + '\n'
+        print(results)
+
+
+def backup_files(filenames, pack_threshold=None, **kwargs):
+    """Back up files and directories
+
+    Args:
+        filenames (list): paths of files and directories
+        pack_threshold (str): pack files smaller than this (MB) together,
+                              None to back up every file on its own
+        kwargs: further arguments of Backup (size, verbose, td, ...)
+    """
+    paths = expand_paths(filenames)
+    size = kwargs.get('size', '100')
+
+    if pack_threshold is not None:
+        threshold = float(pack_threshold) * 1000000
+        small = [f for f in paths if isfile(f) and getsize(f) < threshold]
+        packed = set(small)
+        paths = [f for f in paths if not f in packed]
+        if size == 'auto':
+            pack_size = auto_chunk_size(None, Db(readonly=True).config.get('upload stats'))
+        else:
+            pack_size = int(float(size) * 1000000)
+        for batch in pack_batches(small, pack_size):
+            backup = PackBackup(batch, **kwargs)
+
+    for f in paths:
+        backup = Backup(f, **kwargs)
+
+
+def restore_files(filenames, prefix=None, concurrency=8, **kwargs):
+    """Restore files by name, path or hash, and the files under a directory
+
+    Args:
+        filenames (list): names, paths or hashes of the files
+        prefix (str): directory whose files are restored, None for none
+        concurrency (int): downloads in flight restoring the prefix
+        kwargs: further arguments of Restore (download_directory, td, ...)
+    """
+    if prefix is not None:
+        bulk = BulkRestore(prefix,
+                           concurrency=concurrency,
+                           **{k: v for k, v in kwargs.items() if k != 'byte_range'})
+    for f in filenames:
+        restore = Restore(f, **kwargs)
+
+
 # as script
 
 def main():
+    from sys import argv, exit, stderr
+
+    # Answer without loading anything else
+    if argv[1:] == ['--version']:
+        print(version)
+        return
+
+    from pprint import pprint
+    from argparse import ArgumentParser
+    from setproctitle import setproctitle
+
+    setproctitle(name)
 
     parser = ArgumentParser(description="PGP encrypted backups on Telegram Cloud")
 
@@ -850,14 +2509,116 @@ def main():
                           'default': False,
                           'help': 'extended output'}}
 
-    version = {'args': ['--version'],
+    print_version = {'args': ['--version'],
                'kwargs': {'dest': 'version',
                           'action': 'store_true',
                           'default': False,
                           'help': 'print version'}}
 
+    metrics_json = {'args': ['--metrics-json'],
+                    'kwargs': {'dest': 'metrics_json',
+                               'nargs': 1,
+                               'action': 'store',
+                               'default': [None],
+                               'help': "write timings and throughput of the run as json in this file"}}
+
+    metrics_prometheus = {'args': ['--metrics-prometheus'],
+                          'kwargs': {'dest': 'metrics_prometheus',
+                                     'nargs': 1,
+                                     'action': 'store',
+                                     'default': [None],
+                                     'help': ("write timings and throughput of the run in this file "
+                                              "for the prometheus node exporter textfile collector")}}
+
     parser.add_argument(*verbose['args'], **verbose['kwargs'])
-    parser.add_argument(*version['args'], **version['kwargs'])
+    parser.add_argument(*print_version['args'], **print_version['kwargs'])
+    profile = {'args': ['--profile'],
+               'kwargs': {'dest': 'profile',
+                          'action': 'store_true',
+                          'default': False,
+                          'help': "print the time spent by each event handler, event type and stage"}}
+
+    profile_dump = {'args': ['--profile-dump'],
+                    'kwargs': {'dest': 'profile_dump',
+                               'nargs': 1,
+                               'action': 'store',
+                               'default': [None],
+                               'help': ("profile the run writing PREFIX.pstats (cProfile) "
+                                        "and PREFIX.folded (flamegraph stacks)")}}
+
+    parser.add_argument(*metrics_json['args'], **metrics_json['kwargs'])
+    parser.add_argument(*metrics_prometheus['args'], **metrics_prometheus['kwargs'])
+    upload_limit = {'args': ['--upload-limit'],
+                    'kwargs': {'dest': 'upload_limit',
+                               'nargs': 1,
+                               'action': 'store',
+                               'default': [None],
+                               'help': ("maximum upload rate in bytes per second (e.g. 500K, 2M) "
+                                        "or schedule (e.g. 08:00-20:00=1M,10M); chunks are sent at full "
+                                        "speed, so they are made no bigger than one second of the rate "
+                                        "(at least 1MB); default: unlimited")}}
+
+    download_limit = {'args': ['--download-limit'],
+                      'kwargs': {'dest': 'download_limit',
+                                 'nargs': 1,
+                                 'action': 'store',
+                                 'default': [None],
+                                 'help': ("maximum download rate in bytes per second "
+                                          "or schedule (see --upload-limit); chunks already "
+                                          "uploaded are downloaded at full speed, pausing after "
+                                          "each one so that the rate is kept on average; "
+                                          "default: unlimited")}}
+
+    global_limits = {'args': ['--global-limits'],
+                     'kwargs': {'dest': 'global_limits',
+                                'action': 'store_true',
+                                'default': False,
+                                'help': ("share upload and download limits with the other "
+                                         "running pgpgram processes; default: False")}}
+
+    parser.add_argument(*profile['args'], **profile['kwargs'])
+    parser.add_argument(*profile_dump['args'], **profile_dump['kwargs'])
+    parser.add_argument(*upload_limit['args'], **upload_limit['kwargs'])
+    parser.add_argument(*download_limit['args'], **download_limit['kwargs'])
+    parser.add_argument(*global_limits['args'], **global_limits['kwargs'])
+
+    low_impact = {'args': ['--low-impact'],
+                  'kwargs': {'dest': 'low_impact',
+                             'action': 'store_true',
+                             'default': False,
+                             'help': ("read and write files dropping them from the page cache "
+                                      "behind the cursor, so that the other programs keep "
+                                      "theirs; default: False")}}
+
+    nice = {'args': ['--nice'],
+            'kwargs': {'dest': 'nice',
+                       'nargs': 1,
+                       'action': 'store',
+                       'type': int,
+                       'default': [None],
+                       'help': "CPU niceness, from -20 to 19 (e.g. 19); default: unchanged"}}
+
+    ionice = {'args': ['--ionice'],
+              'kwargs': {'dest': 'ionice',
+                         'nargs': 1,
+                         'action': 'store',
+                         'choices': ['idle', 'best-effort'],
+                         'default': [None],
+                         'help': ("I/O scheduling class: 'idle' to use the disk only when "
+                                  "nobody else does, 'best-effort' at the lowest priority; "
+                                  "default: unchanged")}}
+
+    parser.add_argument(*low_impact['args'], **low_impact['kwargs'])
+    parser.add_argument(*nice['args'], **nice['kwargs'])
+    parser.add_argument(*ionice['args'], **ionice['kwargs'])
+
+    no_daemon = {'args': ['--no-daemon'],
+                 'kwargs': {'dest': 'no_daemon',
+                            'action': 'store_true',
+                            'default': False,
+                            'help': "run the command here even if a pgpgram daemon is running"}}
+
+    parser.add_argument(*no_daemon['args'], **no_daemon['kwargs'])
 
     command = parser.add_subparsers(dest="command")
 
@@ -875,7 +2636,8 @@ def main():
                        'nargs': 1,
                        'action': 'store',
                        'default':[100],
-                       'help': "specify size of the chunks the file will be split; default: 100M"}}
+                       'help': ("specify size (in MB) of the chunks the file will be split, "
+                                "or 'auto' to choose it for each file; default: 100M")}}
 
     ignore_duplicate = {'args': ['--ignore-duplicate'],
                         'kwargs': {'dest': 'duplicate',
@@ -890,30 +2652,82 @@ def main():
                           'help': ("use if you want to backup a youtube video or channel"
                                    "(requires youtube-dl); default: False")}}
 
+    pack = {'args': ['--pack'],
+            'kwargs': {'dest': 'pack',
+                       'action': 'store_true',
+                       'default': False,
+                       'help': ("bundle small files in shared encrypted packs "
+                                "of about the chunk size; default: False")}}
+
+    pack_threshold = {'args': ['--pack-threshold'],
+                      'kwargs': {'dest': 'pack_threshold',
+                                 'nargs': 1,
+                                 'action': 'store',
+                                 'default': [1],
+                                 'help': "files smaller than this size (in MB) get packed; default: 1M"}}
+
     backup.add_argument(*backup_filename['args'], **backup_filename['kwargs'])
     backup.add_argument(*size['args'], **size['kwargs'])
     backup.add_argument(*ignore_duplicate['args'], **ignore_duplicate['kwargs'])
     backup.add_argument(*youtube['args'], **youtube['kwargs'])
+    backup.add_argument(*pack['args'], **pack['kwargs'])
+    backup.add_argument(*pack_threshold['args'], **pack_threshold['kwargs'])
 
     restore = command.add_parser('restore', help="restore file")
 
     # Restore args
 
     restore_filename = {'args': ['filename'],
-                        'kwargs': {'nargs': '+',
+                        'kwargs': {'nargs': '*',
                                    'action': 'store',
                                    'help': ("exact name, complete path"
                                             "or hash of the file to be restored")}}
 
-    download_directory = {'args': ['--download-directory'],
+    download_directory = {'args': ['--download-directory', '--to'],
                           'kwargs': {'dest': 'download_dir',
                                      'nargs': 1,
                                      'action': 'store',
                                      'default': [getcwd()],
                                      'help': "directory in which to save the file; default: current dir"}}
 
+    byte_range = {'args': ['--range'],
+                  'kwargs': {'dest': 'range',
+                             'nargs': 1,
+                             'action': 'store',
+                             'default': [None],
+                             'help': ("restore only the bytes START:END of the file "
+                                      "(END excluded, can be omitted); default: whole file")}}
+
     restore.add_argument(*restore_filename['args'], **restore_filename['kwargs'])
     restore.add_argument(*download_directory['args'], **download_directory['kwargs']) 
+    restore.add_argument(*byte_range['args'], **byte_range['kwargs'])
+
+    restore_prefix = {'args': ['--prefix'],
+                      'kwargs': {'dest': 'prefix',
+                                 'nargs': 1,
+                                 'action': 'store',
+                                 'default': [None],
+                                 'help': ("restore every file backed up under this directory, "
+                                          "keeping the layout relative to it")}}
+
+    restore_concurrency = {'args': ['--concurrency'],
+                           'kwargs': {'dest': 'concurrency',
+                                      'type': int,
+                                      'action': 'store',
+                                      'default': 8,
+                                      'help': "maximum number of downloads in flight with --prefix; default: 8"}}
+
+    restore_cache_size = {'args': ['--cache-size'],
+                          'kwargs': {'dest': 'cache_size',
+                                     'nargs': 1,
+                                     'action': 'store',
+                                     'default': [None],
+                                     'help': ("keep up to this much downloaded chunks (e.g. 500M, 2G) "
+                                              "for later restores, 0 to disable; default: 1G")}}
+
+    restore.add_argument(*restore_prefix['args'], **restore_prefix['kwargs'])
+    restore.add_argument(*restore_cache_size['args'], **restore_cache_size['kwargs'])
+    restore.add_argument(*restore_concurrency['args'], **restore_concurrency['kwargs'])
 
     list_command = command.add_parser('list', help="show all backed up files in location")
 
@@ -984,14 +2798,201 @@ def main():
 
     # Import args
     import_filename = {'args': ['filename'],
-                       'kwargs': {'nargs': 1,
+                       'kwargs': {'nargs': '+',
+                                  'action': 'store',
+                                  'help': "files.db (or legacy files.pkl) catalogs to import"}}
+
+    import_command.add_argument(*import_filename['args'], **import_filename['kwargs'])
+
+    queue_command = command.add_parser('queue', help="manage the queue of backup and restore jobs")
+    queue_action = queue_command.add_subparsers(dest="queue_command")
+
+    # Queue args
+    queue_add = queue_action.add_parser('add', help="queue backup or restore jobs")
+
+    queue_kind = {'args': ['kind'],
+                  'kwargs': {'choices': ['backup', 'restore'],
+                             'help': "kind of the jobs"}}
+
+    queue_filename = {'args': ['filename'],
+                      'kwargs': {'nargs': '+',
+                                 'action': 'store',
+                                 'help': ("files or directories to back up, or exact names, "
+                                          "complete paths or hashes of the files to restore")}}
+
+    queue_priority = {'args': ['--priority'],
+                      'kwargs': {'dest': 'priority',
+                                 'type': int,
+                                 'action': 'store',
+                                 'default': 0,
+                                 'help': "jobs with higher priority run first; default: 0"}}
+
+    queue_add.add_argument(*queue_kind['args'], **queue_kind['kwargs'])
+    queue_add.add_argument(*queue_filename['args'], **queue_filename['kwargs'])
+    queue_add.add_argument(*queue_priority['args'], **queue_priority['kwargs'])
+    queue_add.add_argument(*size['args'], **size['kwargs'])
+    queue_add.add_argument(*ignore_duplicate['args'], **ignore_duplicate['kwargs'])
+    queue_add.add_argument(*download_directory['args'], **download_directory['kwargs'])
+    queue_add.add_argument(*byte_range['args'], **byte_range['kwargs'])
+
+    queue_status = queue_action.add_parser('status', help="show queued, running and failed jobs")
+
+    queue_all = {'args': ['--all'],
+                 'kwargs': {'dest': 'all',
+                            'action': 'store_true',
+                            'default': False,
+                            'help': "show completed jobs too"}}
+
+    queue_status.add_argument(*queue_all['args'], **queue_all['kwargs'])
+
+    queue_work = queue_action.add_parser('work', help="run queued jobs over a single telegram session")
+
+    queue_forever = {'args': ['--forever'],
+                     'kwargs': {'dest': 'forever',
+                                'action': 'store_true',
+                                'default': False,
+                                'help': "keep waiting for new jobs when the queue is empty"}}
+
+    queue_work.add_argument(*queue_forever['args'], **queue_forever['kwargs'])
+
+    delete_command = command.add_parser('delete', help="delete backed up files from the catalog and from telegram")
+
+    # Delete args
+    delete_filename = {'args': ['filename'],
+                       'kwargs': {'nargs': '*',
                                   'action': 'store',
-                                  'help': "pickle file to import"}}
+                                  'help': ("path or hash of the files to delete; a name alone "
+                                           "needs --all, which deletes every file having it")}}
 
-    import_command.add_argument(*backup_filename['args'], **backup_filename['kwargs'])
+    delete_prefix = {'args': ['--prefix'],
+                     'kwargs': {'dest': 'prefix',
+                                'nargs': 1,
+                                'action': 'store',
+                                'default': [None],
+                                'help': "delete every file backed up under this directory"}}
+
+    dry_run = {'args': ['--dry-run'],
+               'kwargs': {'dest': 'dry_run',
+                          'action': 'store_true',
+                          'default': False,
+                          'help': "only show what would be deleted"}}
+
+    delete_all = {'args': ['--all'],
+                  'kwargs': {'dest': 'all',
+                             'action': 'store_true',
+                             'default': False,
+                             'help': "delete every file having the names given"}}
+
+    delete_command.add_argument(*delete_filename['args'], **delete_filename['kwargs'])
+    delete_command.add_argument(*delete_prefix['args'], **delete_prefix['kwargs'])
+    delete_command.add_argument(*delete_all['args'], **delete_all['kwargs'])
+    delete_command.add_argument(*dry_run['args'], **dry_run['kwargs'])
+
+    gc_command = command.add_parser('gc', help="delete old versions of backed up files")
+
+    # Gc args
+    gc_keep = {'args': ['--keep'],
+               'kwargs': {'dest': 'keep',
+                          'type': parse_keep,
+                          'action': 'store',
+                          'default': None,
+                          'help': "versions of every file to keep, at least 1"}}
+
+    gc_older_than = {'args': ['--older-than'],
+                     'kwargs': {'dest': 'older_than',
+                                'type': float,
+                                'action': 'store',
+                                'default': None,
+                                'help': ("delete versions backed up more than this many days ago; "
+                                         "the last version of a file is always kept")}}
+
+    gc_prefix = {'args': ['--prefix'],
+                 'kwargs': {'dest': 'prefix',
+                            'nargs': 1,
+                            'action': 'store',
+                            'default': [None],
+                            'help': "apply the policy only to files under this directory"}}
+
+    gc_command.add_argument(*gc_keep['args'], **gc_keep['kwargs'])
+    gc_command.add_argument(*gc_older_than['args'], **gc_older_than['kwargs'])
+    gc_command.add_argument(*gc_prefix['args'], **gc_prefix['kwargs'])
+    gc_command.add_argument(*dry_run['args'], **dry_run['kwargs'])
+
+    verify_command = command.add_parser('verify', help="check that backed up files are still on telegram")
+
+    # Verify args
+    verify_deep = {'args': ['--deep'],
+                   'kwargs': {'dest': 'deep',
+                              'nargs': 1,
+                              'action': 'store',
+                              'default': ['0'],
+                              'help': "also download and check this percentage of the chunks, e.g. 5%%; default: 0"}}
+
+    verify_max_age = {'args': ['--max-age'],
+                      'kwargs': {'dest': 'max_age',
+                                 'type': float,
+                                 'action': 'store',
+                                 'default': 7,
+                                 'help': "recheck only files not verified in this many days; default: 7"}}
+
+    verify_all = {'args': ['--all'],
+                  'kwargs': {'dest': 'all',
+                             'action': 'store_true',
+                             'default': False,
+                             'help': "recheck every file"}}
+
+    verify_command.add_argument(*verify_deep['args'], **verify_deep['kwargs'])
+    verify_command.add_argument(*verify_max_age['args'], **verify_max_age['kwargs'])
+    verify_command.add_argument(*verify_all['args'], **verify_all['kwargs'])
+
+    watch_command = command.add_parser('watch', help="back up files of directories as soon as they change")
+
+    # Watch args
+    watch_directory = {'args': ['directory'],
+                       'kwargs': {'nargs': '+',
+                                  'action': 'store',
+                                  'help': "directories to watch"}}
+
+    watch_debounce = {'args': ['--debounce'],
+                      'kwargs': {'dest': 'debounce',
+                                 'type': float,
+                                 'action': 'store',
+                                 'default': 5,
+                                 'help': "seconds a file must be left untouched before it is backed up; default: 5"}}
+
+    watch_no_initial = {'args': ['--no-initial'],
+                        'kwargs': {'dest': 'initial',
+                                   'action': 'store_false',
+                                   'default': True,
+                                   'help': "do not back up files already in the directories"}}
+
+    watch_command.add_argument(*watch_directory['args'], **watch_directory['kwargs'])
+    watch_command.add_argument(*watch_debounce['args'], **watch_debounce['kwargs'])
+    watch_command.add_argument(*watch_no_initial['args'], **watch_no_initial['kwargs'])
+    watch_command.add_argument(*size['args'], **size['kwargs'])
+
+    catalog_backup_command = command.add_parser('catalog-backup', help=("back up the catalog, encrypted with a passphrase, "
+                                                                        "to the backup chat; once set up, it is backed "
+                                                                        "up after every change"))
+
+    # Catalog backup args
+    catalog_snapshot = {'args': ['--snapshot'],
+                        'kwargs': {'dest': 'snapshot',
+                                   'action': 'store_true',
+                                   'default': False,
+                                   'help': "upload the whole catalog instead of the changes"}}
+
+    catalog_backup_command.add_argument(*catalog_snapshot['args'], **catalog_snapshot['kwargs'])
+
+    catalog_restore_command = command.add_parser('catalog-restore', help="rebuild the catalog from its backup in the backup chat")
+
+    daemon_command = command.add_parser('daemon', help=("keep a telegram session open and run backup, restore, "
+                                                        "list and info commands sent by pgpgram"))
 
     args = parser.parse_args()
 
+    config.setup_logging()
+
     if args.version:
         print(version)
 
@@ -1001,53 +3002,235 @@ def main():
     else:
         verbose = 0
 
-    if args.command == "info":
-        if args.filename:
-            get_info(args.filename)
-        else:
-            get_info()
-
-    if args.command == "import":
-        db = Db(verbose)
-        db.import_file(*args.filename)
-
-    if args.command == "backup":
-        backup_kwargs = {'ignore_duplicate': args.duplicate,
-                         'size': str(args.size[0]),
-                         'verbose': verbose}
-        if not args.youtube:
-            for f in args.filename:
-                if not isfile(f):
-                    if isdir(f):
-                        for path, directory, files in walk(f):
-                            for f2 in files:
-                                file_path = path_join(path, f2)
-                                backup = Backup(file_path, **backup_kwargs)
-                else:
-                    backup = Backup(f, **backup_kwargs)
-
-        if args.youtube:
-            youtube_backup(*args.filename, verbose)
+    metrics = None
+    if args.metrics_json[0] or args.metrics_prometheus[0] or args.profile or args.profile_dump[0]:
+        from .metrics import Metrics
+        metrics = Metrics(args.command)
+
+    profiler = None
+    if args.profile or args.profile_dump[0]:
+        from .profiler import Profiler
+        profiler = Profiler(cprofile=bool(args.profile_dump[0]),
+                            sample_interval=0.005 if args.profile_dump[0] else None)
+        profiler.start()
+
+    throttle = None
+    if args.upload_limit[0] or args.download_limit[0]:
+        from .throttle import Throttle
+        throttle = Throttle(upload=args.upload_limit[0],
+                            download=args.download_limit[0],
+                            shared_dir=Db.cache_path if args.global_limits else None)
+
+    # Files are read and written gently (see lowimpact),
+    # by the crypto processes and tools started from now on too
+    if args.low_impact:
+        from .lowimpact import enable
+        enable()
+    if args.nice[0] is not None or args.ionice[0] is not None:
+        from .lowimpact import renice
+        renice(nice=args.nice[0], ionice=args.ionice[0])
+
+    # Commands are run by the daemon, if any, unless
+    # they have to be measured, throttled or run gently here
+    if (args.command in ("backup", "restore", "list", "info") and not args.no_daemon and
+        metrics is None and profiler is None and throttle is None and
+        not args.low_impact and args.nice[0] is None and args.ionice[0] is None):
+        from .daemon import arguments, request
+        daemon_arguments = arguments(args)
+        if daemon_arguments is not None:
+            status = request(args.command, daemon_arguments)
+            if status is not None:
+                exit(status)
+
+    # Changes of the catalog are backed up by checkpoints
+    # (see checkpoint.py) once catalog backups are set up
+    catalog_changed = (args.command in ("import", "backup", "delete", "gc", "queue") and
+                       not getattr(args, 'dry_run', False) and
+                       getattr(args, 'queue_command', 'work') == 'work')
 
-    if args.command == "restore":
-        for f in args.filename:
-            restore = Restore(f, download_directory=args.download_dir[0], verbose=verbose)
+    try:
+        if args.command == "info":
+            if args.filename:
+                get_info(args.filename)
+            else:
+                get_info()
+
+        if args.command == "import":
+            db = Db(verbose)
+            for filename in args.filename:
+                db.import_file(filename)
+
+        if args.command == "catalog-backup":
+            from .checkpoint import Checkpoint, setup
+            snapshot = setup(verbose) or args.snapshot
+            checkpoint = Checkpoint(snapshot=snapshot,
+                                    verbose=verbose,
+                                    metrics=metrics,
+                                    profiler=profiler)
+
+        if args.command == "daemon":
+            from .daemon import Daemon
+            daemon = Daemon(verbose=verbose, throttle=throttle)
+
+        if args.command == "catalog-restore":
+            from .checkpoint import CatalogRestore
+            catalog_restore = CatalogRestore(verbose=verbose,
+                                             metrics=metrics,
+                                             profiler=profiler)
+
+        if args.command in ("delete", "gc"):
+            from .retention import Deletion, expired
+            db = Db(verbose, readonly=True)
+            prefix = abspath(args.prefix[0]).rstrip("/") if args.prefix[0] is not None else None
+            documents = [d for stored in db.files.values() for d in stored
+                         if prefix is None or d['path'] == prefix or d['path'].startswith(prefix + "/")]
+            if args.command == "delete":
+                if not args.filename and prefix is None:
+                    delete_command.error("give the files to delete or --prefix")
+                if args.filename:
+                    paths = {abspath(f) for f in args.filename}
+                    selected = [d for d in documents if d['path'] in paths or d['hash'] in args.filename]
+                    named = [d for d in documents if d['name'] in args.filename and not d in selected]
+                    if named and not args.all:
+                        # A name can stand for many files, list them
+                        for d in sorted(named, key=lambda d: (d['path'], d['date backed up'])):
+                            print("{} {}".format(d['date backed up'].strftime("%Y-%m-%d %H:%M"), d['path']))
+                        delete_command.error("{} files have the names given, give their paths "
+                                             "or --all".format(len({d['path'] for d in named})))
+                    documents = selected + named
+            else:
+                documents = expired(documents, keep=args.keep, older_than=args.older_than)
+            deletion = Deletion(documents,
+                                dry_run=args.dry_run,
+                                verbose=verbose,
+                                metrics=metrics,
+                                profiler=profiler)
+
+        if args.command == "verify":
+            from .verify import Verify, parse_percent
+            verify = Verify(deep=parse_percent(args.deep[0]),
+                            max_age=-1 if args.all else args.max_age,
+                            verbose=verbose,
+                            metrics=metrics,
+                            profiler=profiler,
+                            throttle=throttle)
+
+        if args.command == "watch":
+            from .watch import watch
+            watch(args.directory,
+                  debounce=args.debounce,
+                  initial=args.initial,
+                  verbose=verbose,
+                  size=str(args.size[0]),
+                  metrics=metrics,
+                  profiler=profiler,
+                  throttle=throttle)
+
+        if args.command == "queue":
+            from .jobs import JobQueue, work
+            config.setup_dirs()
+            queue = JobQueue(path_join(Db.data_path, "jobs.db"))
+
+            if args.queue_command == "add":
+                if args.kind == "backup":
+                    targets = [abspath(f) for f in expand_paths(args.filename)]
+                    options = {'ignore_duplicate': args.duplicate,
+                               'size': str(args.size[0])}
+                else:
+                    targets = args.filename
+                    options = {'download_directory': abspath(args.download_dir[0]),
+                               'byte_range': parse_range(args.range[0])}
+                for target in targets:
+                    job_id = queue.add(args.kind, target, options, priority=args.priority)
+                    if verbose:
+                        print("{} {} {}".format(job_id, args.kind, target))
+                print("{} jobs queued".format(len(targets)))
+
+            if args.queue_command == "status":
+                counts = queue.counts()
+                print(", ".join("{}: {}".format(state, counts.get(state, 0))
+                                for state in ('queued', 'running', 'done', 'failed')))
+                states = ('queued', 'running', 'failed', 'done') if args.all else ('queued', 'running', 'failed')
+                for job in queue.jobs(states):
+                    line = "{}{:>6}{} {:<8} {:>3} {} {}".format(color.BOLD, job['id'], color.END,
+                                                               job['state'], job['priority'],
+                                                               job['kind'], job['target'])
+                    if job['state'] == 'queued' and job['not_before'] > time():
+                        line += " (retry in {:.0f}s)".format(job['not_before'] - time())
+                    if job['error'] and job['state'] != 'done':
+                        line += " " + color.set(color.RED, job['error'])
+                    print(line)
+
+            if args.queue_command == "work":
+                done, failed = work(queue,
+                                    verbose=verbose,
+                                    forever=args.forever,
+                                    metrics=metrics,
+                                    profiler=profiler,
+                                    throttle=throttle)
+                print("{} jobs done, {} failed".format(done, failed))
+
+        if args.command == "backup":
+            backup_kwargs = {'ignore_duplicate': args.duplicate,
+                             'size': str(args.size[0]),
+                             'verbose': verbose,
+                             'metrics': metrics,
+                             'profiler': profiler,
+                             'throttle': throttle}
+            if not args.youtube:
+                backup_files(args.filename,
+                             pack_threshold=args.pack_threshold[0] if args.pack else None,
+                             **backup_kwargs)
+
+            if args.youtube:
+                youtube_backup(*args.filename, verbose)
+
+        if args.command == "restore":
+            from .cache import parse_size
+            cache_size = parse_size(args.cache_size[0]) if args.cache_size[0] is not None else None
+            restore_kwargs = {'download_directory': args.download_dir[0],
+                              'cache_size': cache_size,
+                              'verbose': verbose,
+                              'byte_range': parse_range(args.range[0]),
+                              'metrics': metrics,
+                              'profiler': profiler,
+                              'throttle': throttle}
+            if not args.filename and args.prefix[0] is None:
+                restore.error("give the files to restore or --prefix")
+            restore_files(args.filename,
+                          prefix=args.prefix[0],
+                          concurrency=args.concurrency,
+                          **restore_kwargs)
+
+        if args.command == "list":
+            list_files(args.pattern, verbose=verbose)
+
+        if args.command == "search":
+            query = args.query[0]
+            for w in args.query[1:]:
+                query = query + " " + w
+            db = Db(verbose, readonly=True)
+            search = db.search(query, filetype=args.filetype[0], path=args.path[0], results_number=int(args.results), verbose=verbose)
+
+        if catalog_changed:
+            from .checkpoint import auto_checkpoint
+            auto_checkpoint(verbose=verbose, metrics=metrics, profiler=profiler)
+
+    except Exception as e:
+        if metrics is not None:
+            metrics.failures += 1
+        raise
 
-    if args.command == "list":
-        db = Db(verbose)
-        path = abspath(args.pattern)
-        docs = [d for k in db.files for d in db.files[k] if d['path'].startswith(path)]
-        if args.verbose:
-            pprint(docs)
-        else:
-            results = ""
-            for d in docs:
-                results = results + d['path'] + '\n'
-            print(results)
-
-    if args.command == "search":
-        query = args.query[0]
-        for w in args.query[1:]:
-            query = query + " " + w
-        db = Db(verbose)
-        search = db.search(query, filetype=args.filetype[0], path=args.path[0], results_number=int(args.results), verbose=verbose)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            print(profiler.table(metrics), file=stderr)
+            if args.profile_dump[0]:
+                profiler.dump(args.profile_dump[0])
+
+        if metrics is not None:
+            metrics.finished = time()
+            if args.metrics_json[0]:
+                metrics.save_json(args.metrics_json[0])
+            if args.metrics_prometheus[0]:
+                metrics.save_prometheus(args.metrics_prometheus[0])
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+#    Cache
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from collections import OrderedDict
+from os import makedirs, rename, scandir, utime
+from os import remove as rm
+from os.path import basename, dirname, getsize, join as path_join
+from threading import Lock
+from time import time
+
+default_size = 1000000000
+"""Default byte cap of the chunk cache"""
+
+
+def parse_size(size):
+    """Parse a size like 500M or 2G (bytes)
+
+    Args:
+        size (str): the size
+    Returns:
+        (int) bytes
+    """
+    from .throttle import units
+
+    size = size.strip().upper().rstrip("B")
+    unit = size[-1] if size and size[-1] in units else ''
+    return int(float(size[:len(size) - len(unit)] or 0) * units[unit])
+
+
+class ChunkCache:
+    """Size capped cache of downloaded chunks
+
+    Chunks are kept under the remote unique id of their file and their
+    digest, so that restoring a file again reads them from disk instead
+    of downloading them. The least recently used chunks are evicted as
+    soon as a new one takes the cache over its cap, sparing the ones
+    handed out and not discarded yet; a cap of 0 disables the cache.
+    Other processes share the directory, so trim evicts again from
+    what is on disk at the end of a run. Bulk restores get, put and
+    discard chunks from several threads, so the bookkeeping is kept
+    under a lock.
+
+    Args:
+        directory (str): where chunks are kept
+        size (int): byte cap
+        downloads (str): tdlib documents directory, whose files left
+                         behind by interrupted runs are removed on trim
+    """
+
+    orphan_age = 86400
+    """Seconds after which a tdlib download is considered left behind"""
+
+    def __init__(self, directory, size=default_size, downloads=None):
+        self.directory = directory
+        self.size = size
+        self.downloads = downloads
+        self.entries = None
+        self.in_use = set()
+        self.lock = Lock()
+        if self.size:
+            makedirs(directory, exist_ok=True)
+
+    def load(self):
+        """Sizes of the cached chunks, least recently used first"""
+        with self.lock:
+            return self.scan()
+
+    def scan(self):
+        """Sizes of the cached chunks, to be called holding the lock"""
+        if self.entries is None:
+            entries = []
+            for entry in scandir(self.directory):
+                if entry.is_file():
+                    st = entry.stat()
+                    entries.append((st.st_mtime, entry.name, st.st_size))
+            self.entries = OrderedDict((name, size) for _, name, size in sorted(entries))
+            self.total = sum(self.entries.values())
+        return self.entries
+
+    def key(self, file, document, index):
+        """Cache key of a chunk
+
+        Args:
+            file (dict): tdlib file of the chunk
+            document (dict): document the chunk belongs to
+            index (int): position of the chunk in the document
+        Returns:
+            (str) the key, None if the chunk can not be cached
+        """
+        unique_id = file.get('remote', {}).get('unique_id')
+        if not self.size or not unique_id:
+            return None
+        chunks = document.get('chunks', [])
+        digest = chunks[index].get('sha256', '') if index is not None and index < len(chunks) else ''
+        return "{}-{}".format(unique_id.replace("/", "_"), digest)
+
+    def get(self, key):
+        """Path of a cached chunk, None if not cached"""
+        if key is None:
+            return None
+        path = path_join(self.directory, key)
+        try:
+            utime(path)
+        except FileNotFoundError as e:
+            return None
+        with self.lock:
+            if self.entries is not None and key in self.entries:
+                self.entries.move_to_end(key)
+            self.in_use.add(key)
+        return path
+
+    def put(self, key, path):
+        """Move a downloaded chunk in the cache
+
+        Returns:
+            (str) new path of the chunk
+        """
+        if key is None:
+            return path
+        cached = path_join(self.directory, key)
+        try:
+            rename(path, cached)
+        except OSError as e:
+            return path
+        size = getsize(cached)
+        with self.lock:
+            entries = self.scan()
+            self.total -= entries.pop(key, 0)
+            entries[key] = size
+            self.total += size
+            self.in_use.add(key)
+            self.evict()
+        return cached
+
+    def discard(self, path, damaged=False):
+        """Done with a chunk: remove it unless it is cached and not damaged"""
+        cached = dirname(path) == self.directory
+        if damaged or not cached:
+            try:
+                rm(path)
+            except FileNotFoundError as e:
+                pass
+        if cached:
+            key = basename(path)
+            with self.lock:
+                self.in_use.discard(key)
+                if damaged and self.entries is not None and key in self.entries:
+                    self.total -= self.entries.pop(key)
+                if self.entries is not None:
+                    self.evict()
+
+    def evict(self):
+        """Remove the least recently used chunks not in use over the cap
+
+        To be called holding the lock.
+        """
+        for key in list(self.entries):
+            if self.total <= self.size:
+                break
+            if key in self.in_use:
+                continue
+            try:
+                rm(path_join(self.directory, key))
+            except FileNotFoundError as e:
+                pass
+            self.total -= self.entries.pop(key)
+
+    def trim(self):
+        """Evict least recently used chunks over the cap and orphaned downloads"""
+        if self.downloads is not None:
+            limit = time() - self.orphan_age
+            try:
+                for entry in scandir(self.downloads):
+                    if entry.is_file() and entry.stat().st_mtime < limit:
+                        rm(entry.path)
+            except FileNotFoundError as e:
+                pass
+        if not self.size:
+            return
+        with self.lock:
+            entries = []
+            for entry in scandir(self.directory):
+                if entry.is_file():
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for mtime, size, path in sorted(entries):
+                if total <= self.size:
+                    break
+                try:
+                    rm(path)
+                except FileNotFoundError as e:
+                    pass
+                total -= size
+            self.entries = None
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+#    Catalog
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import sqlite3
+from os.path import exists
+from pickle import HIGHEST_PROTOCOL, dumps, loads
+
+
+def encode(obj):
+    """Serialize a SqliteDict value (same as sqlitedict.encode)"""
+    return sqlite3.Binary(dumps(obj, protocol=HIGHEST_PROTOCOL))
+
+
+def decode(obj):
+    """Deserialize a SqliteDict value (same as sqlitedict.decode)"""
+    return loads(bytes(obj))
+
+
+class ReadOnlySqliteDict:
+    """Read-only access to a SqliteDict database
+
+    It never writes to the database, not even pragmas, and keeps locks
+    only for the duration of a single query, so that it can be used
+    while another process is writing to the same database.
+
+    Args:
+        filename (str): path of the database;
+        tablename (str): table of the SqliteDict;
+        page (int): number of rows read by every query while iterating.
+    """
+
+    def __init__(self, filename, tablename="unnamed", page=1000):
+        self.filename = filename
+        self.tablename = tablename.replace('"', '""')
+        self.page = page
+        self.conn = None
+        self.uri = exists(filename)
+        if self.uri:
+            uri = "file:{}?mode=ro".format(filename)
+            self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    def query(self, sql, args=()):
+        if self.conn is None:
+            return []
+        try:
+            return self.conn.execute(sql.format(table=self.tablename), args).fetchall()
+        except sqlite3.OperationalError as e:
+            if "no such table" in str(e):
+                return []
+            if "readonly" in str(e) and self.uri:
+                # A writer crashed leaving a hot journal,
+                # which needs a writable connection to be rolled back
+                self.conn.close()
+                self.uri = False
+                self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+                return self.query(sql, args)
+            raise
+
+    def __len__(self):
+        rows = self.query('SELECT COUNT(*) FROM "{table}"')
+        return rows[0][0] if rows else 0
+
+    def __contains__(self, key):
+        return bool(self.query('SELECT 1 FROM "{table}" WHERE key = ?', (key,)))
+
+    def __getitem__(self, key):
+        rows = self.query('SELECT value FROM "{table}" WHERE key = ?', (key,))
+        if not rows:
+            raise KeyError(key)
+        return decode(rows[0][0])
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError as e:
+            return default
+
+    def items(self):
+        """Iterate over the table one page at a time"""
+        rows = self.query('SELECT key, value FROM "{table}" ORDER BY key LIMIT ?', (self.page,))
+        while rows:
+            for key, value in rows:
+                yield key, decode(value)
+            rows = self.query('SELECT key, value FROM "{table}" WHERE key > ? ORDER BY key LIMIT ?',
+                              (rows[-1][0], self.page))
+
+    def keys(self):
+        rows = self.query('SELECT key FROM "{table}" ORDER BY key LIMIT ?', (self.page,))
+        while rows:
+            for key, in rows:
+                yield key
+            rows = self.query('SELECT key FROM "{table}" WHERE key > ? ORDER BY key LIMIT ?',
+                              (rows[-1][0], self.page))
+
+    def values(self):
+        for key, value in self.items():
+            yield value
+
+    def __iter__(self):
+        return self.keys()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+class Writer:
+    """Atomic read-modify-write of the rows of a SqliteDict database
+
+    SqliteDict writes a value read earlier, so two processes appending
+    to the same row lose one of the appends. Here a row is read and
+    written back inside a single BEGIN IMMEDIATE transaction, which
+    serializes writers over the whole read-modify-write; the database
+    is switched to write-ahead logging, so that readers are never
+    blocked by writers and writers wait only for each other.
+
+    Args:
+        filename (str): path of the database;
+        tablename (str): table of the SqliteDict;
+        timeout (float): seconds to wait for another writer.
+    """
+
+    def __init__(self, filename, tablename="unnamed", timeout=60):
+        self.tablename = tablename.replace('"', '""')
+        self.conn = sqlite3.connect(filename, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "{}" (key TEXT PRIMARY KEY, value BLOB)'.format(self.tablename))
+
+    def update(self, functions):
+        """Replace rows with a function of their current value
+
+        All the rows are updated in the same transaction.
+
+        Args:
+            functions (dict): for every key, a function of the current
+                              value (None if missing) returning the new
+                              one (None to remove the row)
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for key, function in functions.items():
+                row = self.conn.execute('SELECT value FROM "{}" WHERE key = ?'.format(self.tablename), (key,)).fetchone()
+                value = function(decode(row[0]) if row else None)
+                if value is None:
+                    self.conn.execute('DELETE FROM "{}" WHERE key = ?'.format(self.tablename), (key,))
+                else:
+                    self.conn.execute('REPLACE INTO "{}" (key, value) VALUES (?, ?)'.format(self.tablename), (key, encode(value)))
+        except BaseException as e:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def close(self):
+        self.conn.close()
+
+
+def merge(target, source, added, conflicting, tablename="unnamed", page=1000):
+    """Merge a SqliteDict database into another one, set-wise in SQL
+
+    The source is attached to the target: rows whose key is missing in
+    the target are copied with a single INSERT, identical rows are
+    skipped, and rows with the same key but a different value are
+    handed to 'conflicting'. Neither database is loaded in memory;
+    copied and conflicting rows are passed along one page at a time.
+
+    Args:
+        target (str): path of the database to merge into
+        source (str): path of the database to merge
+        added (fun): called with a list of (key, value) of copied rows
+        conflicting (fun): called with a list of (key, source value, target value)
+        tablename (str): table of the SqliteDicts
+        page (int): rows handed to the callbacks at a time
+    Returns:
+        (tuple) number of added, skipped and conflicting rows
+    """
+    table = tablename.replace('"', '""')
+    conn = sqlite3.connect(target, timeout=60)
+    try:
+        conn.execute("ATTACH DATABASE ? AS source", (source,))
+        try:
+            conn.execute('SELECT 1 FROM source."{}" LIMIT 1'.format(table))
+        except sqlite3.OperationalError as e:
+            if "no such table" in str(e):
+                return 0, 0, 0
+            raise
+        conn.execute('CREATE TABLE IF NOT EXISTS main."{}" (key TEXT PRIMARY KEY, value BLOB)'.format(table))
+
+        skipped = conn.execute('''SELECT COUNT(*) FROM source."{0}" s JOIN main."{0}" m ON m.key = s.key
+                                  WHERE m.value = s.value'''.format(table)).fetchone()[0]
+        # Take the write lock before reading, other processes may be writing
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("CREATE TEMP TABLE new_keys (key TEXT PRIMARY KEY)")
+            conn.execute('''INSERT INTO new_keys SELECT s.key FROM source."{0}" s
+                            WHERE NOT EXISTS (SELECT 1 FROM main."{0}" m WHERE m.key = s.key)'''.format(table))
+            conn.execute('''INSERT OR IGNORE INTO main."{0}" (key, value)
+                            SELECT key, value FROM source."{0}" WHERE key IN (SELECT key FROM new_keys)'''.format(table))
+        except BaseException as e:
+            conn.rollback()
+            raise
+        conn.commit()
+        added_count = conn.execute("SELECT COUNT(*) FROM new_keys").fetchone()[0]
+
+        rows = conn.execute('''SELECT n.key, m.value FROM new_keys n JOIN main."{0}" m ON m.key = n.key
+                               ORDER BY n.key LIMIT ?'''.format(table), (page,)).fetchall()
+        while rows:
+            added([(key, decode(value)) for key, value in rows])
+            rows = conn.execute('''SELECT n.key, m.value FROM new_keys n JOIN main."{0}" m ON m.key = n.key
+                                   WHERE n.key > ? ORDER BY n.key LIMIT ?'''.format(table),
+                                (rows[-1][0], page)).fetchall()
+
+        conflicts = 0
+        rows = conn.execute('''SELECT s.key, s.value, m.value FROM source."{0}" s JOIN main."{0}" m ON m.key = s.key
+                               WHERE m.value != s.value ORDER BY s.key LIMIT ?'''.format(table), (page,)).fetchall()
+        while rows:
+            conflicts += len(rows)
+            conflicting([(key, decode(theirs), decode(ours)) for key, theirs, ours in rows])
+            rows = conn.execute('''SELECT s.key, s.value, m.value FROM source."{0}" s JOIN main."{0}" m ON m.key = s.key
+                                   WHERE m.value != s.value AND s.key > ? ORDER BY s.key LIMIT ?'''.format(table),
+                                (rows[-1][0], page)).fetchall()
+        return added_count, skipped, conflicts
+    finally:
+        conn.close()
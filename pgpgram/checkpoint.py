@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+
+#    Checkpoint
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import re
+import sqlite3
+from os import environ, getcwd, getpid, replace
+from os import chdir as cd
+from os import remove as rm
+from os.path import exists, getsize, join as path_join
+from pickle import HIGHEST_PROTOCOL, dump, load
+
+from .color import Color
+from .scheduler import Download
+
+color = Color()
+
+# The catalog backs itself up in the backup chat as a sequence of
+# segments: a snapshot holds every row of files.db, a delta the rows
+# changed since the previous segment (None for removed rows). Rows are
+# tracked by triggers writing their keys in the 'changes' table of
+# files.db, so every writer (SqliteDict, catalog.Writer, imports) is
+# seen. A segment is a stream of pickles
+#
+#     header | (key, value) | ... | None
+#
+# with the values as stored by SqliteDict, encrypted by gpg with the
+# passphrase of the user, and sent with the caption
+#
+#     pgpgram catalog <sequence> <snapshot|delta>
+#
+# so that catalog-restore finds it by searching the chat. The last
+# segment uploaded is recorded in the 'checkpoint' table of files.db,
+# in the transaction forgetting the changes it holds.
+
+caption_pattern = re.compile(r"^pgpgram catalog (\d+) (snapshot|delta)$")
+
+snapshot_every = 30
+"""Deltas uploaded before the next snapshot"""
+
+
+def track(path, tablename="unnamed"):
+    """Record the keys of the rows changed in a SqliteDict database
+
+    Args:
+        path (str): path of the database
+        tablename (str): table of the SqliteDict
+    """
+    table = tablename.replace('"', '""')
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute('CREATE TABLE IF NOT EXISTS "{}" (key TEXT PRIMARY KEY, value BLOB)'.format(table))
+        conn.execute("CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT)")
+        conn.execute(checkpoint_table)
+        for event, row in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+            conn.execute('''CREATE TRIGGER IF NOT EXISTS track_{0} AFTER {1} ON "{2}"
+                            BEGIN INSERT INTO changes (key) VALUES ({3}.key); END'''.format(
+                         event.lower(), event, table, row))
+    finally:
+        conn.close()
+
+
+checkpoint_table = '''CREATE TABLE IF NOT EXISTS checkpoint (id INTEGER PRIMARY KEY CHECK (id = 0),
+                                                                sequence INTEGER, snapshot INTEGER, deltas INTEGER)'''
+
+
+def load_state(conn):
+    """Last segment uploaded, from the 'checkpoint' table
+
+    Returns:
+        (dict) its 'sequence', the 'snapshot' it follows and the
+        'deltas' since that snapshot; empty if none was uploaded
+    """
+    row = conn.execute("SELECT sequence, snapshot, deltas FROM checkpoint WHERE id = 0").fetchone()
+    if row is None:
+        return {}
+    return dict(zip(('sequence', 'snapshot', 'deltas'), row))
+
+
+def save_state(conn, state):
+    """Record the last segment uploaded (see load_state)"""
+    conn.execute("REPLACE INTO checkpoint (id, sequence, snapshot, deltas) VALUES (0, ?, ?, ?)",
+                 (state['sequence'], state['snapshot'], state['deltas']))
+
+
+def passphrase(confirm=False):
+    """Passphrase of the catalog backup
+
+    It is read from PGPGRAM_CATALOG_PASSPHRASE or asked on the terminal.
+
+    Args:
+        confirm (bool): ask it twice
+    Returns:
+        (str) the passphrase
+    """
+    from getpass import getpass
+
+    if environ.get('PGPGRAM_CATALOG_PASSPHRASE'):
+        return environ['PGPGRAM_CATALOG_PASSPHRASE']
+    while True:
+        secret = getpass("Catalog backup passphrase: ")
+        if not secret:
+            continue
+        if not confirm or getpass("Again: ") == secret:
+            return secret
+        print(color.set(color.RED, "The passphrases do not match"))
+
+
+def gpg(arguments, secret):
+    """Run gpg with the passphrase on its standard input"""
+    from subprocess import run, DEVNULL, PIPE
+
+    process = run(['gpg', '--batch', '--yes', '--quiet', '--passphrase-fd', '0'] + arguments,
+                  input=secret.encode(), stdout=DEVNULL, stderr=PIPE)
+    if process.returncode:
+        raise Exception("gpg: {}".format(process.stderr.decode(errors='replace').strip()))
+
+
+class Checkpoint:
+    """Back up the catalog to the backup chat
+
+    Rows changed since the last checkpoint are uploaded as an encrypted
+    delta segment; every 'snapshot every' deltas, or when asked, the
+    whole catalog is uploaded instead. Runs of other processes holding
+    the checkpoint lock are not waited for: their segment covers the
+    changes made so far.
+
+    Args:
+        snapshot (bool): upload the whole catalog;
+        verbose (int): integer indicating level of verbose (see Backup);
+        metrics (Metrics): where to record timings of the stages;
+        profiler (Profiler): where to time the telegram client event loop;
+        td (Td): connected telegram client to use instead of creating one.
+    """
+
+    def __init__(self, snapshot=False, verbose=0, metrics=None, profiler=None, td=None):
+        from fcntl import flock, LOCK_EX, LOCK_NB
+        from . import Db
+        from .metrics import Metrics
+        from .td import Td
+
+        self.metrics = metrics if metrics is not None else Metrics("checkpoint")
+        self.verbose = verbose
+        self.sequence = None
+        current_path = getcwd()
+        db = Db(verbose, readonly=True)
+        if not db.config.get('catalog passphrase'):
+            raise Exception("catalog backup not set up, run 'pgpgram catalog-backup'")
+        if not 'backup chat id' in db.config:
+            raise Exception("no backup chat yet, back up a file first")
+
+        lock = open(path_join(db.cache_path, "checkpoint.lock"), 'w')
+        try:
+            try:
+                flock(lock, LOCK_EX | LOCK_NB)
+            except BlockingIOError as e:
+                if verbose:
+                    print("catalog checkpoint running in another process")
+                return
+            track(db.files_db_path)
+            conn = sqlite3.connect(db.files_db_path, timeout=60)
+            try:
+                # Kept in the configuration by previous versions
+                state = load_state(conn) or db.config.get('catalog checkpoint', {})
+            finally:
+                conn.close()
+            kind = 'delta'
+            if snapshot or not state or state['deltas'] + 1 >= snapshot_every:
+                kind = 'snapshot'
+            self.sequence = state.get('sequence', 0) + 1
+            segment = path_join(db.cache_path, "catalog-{}-{}".format(getpid(), self.sequence))
+
+            with self.metrics.stage('catalog ' + kind):
+                rows, change = self.write(db.files_db_path, segment, kind, state)
+            if kind == 'delta' and not rows:
+                rm(segment)
+                self.sequence = None
+                return
+
+            shared = td is not None
+            try:
+                with self.metrics.stage('encrypt', size=getsize(segment)):
+                    gpg(['--symmetric', '--cipher-algo', 'AES256', '--s2k-digest-algo', 'SHA512',
+                         '--output', segment + ".gpg", segment], db.config['catalog passphrase'])
+                if not shared:
+                    cd(db.config_path)
+                    td = Td(tdjson_path=db.executable_path, db_key=db.config["db key"], verbosity_level=verbose, metrics=self.metrics, profiler=profiler)
+                with self.metrics.stage('connect'):
+                    if not td.connected:
+                        td.cycle(self.connected)
+                self.caption = "pgpgram catalog {} {}".format(self.sequence, kind)
+                self.failed = None
+                with self.metrics.stage('upload', size=getsize(segment + ".gpg")):
+                    td.send_file_message(db.config['backup chat id'], segment + ".gpg", text=self.caption)
+                    td.cycle(self.sent)
+                if self.failed is not None:
+                    raise Exception("catalog upload failed: {}".format(self.failed))
+            finally:
+                for f in (segment, segment + ".gpg"):
+                    if exists(f):
+                        rm(f)
+                if td is not None and not shared:
+                    td.destroy(td.client)
+                cd(current_path)
+
+            # Forget uploaded changes
+            conn = sqlite3.connect(db.files_db_path, timeout=60)
+            with conn:
+                conn.execute("DELETE FROM changes WHERE seq <= ?", (change,))
+                save_state(conn, {'sequence': self.sequence,
+                                  'snapshot': self.sequence if kind == 'snapshot' else state['snapshot'],
+                                  'deltas': 0 if kind == 'snapshot' else state['deltas'] + 1})
+            conn.close()
+            print(color.set(color.BLUE, "catalog {} {} uploaded, {} rows".format(kind, self.sequence, rows)))
+        finally:
+            lock.close()
+
+    def write(self, path, segment, kind, state):
+        """Write the rows of a segment
+
+        The rows are read in a single transaction, together with the
+        last change they include.
+
+        Returns:
+            (tuple) number of rows written and last change included
+        """
+        conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        rows = 0
+        try:
+            conn.execute("BEGIN")
+            change = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+            if kind == 'snapshot':
+                cursor = conn.execute('SELECT key, value FROM "unnamed"')
+            else:
+                cursor = conn.execute('''SELECT c.key, u.value FROM (SELECT DISTINCT key FROM changes WHERE seq <= ?) c
+                                         LEFT JOIN "unnamed" u ON u.key = c.key''', (change,))
+            with open(segment, 'wb') as f:
+                dump({'format': 1,
+                      'kind': kind,
+                      'sequence': state.get('sequence', 0) + 1}, f, protocol=HIGHEST_PROTOCOL)
+                for key, value in cursor:
+                    dump((key, bytes(value) if value is not None else None), f, protocol=HIGHEST_PROTOCOL)
+                    rows += 1
+                dump(None, f, protocol=HIGHEST_PROTOCOL)
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return rows, change
+
+    def connected(self, td, event):
+        """Check if td instance is connected to telegram network"""
+        if td.connected:
+            return True
+
+    def sent(self, td, event):
+        """Wait for the segment to be uploaded"""
+        if event['@type'] in ('updateMessageSendSucceeded', 'updateMessageSendFailed'):
+            content = event['message']['content']
+            if content.get('caption', {}).get('text') == self.caption:
+                if event['@type'] == 'updateMessageSendFailed':
+                    self.failed = event.get('error_message')
+                return True
+        if event['@type'] == 'error' and event.get('message') == 'Chat not found':
+            self.failed = event['message']
+            return True
+
+
+def auto_checkpoint(verbose=0, metrics=None, profiler=None, td=None):
+    """Back up the catalog if catalog backups are set up
+
+    A failed checkpoint does not fail the command that changed the
+    catalog: its changes are uploaded by the next one.
+    """
+    from . import Db
+
+    if not Db(readonly=True).config.get('catalog passphrase'):
+        return
+    try:
+        Checkpoint(verbose=verbose, metrics=metrics, profiler=profiler, td=td)
+    except Exception as e:
+        print(color.set(color.RED, "catalog backup: {}".format(e)))
+
+
+def setup(verbose=0):
+    """Ask the passphrase of the catalog backups and start tracking changes
+
+    Returns:
+        (bool) whether catalog backups were set up just now
+    """
+    from . import Db
+
+    db = Db(verbose)
+    if db.config.get('catalog passphrase'):
+        return False
+    print(color.set(color.BLUE, "The catalog is backed up encrypted with a passphrase, "
+                                "which is needed to restore it on another computer."))
+    db.config['catalog passphrase'] = passphrase(confirm=True)
+    db.save()
+    track(db.files_db_path)
+    return True
+
+
+class CatalogRestore:
+    """Rebuild the catalog from the segments in the backup chat
+
+    The last snapshot and the deltas following it are downloaded,
+    decrypted and replayed into a new files.db, which replaces the
+    current one (kept as files.db.bak); the name index is rebuilt.
+
+    Args:
+        verbose (int): integer indicating level of verbose (see Backup);
+        metrics (Metrics): where to record timings of the stages;
+        profiler (Profiler): where to time the telegram client event loop;
+        td (Td): connected telegram client to use instead of creating one.
+    """
+
+    def __init__(self, verbose=0, metrics=None, profiler=None, td=None):
+        from . import Db
+        from .metrics import Metrics
+        from .td import Td
+
+        self.metrics = metrics if metrics is not None else Metrics("catalog-restore")
+        self.verbose = verbose
+        current_path = getcwd()
+        db = Db(verbose)
+        secret = db.config.get('catalog passphrase') or passphrase()
+
+        shared = td is not None
+        try:
+            if not shared:
+                cd(db.config_path)
+                td = Td(tdjson_path=db.executable_path, db_key=db.config["db key"], verbosity_level=verbose, metrics=self.metrics, profiler=profiler)
+            with self.metrics.stage('connect'):
+                if not td.connected:
+                    td.cycle(self.connected)
+            if not 'backup chat id' in db.config:
+                print(color.set(color.BLUE, "\nInstructions: ") +
+                      ("send the message 'telegram "
+                       "will not allow this' in the chat your "
+                       "backups are stored."))
+                self.db = db
+                td.cycle(self.find_backup_chat)
+            chat_id = db.config['backup chat id']
+
+            with self.metrics.stage('search'):
+                segments = self.search(td, chat_id)
+            snapshots = [sequence for sequence, (kind, message) in segments.items() if kind == 'snapshot']
+            if not snapshots:
+                raise Exception("no catalog snapshot found in the backup chat")
+            first = max(snapshots)
+            last = first
+            while last + 1 in segments and segments[last + 1][0] == 'delta':
+                last += 1
+            print(color.set(color.BLUE, "replaying catalog snapshot {} and {} deltas".format(first, last - first)))
+
+            restored = db.files_db_path + ".restoring"
+            for f in (restored, restored + "-wal", restored + "-shm"):
+                if exists(f):
+                    rm(f)
+            conn = sqlite3.connect(restored)
+            conn.execute('CREATE TABLE "unnamed" (key TEXT PRIMARY KEY, value BLOB)')
+            for sequence in range(first, last + 1):
+                kind, message = segments[sequence]
+                with self.metrics.stage('download', chunk=sequence):
+                    path = Download(message['content']['document']['document']['id']).run(td)
+                try:
+                    with self.metrics.stage('replay', size=getsize(path), chunk=sequence):
+                        self.replay(conn, path, secret, db.cache_path)
+                finally:
+                    td.deleteFile(message['content']['document']['document']['id'])
+            conn.execute(checkpoint_table)
+            save_state(conn, {'sequence': last, 'snapshot': first, 'deltas': last - first})
+            conn.commit()
+            conn.close()
+        finally:
+            if td is not None and not shared:
+                td.destroy(td.client)
+            cd(current_path)
+
+        # Swap catalogs
+        db.files.close()
+        db.file_names.close()
+        for writer in db.writers.values():
+            writer.close()
+        if exists(db.files_db_path):
+            replace(db.files_db_path, db.files_db_path + ".bak")
+        for f in (db.files_db_path + "-wal", db.files_db_path + "-shm",
+                  db.names_db_path, db.names_db_path + "-wal", db.names_db_path + "-shm"):
+            if exists(f):
+                rm(f)
+        replace(restored, db.files_db_path)
+        track(db.files_db_path)
+        db.config['catalog passphrase'] = secret
+        db.config.pop('catalog checkpoint', None)
+        db.save()
+        restored_db = Db(verbose)
+        print(color.set(color.BLUE, "{} hashes restored".format(len(restored_db.files))))
+
+    def search(self, td, chat_id):
+        """Catalog segments of the backup chat
+
+        Returns:
+            (dict) kind and message of every sequence number
+        """
+        self.segments = {}
+        self.from_message_id = 0
+        self.done = False
+        while not self.done:
+            td.send({'@type': 'searchChatMessages',
+                     'chat_id': chat_id,
+                     'query': "pgpgram catalog",
+                     'from_message_id': self.from_message_id,
+                     'offset': 0,
+                     'limit': 100,
+                     'filter': {'@type': 'searchMessagesFilterDocument'},
+                     '@extra': "catalog search {}".format(self.from_message_id)})
+            td.cycle(self.found)
+        return self.segments
+
+    def found(self, td, event):
+        """Collect a page of search results"""
+        if event.get('@extra') != "catalog search {}".format(self.from_message_id):
+            return
+        if event['@type'] == 'error':
+            raise Exception("searchChatMessages: {}".format(event.get('message')))
+        messages = [m for m in event['messages'] if m['id'] != self.from_message_id]
+        for message in messages:
+            match = caption_pattern.match(message['content'].get('caption', {}).get('text', ''))
+            if match and message['content']['@type'] == 'messageDocument':
+                # Retried uploads leave duplicates, keep the most recent
+                self.segments.setdefault(int(match.group(1)), (match.group(2), message))
+        if messages:
+            self.from_message_id = messages[-1]['id']
+        else:
+            self.done = True
+        return True
+
+    def replay(self, conn, path, secret, directory):
+        """Apply a downloaded segment to the catalog being restored"""
+        plain = path_join(directory, "catalog-restore-{}".format(getpid()))
+        try:
+            gpg(['--decrypt', '--output', plain, path], secret)
+            with open(plain, 'rb') as f:
+                header = load(f)
+                if header.get('format') != 1:
+                    raise Exception("unknown catalog segment format {}".format(header.get('format')))
+                if header['kind'] == 'snapshot':
+                    conn.execute('DELETE FROM "unnamed"')
+                while True:
+                    row = load(f)
+                    if row is None:
+                        break
+                    key, value = row
+                    if value is None:
+                        conn.execute('DELETE FROM "unnamed" WHERE key = ?', (key,))
+                    else:
+                        conn.execute('REPLACE INTO "unnamed" (key, value) VALUES (?, ?)', (key, sqlite3.Binary(value)))
+        except EOFError as e:
+            raise Exception("truncated catalog segment {}".format(path))
+        finally:
+            if exists(plain):
+                rm(plain)
+
+    def connected(self, td, event):
+        """Check if td instance is connected to telegram network"""
+        if td.connected:
+            return True
+
+    def find_backup_chat(self, td, event):
+        """Extract chat id of the next chat containing the message 'telegram will not allow this'"""
+        message = td.filter_new_message(event, exact_text='telegram will not allow this')
+        if message:
+            self.db.config['backup chat id'] = message['chat_id']
+            self.db.save()
+            return True
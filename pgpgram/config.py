@@ -20,8 +20,6 @@
 #   along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from appdirs import user_cache_dir, user_config_dir, user_data_dir
-from logging import basicConfig as set_log_config
-from logging import INFO as log_level_info
 from os.path import join as path_join
 from os import makedirs, umask
 
@@ -42,9 +40,11 @@ class Config:
     appauthor = "Pellegrino Prevete"
 
     def __init__(self, 
-                 log_level=log_level_info):
-        self.setup_logging(log_level)
-        self.setup_dirs()
+                 log_level=None,
+                 setup=True):
+        if setup:
+            self.setup_logging(log_level)
+            self.setup_dirs()
 
     def get_db_path(self, db_name: str) -> str:
         return path_join(self.get_data_dir(), ".".join([db_name, 'db']))
@@ -63,8 +63,13 @@ class Config:
         mkdirs(self.get_config_dir())
         mkdirs(self.get_data_dir())
 
-    def setup_logging(self, level: int) -> None:
-        """Set verbose level"""
+    def setup_logging(self, level: int = None) -> None:
+        """Set verbose level (default: INFO)"""
+        from logging import basicConfig as set_log_config
+        from logging import INFO as log_level_info
+
+        if level is None:
+            level = log_level_info
         log_config_args = {
             'format': '%(asctime)s %(levelname)-8s %(message)s',
             'level': level,
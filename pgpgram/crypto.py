@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+#    Crypto
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from os import urandom
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    available = True
+except ModuleNotFoundError as e:
+    available = False
+
+# Every document of format version 5 has its own random 256 bit data key,
+# kept in the catalog as 'key': since the key is random there is nothing
+# to stretch, and chunks are encrypted with AES-256-GCM directly, without
+# the gpg key derivation. An encrypted chunk is
+#
+#     nonce (12 bytes) | ciphertext | tag (16 bytes)
+#
+# with the id of the document and the position of the chunk as
+# additional authenticated data, so that chunks can not be swapped.
+
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+
+def new_key():
+    """Random data key of a document (hex)"""
+    return urandom(32).hex()
+
+
+def chunk_aad(document_id, index):
+    """Additional authenticated data of a chunk"""
+    return b"pgpgram 5 " + document_id.encode() + b" " + index.to_bytes(8, 'big')
+
+
+def require():
+    if not available:
+        raise Exception("Please install cryptography to back up and restore format version 5 documents")
+
+
+def seal(f, key, aad, offset, length, output, block_size=1048576):
+    """Encrypt a slice of a file
+
+    Args:
+        f (str): path of the file to encrypt
+        key (str): data key of the document (hex)
+        aad (bytes): additional authenticated data (see chunk_aad)
+        offset (int): position of the slice in the file
+        length (int): size of the slice
+        output (str): path of the encrypted chunk
+    """
+    require()
+    nonce = urandom(NONCE_SIZE)
+    encryptor = Cipher(algorithms.AES(bytes.fromhex(key)), modes.GCM(nonce)).encryptor()
+    encryptor.authenticate_additional_data(aad)
+    from .lowimpact import blocks
+
+    with open(f, 'rb') as source, open(output, 'wb') as out:
+        out.write(nonce)
+        source.seek(offset)
+        for data in blocks(source, length, block_size):
+            out.write(encryptor.update(data))
+        out.write(encryptor.finalize())
+        out.write(encryptor.tag)
+
+
+def unseal(f, key, aad, out=None, skip=0, length=None, block_size=1048576):
+    """Decrypt a chunk writing a slice of it
+
+    The whole chunk is read to check its tag; plaintext is written as
+    it is decrypted, so the output must be discarded if this raises.
+
+    Args:
+        f (str): path of the encrypted chunk
+        key (str): data key of the document (hex)
+        aad (bytes): additional authenticated data (see chunk_aad)
+        out (file): opened output file, None to only authenticate the chunk
+        skip (int): bytes of the decrypted chunk to skip
+        length (int): bytes of the decrypted chunk to write
+    """
+    require()
+    with open(f, 'rb') as source:
+        source.seek(0, 2)
+        size = source.tell() - NONCE_SIZE - TAG_SIZE
+        if size < 0:
+            raise ValueError("{}: truncated chunk".format(f))
+        source.seek(size + NONCE_SIZE)
+        tag = source.read(TAG_SIZE)
+        source.seek(0)
+        nonce = source.read(NONCE_SIZE)
+        decryptor = Cipher(algorithms.AES(bytes.fromhex(key)), modes.GCM(nonce, tag)).decryptor()
+        decryptor.authenticate_additional_data(aad)
+        position = 0
+        end = size if length is None else min(size, skip + length)
+        while position < size:
+            data = decryptor.update(source.read(min(block_size, size - position)))
+            if out is not None and position + len(data) > skip and position < end:
+                out.write(data[max(0, skip - position):end - position])
+            position += len(data)
+        try:
+            decryptor.finalize()
+        except InvalidTag as e:
+            raise ValueError("{}: authentication failed".format(f))
+
+
+# Format version 6 seals every chunk as a sequence of segments, each
+# one with its own nonce and tag:
+#
+#     nonce | ciphertext of segment 0 | tag | nonce | ... | tag
+#
+# The additional authenticated data of a segment binds the document,
+# the chunk, the position of the segment and whether it is the last
+# one, so segments can not be reordered, swapped or dropped. Since the
+# position of every segment in the chunk is known in advance, segments
+# are encrypted and decrypted independently by a pool of processes,
+# reading and writing files at their offsets.
+
+SEGMENT_SIZE = 4194304
+OVERHEAD = NONCE_SIZE + TAG_SIZE
+
+pool = None
+"""Process pool sealing segments, created on first use"""
+
+
+def segment_aad(document_id, chunk, segment, last):
+    """Additional authenticated data of a segment"""
+    return (b"pgpgram 6 " + document_id.encode() + b" " + chunk.to_bytes(8, 'big') +
+            segment.to_bytes(8, 'big') + (b"\x01" if last else b"\x00"))
+
+
+def get_pool():
+    """Process pool, None on single core hosts
+
+    Processes are started by a fork server, so that they are not forked
+    from a process running tdlib threads.
+    """
+    global pool
+    if pool is None:
+        from os import cpu_count
+        if (cpu_count() or 1) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            from multiprocessing import get_context
+            from atexit import register
+            pool = ProcessPoolExecutor(max_workers=cpu_count(), mp_context=get_context("forkserver"))
+            register(pool.shutdown)
+    return pool
+
+
+def run(tasks):
+    """Run (function, args) tasks in the pool, raising the first failure"""
+    executor = get_pool() if len(tasks) > 1 else None
+    if executor is None:
+        for function, args in tasks:
+            function(*args)
+        return
+    for future in [executor.submit(function, *args) for function, args in tasks]:
+        future.result()
+
+
+def seal_segment(f, output, key, aad, offset, length, output_offset):
+    """Encrypt length bytes of f at offset, writing them in output at output_offset"""
+    from os import O_RDONLY, O_WRONLY, close, open as os_open, pread, pwrite
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from .lowimpact import release, sequential
+
+    source = os_open(f, O_RDONLY)
+    try:
+        sequential(source, offset, length)
+        data = pread(source, length, offset)
+        release(source, offset, length)
+    finally:
+        close(source)
+    nonce = urandom(NONCE_SIZE)
+    sealed = nonce + AESGCM(bytes.fromhex(key)).encrypt(nonce, data, aad)
+    out = os_open(output, O_WRONLY)
+    try:
+        pwrite(out, sealed, output_offset)
+    finally:
+        close(out)
+
+
+def open_segment(f, key, aad, offset, size, output, output_offset, skip, length):
+    """Decrypt the size bytes segment of f at offset
+
+    Bytes skip to skip + length of the segment plaintext are written in
+    output at output_offset; with output None the segment is only
+    authenticated.
+    """
+    from os import O_RDONLY, O_WRONLY, close, open as os_open, pread, pwrite
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    source = os_open(f, O_RDONLY)
+    try:
+        sealed = pread(source, size, offset)
+    finally:
+        close(source)
+    try:
+        data = AESGCM(bytes.fromhex(key)).decrypt(sealed[:NONCE_SIZE], sealed[NONCE_SIZE:], aad)
+    except InvalidTag as e:
+        raise ValueError("{}: authentication of the segment at {} failed".format(f, offset))
+    if output is not None:
+        out = os_open(output, O_WRONLY)
+        try:
+            pwrite(out, data[skip:skip + length], output_offset)
+        finally:
+            close(out)
+
+
+def seal_chunk(f, key, document_id, index, offset, length, output, segment_size=SEGMENT_SIZE):
+    """Encrypt a chunk of a file as independent segments
+
+    Args:
+        f (str): path of the file to encrypt
+        key (str): data key of the document (hex)
+        document_id (str): id of the document
+        index (int): position of the chunk in the document
+        offset (int): position of the chunk in the file
+        length (int): size of the chunk
+        output (str): path of the encrypted chunk
+        segment_size (int): plaintext bytes of every segment
+    """
+    from os.path import getsize
+
+    require()
+    length = max(0, min(length, getsize(f) - offset))
+    segments = max(1, -(-length // segment_size))
+    with open(output, 'wb') as out:
+        out.truncate(length + segments * OVERHEAD)
+    run([(seal_segment, (f, output, key,
+                         segment_aad(document_id, index, j, j == segments - 1),
+                         offset + j * segment_size,
+                         min(segment_size, length - j * segment_size),
+                         j * (segment_size + OVERHEAD)))
+         for j in range(segments)])
+
+
+def unseal_chunk(f, key, document_id, index, output=None, output_offset=0, skip=0, length=None, segment_size=SEGMENT_SIZE):
+    """Decrypt a slice of a chunk sealed as segments
+
+    Only the segments containing the slice are decrypted.
+
+    Args:
+        f (str): path of the encrypted chunk
+        key (str): data key of the document (hex)
+        document_id (str): id of the document
+        index (int): position of the chunk in the document
+        output (str): path of the output file, None to only authenticate the chunk
+        output_offset (int): where to write the slice in output
+        skip (int): bytes of the decrypted chunk to skip
+        length (int): bytes of the decrypted chunk to write, None for all
+        segment_size (int): plaintext bytes of every segment
+    Returns:
+        (int) bytes written
+    """
+    from os.path import getsize
+
+    require()
+    size = getsize(f)
+    segments = -(-size // (segment_size + OVERHEAD))
+    plain = size - segments * OVERHEAD
+    if segments == 0 or plain < 0:
+        raise ValueError("{}: truncated chunk".format(f))
+    end = plain if length is None else min(plain, skip + length)
+    if output is None:
+        skip, end = 0, plain
+    tasks = []
+    for j in range(segments):
+        start = j * segment_size
+        stop = min(start + segment_size, plain)
+        if output is not None and (stop <= skip or start >= end):
+            continue
+        tasks.append((open_segment, (f, key,
+                                     segment_aad(document_id, index, j, j == segments - 1),
+                                     j * (segment_size + OVERHEAD),
+                                     stop - start + OVERHEAD,
+                                     output,
+                                     output_offset + max(0, start - skip),
+                                     max(0, skip - start),
+                                     max(0, min(stop, end) - max(start, skip)))))
+    run(tasks)
+    return max(0, end - skip)
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+
+#    Daemon
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import json
+import socket
+from os import getcwd, umask
+from os import chdir as cd
+from os import remove as rm
+from os.path import abspath, join as path_join
+
+from .color import Color
+
+color = Color()
+
+# Requests and answers are json objects, one per line. A request is
+#
+#     {"command": "backup", "arguments": {...}}
+#
+# and is answered by the output of the command, as {"output": text}
+# lines, followed by {"exit": status, "error": message}.
+
+commands = ("backup", "restore", "list", "info")
+"""Commands served by the daemon"""
+
+
+def socket_path():
+    """Path of the socket of the daemon"""
+    from . import Db
+    return path_join(Db.cache_path, "daemon.sock")
+
+
+def interactive(args):
+    """Whether a command would ask something to the user
+
+    A backup without a backup chat asks to pick one, a restore of a
+    name matching several files asks which one: they run in place,
+    since the daemon can not ask.
+
+    Args:
+        args (Namespace): parsed command line
+    Returns:
+        (bool) True if the command is interactive
+    """
+    from . import Db
+
+    db = Db(readonly=True)
+    if args.command == "backup":
+        return not "backup chat id" in db.config
+    if args.command == "restore":
+        for filename in args.filename:
+            results = [d for k in db.files for d in db.files[k]
+                       if d['name'] == filename or d['path'] == filename]
+            if filename in db.files:
+                results = results + db.files[filename]
+            if len(results) > 1:
+                return True
+    return False
+
+
+def arguments(args):
+    """Arguments of a request from the parsed command line
+
+    Paths are made absolute, since the daemon runs elsewhere; the
+    verbosity of the command is sent along with them. Interactive
+    commands are not sent (see interactive).
+
+    Args:
+        args (Namespace): parsed command line
+    Returns:
+        (dict) the arguments, None if the command can not be sent
+    """
+    from . import parse_range
+
+    verbose = 2 if args.verbose else 0
+    if args.command in ("backup", "restore") and interactive(args):
+        return None
+    if args.command == "backup":
+        if args.youtube:
+            return None
+        return {'filenames': [abspath(f) for f in args.filename],
+                'pack_threshold': args.pack_threshold[0] if args.pack else None,
+                'ignore_duplicate': args.duplicate,
+                'size': str(args.size[0]),
+                'verbose': verbose}
+    if args.command == "restore":
+        if not args.filename and args.prefix[0] is None:
+            return None
+        return {'filenames': args.filename,
+                'prefix': abspath(args.prefix[0]) if args.prefix[0] is not None else None,
+                'concurrency': args.concurrency,
+                'download_directory': abspath(args.download_dir[0]),
+                'cache_size': args.cache_size[0],
+                'byte_range': parse_range(args.range[0]),
+                'verbose': verbose}
+    if args.command == "list":
+        return {'pattern': abspath(args.pattern),
+                'verbose': verbose}
+    if args.command == "info":
+        return {'file': args.filename,
+                'verbose': verbose}
+
+
+def request(command, arguments, output=None):
+    """Run a command in the daemon
+
+    Args:
+        command (str): one of 'commands'
+        arguments (dict): arguments of the command (see 'arguments')
+        output (file): where to write the output, default stdout
+    Returns:
+        (int) exit status of the command, None if no daemon is running
+    """
+    from sys import stdout
+
+    output = output if output is not None else stdout
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path())
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        client.close()
+        return None
+    with client, client.makefile('rw', encoding='utf-8') as stream:
+        stream.write(json.dumps({'command': command, 'arguments': arguments}) + "\n")
+        stream.flush()
+        for line in stream:
+            answer = json.loads(line)
+            if 'output' in answer:
+                output.write(answer['output'])
+                output.flush()
+            elif 'exit' in answer:
+                if answer['error']:
+                    print(color.set(color.RED, answer['error']))
+                return answer['exit']
+    raise ConnectionError("pgpgram daemon closed the connection")
+
+
+class Output:
+    """Write the output of a command to the client"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        if text:
+            self.stream.write(json.dumps({'output': text}) + "\n")
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class NoInput:
+    """Standard input of the commands run by the daemon
+
+    The daemon has no terminal of the client: a command asking
+    something fails instead of waiting forever.
+    """
+
+    def readline(self, *args):
+        raise RuntimeError("the command asked for input: run it again with --no-daemon")
+
+    read = readline
+
+
+class Daemon:
+    """Serve commands over a Unix socket with a resident telegram client
+
+    The client is authenticated once and kept connected between
+    commands, which run one at a time; while idle, its events are
+    still received, so that they do not pile up. The read-only catalog
+    of list and info is opened again when other processes change it.
+
+    Args:
+        verbose (int): integer indicating level of verbose (see Backup);
+        throttle (Throttle): upload and download rate limits of all the commands.
+    """
+
+    def __init__(self, verbose=0, throttle=None):
+        from select import select
+        from . import Db
+        from .td import Td
+
+        self.verbose = verbose
+        self.throttle = throttle
+        current_path = getcwd()
+        self.db = Db(verbose)
+        self.catalog = None
+        self.catalog_version = None
+        self.files_conn = None
+        path = socket_path()
+
+        # A socket nobody listens to is left by a daemon which crashed
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            raise Exception("pgpgram daemon already running")
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            pass
+        finally:
+            probe.close()
+        try:
+            rm(path)
+        except FileNotFoundError as e:
+            pass
+
+        original_umask = umask(0o077)
+        try:
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+        finally:
+            umask(original_umask)
+        server.listen(16)
+
+        cd(self.db.config_path)
+        self.td = Td(tdjson_path=self.db.executable_path, db_key=self.db.config["db key"], verbosity_level=verbose)
+        try:
+            self.td.cycle(self.connected)
+            print(color.set(color.BLUE, "pgpgram daemon listening on {}".format(path)))
+            while True:
+                ready, _, _ = select([server], [], [], 0)
+                if not ready:
+                    # Idle: keep the client going
+                    event = self.td.receive()
+                    if event:
+                        self.td.signin(event)
+                    continue
+                connection, _ = server.accept()
+                with connection, connection.makefile('rw', encoding='utf-8') as stream:
+                    try:
+                        self.serve(stream)
+                    except (BrokenPipeError, ConnectionResetError) as e:
+                        pass
+                    finally:
+                        cd(self.db.config_path)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            try:
+                rm(path)
+            except FileNotFoundError as e:
+                pass
+            self.td.destroy(self.td.client)
+            if self.files_conn is not None:
+                self.files_conn.close()
+            cd(current_path)
+
+    def refresh_catalog(self):
+        """Open the read-only catalog again if it changed since it was opened
+
+        PRAGMA data_version of a connection changes when other
+        connections commit to files.db; a replaced files.db (see
+        catalog-restore), names.db or configuration changes its inode
+        or modification time.
+
+        Returns:
+            (Db) the catalog
+        """
+        import sqlite3
+        from os import stat
+        from . import Db
+
+        version = []
+        for f in (Db.files_db_path, Db.names_db_path, path_join(Db.config_path, "config.pkl")):
+            try:
+                st = stat(f)
+                version.append((st.st_ino, st.st_mtime_ns))
+            except FileNotFoundError as e:
+                version.append(None)
+        if self.catalog_version is None or version[0] != self.catalog_version[0]:
+            if self.files_conn is not None:
+                self.files_conn.close()
+                self.files_conn = None
+            if version[0] is not None:
+                self.files_conn = sqlite3.connect(Db.files_db_path, timeout=60)
+        if self.files_conn is not None:
+            version.append(self.files_conn.execute("PRAGMA data_version").fetchone()[0])
+        if version != self.catalog_version:
+            self.catalog = Db(self.verbose, readonly=True)
+            self.catalog_version = version
+        return self.catalog
+
+    def serve(self, stream):
+        """Run the command read from a connection"""
+        import sys
+        from contextlib import redirect_stdout
+
+        line = stream.readline()
+        if not line:
+            return
+        message = json.loads(line)
+        status, error = 0, None
+        stdin, sys.stdin = sys.stdin, NoInput()
+        with redirect_stdout(Output(stream)):
+            try:
+                self.run(message['command'], message.get('arguments', {}))
+            except Exception as e:
+                status, error = 1, "{}: {}".format(type(e).__name__, e)
+            finally:
+                sys.stdin = stdin
+        stream.write(json.dumps({'exit': status, 'error': error}) + "\n")
+        stream.flush()
+
+    def run(self, command, arguments):
+        """Run a command with the resident client"""
+        from . import backup_files, get_info, list_files, restore_files
+        from .checkpoint import auto_checkpoint
+
+        verbose = max(self.verbose, arguments.get('verbose', 0))
+        if verbose:
+            print("{} {}".format(command, arguments))
+        kwargs = {'verbose': verbose,
+                  'throttle': self.throttle,
+                  'td': self.td}
+        if command == "backup":
+            backup_files(arguments['filenames'],
+                         pack_threshold=arguments.get('pack_threshold'),
+                         ignore_duplicate=arguments.get('ignore_duplicate', False),
+                         size=arguments.get('size', '100'),
+                         **kwargs)
+            auto_checkpoint(verbose=verbose, td=self.td)
+        elif command == "restore":
+            from .cache import parse_size
+            cache_size = arguments.get('cache_size')
+            byte_range = arguments.get('byte_range')
+            restore_files(arguments['filenames'],
+                          prefix=arguments.get('prefix'),
+                          concurrency=arguments.get('concurrency', 8),
+                          download_directory=arguments['download_directory'],
+                          cache_size=parse_size(cache_size) if cache_size is not None else None,
+                          byte_range=tuple(byte_range) if byte_range is not None else None,
+                          **kwargs)
+        elif command == "list":
+            list_files(arguments['pattern'], verbose=verbose, db=self.refresh_catalog())
+        elif command == "info":
+            get_info(arguments.get('file'), db=self.refresh_catalog())
+        else:
+            raise ValueError("unknown command {}".format(command))
+
+    def connected(self, td, event):
+        """Check if td instance is connected to telegram network"""
+        if td.connected:
+            return True
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+
+#    Jobs
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import json
+import sqlite3
+from os import getcwd, getpid, kill
+from os import chdir as cd
+from random import random
+from time import sleep, time
+
+from .color import Color
+
+color = Color()
+
+
+class JobQueue:
+    """Persistent queue of backup and restore jobs
+
+    Jobs are rows of a SQLite database: the queued job with the highest
+    priority (then the oldest) runs first. A failed job is queued again
+    after an exponential backoff, until it fails 'max attempts' times.
+    A running job records the pid of its worker, which beats a heartbeat
+    while the job runs; jobs whose worker died or stopped beating are
+    queued again by the other workers, so that work resumes where it
+    stopped and jobs of live workers are never run twice.
+
+    Args:
+        path (str): path of the queue database
+    """
+
+    backoff = 30
+    """Seconds before the first retry; doubled at every failure"""
+
+    max_backoff = 3600
+
+    heartbeat = 60
+    """Seconds between heartbeats of a running job"""
+
+    stale = 600
+    """Seconds without heartbeats after which a running job is queued again"""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                 id INTEGER PRIMARY KEY,
+                                 kind TEXT NOT NULL,
+                                 target TEXT NOT NULL,
+                                 options TEXT NOT NULL,
+                                 priority INTEGER NOT NULL DEFAULT 0,
+                                 state TEXT NOT NULL DEFAULT 'queued',
+                                 attempts INTEGER NOT NULL DEFAULT 0,
+                                 max_attempts INTEGER NOT NULL DEFAULT 5,
+                                 not_before REAL NOT NULL DEFAULT 0,
+                                 error TEXT,
+                                 created REAL NOT NULL,
+                                 updated REAL NOT NULL,
+                                 worker INTEGER,
+                                 heartbeat REAL)""")
+        columns = {row['name'] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        for column, kind in (('worker', 'INTEGER'), ('heartbeat', 'REAL')):
+            if not column in columns:
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN {} {}".format(column, kind))
+        self.conn.execute("""CREATE INDEX IF NOT EXISTS jobs_next
+                             ON jobs (state, priority DESC, id)""")
+
+    def add(self, kind, target, options=None, priority=0, max_attempts=5):
+        """Queue a job, unless the same job is already waiting
+
+        Args:
+            kind (str): 'backup' or 'restore'
+            target (str): file to backup or name, path or hash of the file to restore
+            options (dict): keyword arguments of Backup or Restore
+            priority (int): jobs with higher priority run first
+            max_attempts (int): times the job is tried before giving up
+        Returns:
+            (int) id of the job
+        """
+        options = json.dumps(options or {}, sort_keys=True)
+        now = time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute("""SELECT id, priority FROM jobs
+                                       WHERE kind = ? AND target = ? AND options = ?
+                                       AND state IN ('queued', 'running')""",
+                                    (kind, target, options)).fetchone()
+            if row:
+                job_id = row['id']
+                if priority > row['priority']:
+                    self.conn.execute("UPDATE jobs SET priority = ?, updated = ? WHERE id = ?",
+                                      (priority, now, job_id))
+            else:
+                job_id = self.conn.execute("""INSERT INTO jobs (kind, target, options, priority,
+                                                                max_attempts, created, updated)
+                                              VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                                           (kind, target, options, priority,
+                                            max_attempts, now, now)).lastrowid
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return job_id
+
+    def claim(self):
+        """Take the next job to run
+
+        Returns:
+            (dict) the job, or None if no job is ready
+        """
+        now = time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute("""SELECT * FROM jobs
+                                       WHERE state = 'queued' AND not_before <= ?
+                                       ORDER BY priority DESC, id LIMIT 1""", (now,)).fetchone()
+            if row:
+                self.conn.execute("""UPDATE jobs SET state = 'running', worker = ?, heartbeat = ?,
+                                     updated = ? WHERE id = ?""",
+                                  (getpid(), now, now, row['id']))
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        job = dict(row)
+        job['options'] = json.loads(job['options'])
+        return job
+
+    def done(self, job_id):
+        """Mark a job as completed"""
+        self.conn.execute("UPDATE jobs SET state = 'done', error = NULL, updated = ? WHERE id = ?",
+                          (time(), job_id))
+
+    def fail(self, job_id, error, retry=True):
+        """Record a failure, queueing the job again after a backoff
+
+        Args:
+            job_id (int): id of the job
+            error (str): what went wrong
+            retry (bool): False if trying again would not help
+        """
+        now = time()
+        row = self.conn.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ?",
+                                (job_id,)).fetchone()
+        attempts = row['attempts'] + 1
+        if retry and attempts < row['max_attempts']:
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+            delay = delay * (0.5 + random())
+            self.conn.execute("""UPDATE jobs SET state = 'queued', attempts = ?, error = ?,
+                                 not_before = ?, updated = ? WHERE id = ?""",
+                              (attempts, error, now + delay, now, job_id))
+        else:
+            self.conn.execute("""UPDATE jobs SET state = 'failed', attempts = ?, error = ?,
+                                 updated = ? WHERE id = ?""",
+                              (attempts, error, now, job_id))
+
+    def beat(self, job_id):
+        """Record that the worker of a running job is alive"""
+        self.conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND state = 'running' AND worker = ?",
+                          (time(), job_id, getpid()))
+
+    def recover(self):
+        """Queue again jobs left running by a worker which died
+
+        A job is recovered if its worker is not running anymore or
+        did not beat for 'stale' seconds.
+
+        Returns:
+            (int) number of jobs recovered
+        """
+        now = time()
+        recovered = 0
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for row in self.conn.execute("SELECT id, worker, heartbeat FROM jobs WHERE state = 'running'").fetchall():
+                if alive(row['worker']) and (row['heartbeat'] or 0) >= now - self.stale:
+                    continue
+                self.conn.execute("""UPDATE jobs SET state = 'queued', worker = NULL, heartbeat = NULL,
+                                     updated = ? WHERE id = ?""", (now, row['id']))
+                recovered += 1
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return recovered
+
+    def next_time(self):
+        """When the next queued job will be ready, None if there are none"""
+        row = self.conn.execute("SELECT MIN(not_before) FROM jobs WHERE state = 'queued'").fetchone()
+        return row[0]
+
+    def counts(self):
+        """Number of jobs by state"""
+        return {row['state']: row['n'] for row in
+                self.conn.execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state")}
+
+    def jobs(self, states=('queued', 'running', 'failed')):
+        """Jobs in the given states, in the order they will run"""
+        marks = ", ".join("?" for _ in states)
+        return [dict(row) for row in
+                self.conn.execute("""SELECT * FROM jobs WHERE state IN ({})
+                                     ORDER BY state, priority DESC, id""".format(marks), states)]
+
+
+def alive(pid):
+    """Whether a process is running"""
+    if not pid:
+        return False
+    try:
+        kill(pid, 0)
+    except ProcessLookupError as e:
+        return False
+    except PermissionError as e:
+        pass
+    return True
+
+
+def heartbeat(path, job_id, stop):
+    """Beat the heartbeat of a running job until stop is set
+
+    Args:
+        path (str): path of the queue database
+        job_id (int): id of the job
+        stop (Event): set when the job is over
+    """
+    queue = JobQueue(path)
+    try:
+        while not stop.wait(queue.heartbeat):
+            queue.beat(job_id)
+    finally:
+        queue.conn.close()
+
+
+def run_job(job, td, verbose=0, **kwargs):
+    """Run a job over a shared telegram client
+
+    Args:
+        job (dict): job as returned by JobQueue.claim
+        td (Td): connected telegram client
+        verbose (int): verbose level
+        kwargs: further arguments of Backup and Restore (metrics, throttle, ...)
+    """
+    from . import Backup, Restore
+
+    options = dict(job['options'], **kwargs)
+    if job['kind'] == 'backup':
+        Backup(job['target'], verbose=verbose, td=td, **options)
+    elif job['kind'] == 'restore':
+        if 'byte_range' in options and options['byte_range'] is not None:
+            options['byte_range'] = tuple(options['byte_range'])
+        restore = Restore(job['target'], verbose=verbose, td=td, **options)
+        if restore.document is None:
+            raise FileNotFoundError(job['target'])
+    else:
+        raise ValueError("unknown job kind {}".format(job['kind']))
+
+
+def work(queue, verbose=0, forever=False, poll=5, **kwargs):
+    """Drain the queue over a single telegram session
+
+    Args:
+        queue (JobQueue): the queue
+        verbose (int): verbose level
+        forever (bool): keep waiting for new jobs when the queue is empty
+        poll (float): seconds between checks of an empty queue
+        kwargs: further arguments of Backup and Restore (metrics, throttle, ...)
+    Returns:
+        (tuple) number of jobs done and failed
+    """
+    from threading import Event, Thread
+    from . import Db
+    from .td import Td
+
+    def recover():
+        recovered = queue.recover()
+        if recovered and verbose:
+            print("{} interrupted jobs queued again".format(recovered))
+
+    recover()
+
+    current_path = getcwd()
+    db = Db(verbose)
+    cd(db.config_path)
+    td = None
+    done, failed = 0, 0
+    try:
+        while True:
+            job = queue.claim()
+            if job is None:
+                next_time = queue.next_time()
+                if next_time is None and not forever:
+                    break
+                sleep(poll if next_time is None else min(poll, max(0, next_time - time())) or 0.1)
+                # Jobs of workers which died meanwhile
+                recover()
+                continue
+
+            print(color.set(color.BLUE, "{} {}".format(job['kind'], job['target'])))
+            if td is None:
+                td = Td(tdjson_path=db.executable_path, db_key=db.config["db key"], verbosity_level=verbose,
+                        metrics=kwargs.get('metrics'), profiler=kwargs.get('profiler'))
+            stop = Event()
+            beating = Thread(target=heartbeat, args=(queue.path, job['id'], stop), daemon=True)
+            beating.start()
+            try:
+                run_job(job, td, verbose=verbose, **kwargs)
+                queue.done(job['id'])
+                done += 1
+            except FileNotFoundError as e:
+                queue.fail(job['id'], "{}: not found".format(e), retry=False)
+                failed += 1
+            except Exception as e:
+                print(color.set(color.RED, "{} {}: {}".format(job['kind'], job['target'], e)))
+                queue.fail(job['id'], repr(e))
+                failed += 1
+            finally:
+                stop.set()
+                beating.join()
+                cd(db.config_path)
+    finally:
+        if td is not None:
+            td.destroy(td.client)
+        cd(current_path)
+    return done, failed
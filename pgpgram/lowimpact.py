@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+#    Low impact
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from os import environ, getpid
+
+from .color import Color
+
+color = Color()
+
+try:
+    from os import POSIX_FADV_DONTNEED, POSIX_FADV_SEQUENTIAL, fdatasync, posix_fadvise
+except ImportError as e:
+    posix_fadvise = None
+
+# In low impact mode files backed up and restored are read and written
+# with sequential read-ahead, and their pages are dropped from the page
+# cache behind the cursor, so that a big backup does not evict the
+# working set of the other programs of the host. The mode is kept in
+# the environment, so that it reaches the crypto pool processes and
+# the daemon commands.
+
+environment = "PGPGRAM_LOW_IMPACT"
+
+window = 16777216
+"""Bytes read or written before dropping them from the page cache"""
+
+ionice_classes = {'idle': ['-c', '3'],
+                  'best-effort': ['-c', '2', '-n', '7']}
+"""ionice arguments of the I/O scheduling classes"""
+
+
+def enable():
+    """Turn on low impact I/O for this process and its children"""
+    environ[environment] = "1"
+
+
+def enabled():
+    return posix_fadvise is not None and environ.get(environment) == "1"
+
+
+def sequential(fd, offset=0, length=0):
+    """Announce that a range of a file descriptor is going to be read in order
+
+    Args:
+        fd (int): the file descriptor
+        offset (int): start of the range
+        length (int): size of the range, 0 up to the end of the file
+    """
+    if enabled():
+        posix_fadvise(fd, offset, length, POSIX_FADV_SEQUENTIAL)
+
+
+def release(fd, offset=0, length=0, written=False):
+    """Drop a range of a file descriptor from the page cache
+
+    Args:
+        fd (int): the file descriptor
+        offset (int): start of the range
+        length (int): size of the range, 0 up to the end of the file
+        written (bool): whether the range was written, so that it has
+                        to reach the disk before its pages can be dropped
+    """
+    if enabled():
+        if written:
+            fdatasync(fd)
+        posix_fadvise(fd, offset, length, POSIX_FADV_DONTNEED)
+
+
+def release_path(path, offset=0, length=0, written=False):
+    """Drop a range of a file from the page cache (see release)"""
+    if enabled():
+        from os import O_RDONLY, close, open as os_open
+
+        fd = os_open(path, O_RDONLY)
+        try:
+            release(fd, offset, length, written=written)
+        finally:
+            close(fd)
+
+
+def blocks(file, length=None, block_size=1048576):
+    """Read an opened file from its position in blocks
+
+    In low impact mode read blocks are dropped from the page cache
+    a window at a time.
+
+    Args:
+        file (file): the file, opened in binary mode
+        length (int): bytes to read, None up to the end of the file
+        block_size (int): size of the blocks
+    Returns:
+        (iterator) the blocks
+    """
+    fd = file.fileno()
+    start = released = position = file.tell()
+    end = None if length is None else start + length
+    sequential(fd, start, length or 0)
+    try:
+        while end is None or position < end:
+            data = file.read(block_size if end is None else min(block_size, end - position))
+            if not data:
+                break
+            position += len(data)
+            if position - released >= window:
+                release(fd, released, position - released)
+                released = position
+            yield data
+    finally:
+        release(fd, released, position - released)
+
+
+def command(arguments):
+    """Run an external command through nocache in low impact mode, if installed"""
+    if enabled():
+        from shutil import which
+
+        if which('nocache'):
+            return ['nocache'] + arguments
+    return arguments
+
+
+def renice(nice=None, ionice=None):
+    """Lower the CPU and I/O priority of this process and of what it starts
+
+    Args:
+        nice (int): niceness, from -20 to 19
+        ionice (str): I/O scheduling class, one of ionice_classes
+    """
+    if nice is not None:
+        from os import PRIO_PROCESS, setpriority
+
+        try:
+            setpriority(PRIO_PROCESS, 0, nice)
+        except OSError as e:
+            # Only root can raise the priority
+            print(color.set(color.RED, "can not set the CPU priority: {}".format(e)))
+    if ionice is not None:
+        from subprocess import run, CalledProcessError, DEVNULL
+
+        try:
+            run(['ionice'] + ionice_classes[ionice] + ['-p', str(getpid())],
+                stdout=DEVNULL, check=True)
+        except (FileNotFoundError, CalledProcessError) as e:
+            print(color.set(color.RED, "can not set the I/O priority: {}".format(e)))
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+#    Metrics
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from contextlib import contextmanager
+from os import rename
+from time import perf_counter, time
+
+
+class Metrics:
+    """Wall time, bytes and throughput of backup and restore stages
+
+    Stages (hash, encrypt, upload, download, decrypt, ...) are timed
+    through the 'stage' context manager, both as totals and for every
+    chunk; tdlib events are counted by type by Td.cycle.
+
+    Args:
+        command (str): name of the command being measured
+    """
+
+    def __init__(self, command=""):
+        self.command = command
+        self.started = time()
+        self.finished = None
+        self.stages = {}
+        self.chunks = []
+        self.events = {}
+        self.files = 0
+        self.failures = 0
+
+    @contextmanager
+    def stage(self, name, size=0, chunk=None, document=None):
+        """Time a stage of the pipeline
+
+        Args:
+            name (str): name of the stage
+            size (int): bytes processed by the stage
+            chunk (int): index of the chunk processed, if any
+            document (str): id of the document processed, if any
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - start, size, chunk=chunk, document=document)
+
+    def add(self, name, seconds, size=0, chunk=None, document=None):
+        """Record a measure of a stage
+
+        Args:
+            name (str): name of the stage
+            seconds (float): wall time spent
+            size (int): bytes processed
+            chunk (int): index of the chunk processed, if any
+            document (str): id of the document processed, if any
+        """
+        stage = self.stages.setdefault(name, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+        stage['count'] += 1
+        stage['seconds'] += seconds
+        stage['bytes'] += size
+        if chunk is not None:
+            self.chunks.append({'stage': name,
+                                'document': document,
+                                'chunk': chunk,
+                                'seconds': seconds,
+                                'bytes': size,
+                                'MB/s': throughput(size, seconds)})
+
+    def count(self, event_type):
+        """Count a tdlib event
+
+        Args:
+            event_type (str): '@type' of the event
+        """
+        self.events[event_type] = self.events.get(event_type, 0) + 1
+
+    def report(self):
+        """Run report
+
+        Returns:
+            (dict) json serializable report
+        """
+        finished = self.finished or time()
+        stages = {}
+        for name, stage in self.stages.items():
+            stages[name] = dict(stage, **{'MB/s': throughput(stage['bytes'], stage['seconds'])})
+        return {'command': self.command,
+                'started': self.started,
+                'finished': finished,
+                'seconds': finished - self.started,
+                'files': self.files,
+                'failures': self.failures,
+                'stages': stages,
+                'chunks': self.chunks,
+                'events': dict(self.events)}
+
+    def save_json(self, path):
+        """Write the run report as json"""
+        from json import dump
+
+        with open(path + ".tmp", 'w') as f:
+            dump(self.report(), f, indent=2)
+        rename(path + ".tmp", path)
+
+    def save_prometheus(self, path):
+        """Write the run report for the node exporter textfile collector
+
+        The file is written aside and then renamed, so that the collector
+        never reads it half written.
+        """
+        report = self.report()
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append("# HELP pgpgram_{} {}".format(name, description))
+            lines.append("# TYPE pgpgram_{} {}".format(name, kind))
+            for labels, value in samples:
+                labels = ",".join('{}="{}"'.format(k, escape(v)) for k, v in
+                                  [('command', self.command)] + labels)
+                lines.append("pgpgram_{}{{{}}} {}".format(name, labels, value))
+
+        stages = sorted(report['stages'].items())
+        metric("run_seconds", "gauge", "Wall time of the last run.",
+               [([], report['seconds'])])
+        metric("run_finished_timestamp_seconds", "gauge", "End of the last run.",
+               [([], report['finished'])])
+        metric("run_files", "gauge", "Files processed by the last run.",
+               [([], report['files'])])
+        metric("run_failures", "gauge", "Files failed in the last run.",
+               [([], report['failures'])])
+        metric("stage_seconds", "gauge", "Wall time spent in each stage.",
+               [([('stage', k)], v['seconds']) for k, v in stages])
+        metric("stage_bytes", "gauge", "Bytes processed by each stage.",
+               [([('stage', k)], v['bytes']) for k, v in stages])
+        metric("stage_runs", "gauge", "Times each stage ran.",
+               [([('stage', k)], v['count']) for k, v in stages])
+        metric("stage_throughput_bytes_per_second", "gauge", "Throughput of each stage.",
+               [([('stage', k)], v['bytes'] / v['seconds'] if v['seconds'] else 0) for k, v in stages])
+        metric("td_events", "gauge", "tdlib events received by type.",
+               [([('type', k)], v) for k, v in sorted(report['events'].items())])
+
+        with open(path + ".tmp", 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        rename(path + ".tmp", path)
+
+
+def throughput(size, seconds):
+    """MB/s of a measure"""
+    return size / seconds / 1000000 if seconds else 0
+
+
+def escape(value):
+    """Escape a prometheus label value"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+#    Profiler
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from sys import _current_frames
+from threading import Event, Thread, get_ident
+from time import perf_counter
+
+
+class Profiler:
+    """Low overhead timing of the Td event loop
+
+    Td.cycle times through 'call' tdlib receive, json decoding, signin
+    and every handler it runs, so that the cost of a run can be
+    attributed to each handler and to each event type.
+
+    Optionally the whole run can be profiled with cProfile and sampled
+    into a flamegraph compatible (folded) stacks file.
+
+    Args:
+        cprofile (bool): profile the run with cProfile;
+        sample_interval (float): seconds between stack samples;
+                                 None to not sample stacks.
+    """
+
+    def __init__(self, cprofile=False, sample_interval=None):
+        self.handlers = {}
+        self.events = {}
+        self.stacks = {}
+        self.cprofile = None
+        self.sample_interval = sample_interval
+        self.sampler = None
+        self.stopped = Event()
+        self.thread_id = get_ident()
+        if cprofile:
+            from cProfile import Profile
+            self.cprofile = Profile()
+
+    def start(self):
+        """Start cProfile and stack sampling, if requested"""
+        if self.cprofile is not None:
+            self.cprofile.enable()
+        if self.sample_interval:
+            self.sampler = Thread(target=self.sample, daemon=True)
+            self.sampler.start()
+
+    def stop(self):
+        """Stop cProfile and stack sampling"""
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+
+    def call(self, name, function, *args, event_type=None):
+        """Call a function timing it
+
+        Args:
+            name (str): name under which the call is accounted
+            function (fun): function to call with args
+            event_type (str): '@type' of the event the function handles
+        Returns:
+            what function returns
+        """
+        start = perf_counter()
+        try:
+            return function(*args)
+        finally:
+            elapsed = perf_counter() - start
+            self.add(self.handlers, name, elapsed)
+            if event_type is not None:
+                self.add(self.events, event_type, elapsed)
+
+    def add(self, table, name, elapsed):
+        row = table.get(name)
+        if row is None:
+            table[name] = [1, elapsed, elapsed]
+        else:
+            row[0] += 1
+            row[1] += elapsed
+            if elapsed > row[2]:
+                row[2] = elapsed
+
+    def sample(self):
+        """Sample the stack of the profiled thread until stopped"""
+        while not self.stopped.wait(self.sample_interval):
+            frame = _current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{}:{}".format(code.co_filename.split("/")[-1], code.co_name))
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def table(self, metrics=None):
+        """Cost table of handlers, event types and, if given, pipeline stages
+
+        Args:
+            metrics (Metrics): metrics of the run
+        Returns:
+            (str) the table
+        """
+        lines = []
+
+        def section(title, table):
+            total = sum(row[1] for row in table.values()) or 1
+            lines.append("{:<40} {:>9} {:>11} {:>10} {:>10} {:>6}".format(
+                title, "calls", "total (s)", "mean (ms)", "max (ms)", "%"))
+            for name, (calls, elapsed, longest) in sorted(table.items(), key=lambda t: -t[1][1]):
+                lines.append("{:<40} {:>9} {:>11.3f} {:>10.3f} {:>10} {:>6.1f}".format(
+                    name[:40], calls, elapsed, elapsed / calls * 1000,
+                    "{:.3f}".format(longest * 1000) if longest is not None else "-",
+                    elapsed / total * 100))
+            lines.append("")
+
+        section("handler", self.handlers)
+        section("event type", self.events)
+        if metrics is not None:
+            section("stage", {name: [stage['count'], stage['seconds'], None]
+                              for name, stage in metrics.stages.items()})
+        return "\n".join(lines)
+
+    def dump(self, prefix):
+        """Write cProfile stats in prefix.pstats and sampled stacks in prefix.folded"""
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(prefix + ".pstats")
+        if self.stacks:
+            with open(prefix + ".folded", 'w') as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write("{} {}\n".format(stack, count))
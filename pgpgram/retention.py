@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+#    Retention
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from datetime import datetime, timedelta
+from os import getcwd
+from os import chdir as cd
+
+from .color import Color
+from .scheduler import retry_after, scheduler
+
+color = Color()
+
+
+def expired(documents, keep=None, older_than=None, now=None):
+    """Documents falling out of a retention policy
+
+    Versions of a path are ranked from the most recent backup; a version
+    expires if it is not among the last 'keep' ones or if it was backed
+    up more than 'older than' days ago. The most recent version of a
+    path never expires because of its age.
+
+    Args:
+        documents (iterable): documents of the catalog
+        keep (int): versions of every path to keep, None for all
+        older_than (float): days after which a version expires, None for never
+        now (datetime): reference time, default now
+    Returns:
+        (list) expired documents
+    Raises:
+        ValueError: if keep is less than 1
+    """
+    if keep is not None and keep < 1:
+        raise ValueError("at least one version of every path has to be kept, not {}".format(keep))
+    versions = {}
+    for d in documents:
+        versions.setdefault(d['path'], []).append(d)
+    limit = (now or datetime.now()) - timedelta(days=older_than) if older_than is not None else None
+    result = []
+    for path, documents in versions.items():
+        documents.sort(key=lambda d: d['date backed up'], reverse=True)
+        for rank, d in enumerate(documents):
+            if keep is not None and rank >= keep:
+                result.append(d)
+            elif limit is not None and rank > 0 and d['date backed up'] < limit:
+                result.append(d)
+    return result
+
+
+class Deletion:
+    """Delete documents from the catalog and their messages from telegram
+
+    Messages are reference counted over the whole catalog, so that the
+    ones shared with documents still in use (packs, or duplicates backed
+    up with ignore_duplicate) are kept. Catalog rows are removed first,
+    recording the messages to delete in the configuration (see
+    Db.update_config): messages whose deletion fails are deleted by the
+    next run.
+
+    Args:
+        documents (list): documents to delete;
+        dry_run (bool): only show what would be deleted;
+        batch (int): messages deleted by every deleteMessages;
+        verbose (int): integer indicating level of verbose (see Backup);
+        metrics (Metrics): where to record timings of the stages;
+        profiler (Profiler): where to time the telegram client event loop;
+        td (Td): connected telegram client to use instead of creating one.
+    """
+
+    def __init__(self, documents, dry_run=False, batch=100, verbose=0, metrics=None, profiler=None, td=None):
+        from . import Db
+        from .metrics import Metrics
+        from .td import Td
+
+        self.metrics = metrics if metrics is not None else Metrics("delete")
+        self.verbose = verbose
+        current_path = getcwd()
+        db = Db(verbose)
+
+        # Reference counts of messages
+        removed = {d['id'] for d in documents}
+        references = {}
+        for stored in db.files.values():
+            for d in stored:
+                if not d['id'] in removed:
+                    for message_id in d['messages id']:
+                        key = (d['chat id'], message_id)
+                        references[key] = references.get(key, 0) + 1
+        unreferenced = set()
+        for d in documents:
+            for message_id in d['messages id']:
+                if not (d['chat id'], message_id) in references:
+                    unreferenced.add((d['chat id'], message_id))
+
+        for d in sorted(documents, key=lambda d: (d['path'], d['date backed up'])):
+            print("{} {}".format(d['date backed up'].strftime("%Y-%m-%d %H:%M"), d['path']))
+        print(color.set(color.BLUE, "{} documents, {} messages to delete".format(len(documents), len(unreferenced))))
+        if dry_run:
+            return
+
+        for d in documents:
+            db.remove_document(d)
+        db.save()
+        pending = {tuple(m) for m in db.update_config('pending deletions', lambda saved: sorted(
+                   {tuple(m) for m in saved or []} | unreferenced))}
+        self.metrics.files += len(documents)
+
+        # Delete messages
+        chats = {}
+        for chat_id, message_id in pending:
+            chats.setdefault(chat_id, []).append(message_id)
+        self.batches = [(chat_id, messages_id[i:i + batch])
+                        for chat_id, messages_id in chats.items()
+                        for i in range(0, len(messages_id), batch)]
+        self.requested = {}
+        self.deleted = set()
+        self.sent = 0
+        self.window = scheduler.window('messages', 4)
+
+        shared = td is not None
+        try:
+            if self.batches:
+                if not shared:
+                    cd(db.config_path)
+                    td = Td(tdjson_path=db.executable_path, db_key=db.config["db key"], verbosity_level=verbose, metrics=self.metrics, profiler=profiler)
+                with self.metrics.stage('connect'):
+                    if not td.connected:
+                        td.cycle(self.connected)
+                with self.metrics.stage('delete messages'):
+                    self.top_up(td)
+                    td.cycle(self.answered, tick=True)
+        finally:
+            # Other runs may have added messages meanwhile
+            db.update_config('pending deletions', lambda saved: sorted(
+                {tuple(m) for m in saved or []} - self.deleted))
+            if td is not None and not shared:
+                td.destroy(td.client)
+            cd(current_path)
+
+        failed = len(pending) - len(self.deleted)
+        self.metrics.failures += failed
+        print(color.set(color.BLUE, "{} messages deleted".format(len(self.deleted))) +
+              (color.set(color.RED, ", {} to retry".format(failed)) if failed else ""))
+
+    def top_up(self, td):
+        """Send deleteMessages requests while there is room in the window"""
+        while self.batches and self.window.room(len(self.requested)):
+            chat_id, messages_id = self.batches.pop()
+            extra = "delete {}".format(self.sent)
+            self.sent += 1
+            self.requested[extra] = (chat_id, messages_id)
+            td.send({'@type': 'deleteMessages',
+                     'chat_id': chat_id,
+                     'message_ids': messages_id,
+                     'revoke': True,
+                     '@extra': extra})
+
+    def answered(self, td, event):
+        """Collect deleteMessages answers; finishes when all are back"""
+        extra = event.get('@extra')
+        if extra in self.requested:
+            chat_id, messages_id = self.requested.pop(extra)
+            if event['@type'] == 'ok':
+                self.window.success()
+                self.deleted.update((chat_id, message_id) for message_id in messages_id)
+            elif retry_after(event) is not None:
+                # Rate limited: send it again after the pause
+                self.window.failure(retry_after(event))
+                self.batches.append((chat_id, messages_id))
+            else:
+                self.window.failure()
+                print(color.set(color.RED, "deleteMessages: {}".format(event.get('message'))))
+        self.top_up(td)
+        return not (self.batches or self.requested)
+
+    def connected(self, td, event):
+        """Check if td instance is connected to telegram network"""
+        if td.connected:
+            return True
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+#    Scheduler
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import re
+from time import monotonic
+
+retry_pattern = re.compile(r"retry after (\d+)", re.IGNORECASE)
+flood_pattern = re.compile(r"FLOOD_WAIT_(\d+)")
+
+
+def retry_after(event):
+    """Seconds to wait asked by a rate limit error
+
+    Args:
+        event (dict): an 'error' answer or an updateMessageSendFailed
+    Returns:
+        (int) the seconds, None if the event is not a rate limit error
+    """
+    if event.get('retry_after'):
+        return event['retry_after']
+    message = event.get('message') or event.get('error_message') or ''
+    match = retry_pattern.search(message) or flood_pattern.search(message)
+    if match:
+        return int(match.group(1))
+    if event.get('code', event.get('error_code')) == 429:
+        return 1
+
+
+class Window:
+    """Number of requests of a class which can be in flight
+
+    The window grows by one request for every window of successful
+    requests and is halved on failures (additive increase,
+    multiplicative decrease), so that it settles on the most the
+    server takes; a rate limit error also pauses the whole class for
+    the time asked by the server.
+
+    Args:
+        maximum (int): biggest window;
+        initial (float): starting window, default half the maximum;
+        minimum (int): smallest window.
+    """
+
+    def __init__(self, maximum, initial=None, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.size = float(initial if initial is not None else max(minimum, maximum / 2))
+        self.paused_until = 0
+
+    def paused(self):
+        """Seconds left of the pause, 0 if not paused"""
+        return max(0, self.paused_until - monotonic())
+
+    def room(self, in_flight):
+        """Requests which can be sent with 'in flight' ones running"""
+        if self.paused():
+            return 0
+        return max(0, int(self.size) - in_flight)
+
+    def success(self):
+        self.size = min(self.maximum, self.size + 1 / self.size)
+
+    def failure(self, retry=None):
+        """Shrink the window after a failed request
+
+        Args:
+            retry (float): seconds asked by the server before retrying
+        """
+        self.size = max(self.minimum, self.size / 2)
+        if retry is not None:
+            self.paused_until = max(self.paused_until, monotonic() + retry)
+
+
+class Scheduler:
+    """Windows of the request classes of a process
+
+    They are kept for the whole process, so that commands sharing a
+    telegram client (queue, watch, daemon) start from what the previous
+    ones learned.
+    """
+
+    def __init__(self):
+        self.windows = {}
+
+    def window(self, name, maximum):
+        """Window of a request class, for the caller sending its requests
+
+        Args:
+            name (str): the class, like 'upload' or 'download'
+            maximum (int): biggest window, the most the caller can handle
+        """
+        if not name in self.windows:
+            self.windows[name] = Window(maximum)
+        window = self.windows[name]
+        window.maximum = maximum
+        window.size = min(window.size, maximum)
+        return window
+
+    def failure(self, name, retry=None):
+        """Report a failed request of a class without resizing its maximum
+
+        For requests sent outside of a window, like single downloads; a
+        class nobody sent requests of yet starts from a window of one.
+
+        Args:
+            name (str): the class, like 'upload' or 'download'
+            retry (float): seconds asked by the server before retrying
+        """
+        if not name in self.windows:
+            self.windows[name] = Window(1)
+        self.windows[name].failure(retry)
+
+
+scheduler = Scheduler()
+"""Windows of this process"""
+
+
+class Download:
+    """A file download waited for in the event loop
+
+    Rate limit errors pause the 'download' class (see retry_after) and
+    the file is asked again when the pause is over; other errors, and
+    downloads making no progress for 'timeout' seconds, are tried again
+    up to 'attempts' times.
+
+    Args:
+        file_id (int): id of the file;
+        timeout (float): seconds without progress before giving up an attempt;
+        attempts (int): downloads to try before raising.
+    """
+
+    def __init__(self, file_id, timeout=120, attempts=3):
+        self.file_id = file_id
+        self.timeout = timeout
+        self.attempts = attempts
+        self.extra = "download {}".format(file_id)
+
+    def run(self, td):
+        """Download the file
+
+        Args:
+            td (Td): connected telegram client
+        Returns:
+            (str) local path of the downloaded file
+        Raises:
+            Exception: if every attempt failed
+        """
+        self.path = None
+        self.attempt = 0
+        self.start(td)
+        td.cycle(self.handle, tick=True)
+        return self.path
+
+    def start(self, td):
+        self.attempt += 1
+        self.resend_at = None
+        self.deadline = monotonic() + self.timeout
+        self.downloaded_size = None
+        td.downloadFile(self.file_id, extra=self.extra)
+
+    def handle(self, td, event):
+        now = monotonic()
+        if self.resend_at is not None:
+            if now >= self.resend_at:
+                self.resend_at = None
+                self.deadline = now + self.timeout
+                td.downloadFile(self.file_id, extra=self.extra)
+            return
+        if event['@type'] == 'error' and event.get('@extra') == self.extra:
+            retry = retry_after(event)
+            if retry is not None:
+                scheduler.failure('download', retry)
+                self.resend_at = now + retry
+            else:
+                self.failed(td, event.get('message'))
+            return
+        file = event['file'] if event['@type'] == 'updateFile' else event if event['@type'] == 'file' else None
+        if file and file['id'] == self.file_id:
+            local = file['local']
+            if local['is_downloading_completed'] and local['path']:
+                self.path = local['path']
+                return True
+            if local.get('downloaded_size') != self.downloaded_size:
+                self.downloaded_size = local.get('downloaded_size')
+                self.deadline = now + self.timeout
+        if now >= self.deadline:
+            td.send({'@type': 'cancelDownloadFile',
+                     'file_id': self.file_id,
+                     'only_if_pending': False})
+            self.failed(td, "no progress in {}s".format(self.timeout))
+
+    def failed(self, td, reason):
+        """Try the download again, raise after the last attempt"""
+        if self.attempt >= self.attempts:
+            raise Exception("downloadFile {}: {}".format(self.file_id, reason))
+        self.start(td)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+#    Sparse
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from errno import EINVAL, ENXIO
+from os import O_RDONLY, O_WRONLY, close, fstat, lseek, pread, pwrite
+from os import open as os_open
+
+from .lowimpact import release, sequential
+
+# Files with holes are backed up as the concatenation of their data
+# extents, the 'data stream'; the document keeps the extents as
+# [offset, length] pairs, so that chunks are slices of the data stream
+# and restored files get their holes back.
+
+ZERO_BLOCK = 1048576
+"""Aligned all zero blocks of this size in a sparse file are treated as holes"""
+
+
+def data_extents(path, zero_block=ZERO_BLOCK):
+    """Data extents of a file with holes
+
+    Extents are found with SEEK_DATA and SEEK_HOLE; in files having
+    holes, allocated blocks of zeros are dropped from the extents too,
+    so that preallocated regions of disk images are not uploaded.
+
+    Args:
+        path (str): path of the file
+        zero_block (int): size of the zero blocks to drop, 0 to keep them
+    Returns:
+        (list) [offset, length] of the extents, None if the file has no
+        holes or the filesystem can not tell
+    """
+    try:
+        from os import SEEK_DATA, SEEK_HOLE
+    except ImportError as e:
+        return None
+
+    fd = os_open(path, O_RDONLY)
+    try:
+        size = fstat(fd).st_size
+        extents = []
+        offset = 0
+        while offset < size:
+            try:
+                start = lseek(fd, offset, SEEK_DATA)
+            except OSError as e:
+                if e.errno == ENXIO:
+                    # Only a hole is left
+                    break
+                if e.errno == EINVAL:
+                    return None
+                raise
+            end = min(size, lseek(fd, start, SEEK_HOLE))
+            extents.append([start, end - start])
+            offset = end
+        if sum(length for _, length in extents) == size:
+            return None
+        if zero_block:
+            extents = drop_zeros(fd, extents, zero_block)
+        return extents
+    finally:
+        close(fd)
+
+
+def drop_zeros(fd, extents, block_size):
+    """Remove the aligned all zero blocks from extents"""
+    zeros = bytes(block_size)
+    result = []
+
+    def add(start, end):
+        if result and result[-1][0] + result[-1][1] == start:
+            result[-1][1] += end - start
+        elif end > start:
+            result.append([start, end - start])
+
+    for offset, length in extents:
+        position = offset
+        end = offset + length
+        while position < end:
+            stop = min(end, (position // block_size + 1) * block_size)
+            if stop - position == block_size and pread(fd, block_size, position) == zeros:
+                pass
+            else:
+                add(position, stop)
+            position = stop
+    return result
+
+
+def data_size(extents):
+    """Size of the data stream"""
+    return sum(length for _, length in extents)
+
+
+def to_data(extents, position):
+    """Position in the data stream of the first data byte from a file position"""
+    data = 0
+    for offset, length in extents:
+        if position <= offset:
+            return data
+        if position < offset + length:
+            return data + position - offset
+        data += length
+    return data
+
+
+def slices(extents, start, end):
+    """Parts of the data stream between start and end
+
+    Returns:
+        (iterator) file offset, data stream offset and length of the parts
+    """
+    data = 0
+    for offset, length in extents:
+        if data >= end:
+            break
+        first = max(start, data)
+        last = min(end, data + length)
+        if first < last:
+            yield offset + first - data, first, last - first
+        data += length
+
+
+def gather(path, extents, start, length, output, block_size=1048576):
+    """Write a slice of the data stream of a file
+
+    Args:
+        path (str): path of the file
+        extents (list): data extents of the file
+        start (int): position of the slice in the data stream
+        length (int): size of the slice
+        output (str): path of the file to write
+    """
+    source = os_open(path, O_RDONLY)
+    try:
+        with open(output, 'wb') as out:
+            for offset, _, size in slices(extents, start, start + length):
+                sequential(source, offset, size)
+                while size > 0:
+                    data = pread(source, min(block_size, size), offset)
+                    if not data:
+                        break
+                    out.write(data)
+                    release(source, offset, len(data))
+                    offset += len(data)
+                    size -= len(data)
+    finally:
+        close(source)
+
+
+def scatter(source, extents, start, end, output, origin=0, block_size=1048576):
+    """Write a slice of a data stream at its place in a file
+
+    Args:
+        source (str): path of a file holding the data stream from 'start'
+        extents (list): data extents of the restored file
+        start (int): position of the slice in the data stream
+        end (int): position after the slice in the data stream
+        output (str): path of the restored file, holes are left untouched
+        origin (int): position of the restored file where output begins
+    """
+    data = os_open(source, O_RDONLY)
+    out = os_open(output, O_WRONLY)
+    try:
+        for offset, position, size in slices(extents, start, end):
+            position -= start
+            offset -= origin
+            written = offset
+            while size > 0:
+                block = pread(data, min(block_size, size), position)
+                if not block:
+                    break
+                pwrite(out, block, offset)
+                position += len(block)
+                offset += len(block)
+                size -= len(block)
+            release(out, written, offset - written, written=True)
+    finally:
+        close(data)
+        close(out)
@@ -34,6 +34,51 @@ from .color import Color
 
 color = Color()
 
+tdjson = None
+"""libtdjson binding, loaded once by the first Td instance"""
+
+
+def load_tdjson(tdjson_path, verbosity_level=0):
+    """Load libtdjson and declare the signatures of its functions
+
+    Args:
+        tdjson_path (str): directory containing the pre-built libtdjson
+        verbosity_level (int): parameter of tdlib json interface
+    Returns:
+        (CDLL) libtdjson binding
+    """
+    global tdjson
+    if tdjson is not None:
+        return tdjson
+
+    try:
+        library = CDLL("libtdjson.so")
+    except Exception as e:
+        if verbosity_level:
+            print(e)
+            print("using pre-built td")
+        lib_name = "libtdjson_{}_{}.so".format(system(), machine())
+        lib_path = path_join(tdjson_path, lib_name)
+        library = CDLL(lib_path)
+
+    library.td_json_client_create.restype = c_void_p
+    library.td_json_client_create.argtypes = []
+
+    library.td_json_client_receive.restype = c_char_p
+    library.td_json_client_receive.argtypes = [c_void_p, c_double]
+
+    library.td_json_client_send.restype = None
+    library.td_json_client_send.argtypes = [c_void_p, c_char_p]
+
+    library.td_json_client_execute.restype = c_char_p
+    library.td_json_client_execute.argtypes = [c_void_p, c_char_p]
+
+    library.td_json_client_destroy.restype = None
+    library.td_json_client_destroy.argtypes = [c_void_p]
+
+    tdjson = library
+    return tdjson
+
 class Td:
     """ Ugly python class to interact with tdlib JSON.
     
@@ -68,41 +113,23 @@ class Td:
         To being able to work imperatively and avoid 'callbacks' use cycle method. See documentation. 
 
     Args:
-        verbosity_level (int): parameter of tdlib json interface."""
-    def __init__(self, tdjson_path, db_key, verbosity_level=0):
+        verbosity_level (int): parameter of tdlib json interface;
+        metrics (Metrics): where to count received events by type;
+        profiler (Profiler): where to time receive, signin and handlers."""
+    def __init__(self, tdjson_path, db_key, verbosity_level=0, metrics=None, profiler=None):
         self.db_key = db_key
         self.verbosity_level = verbosity_level
+        self.metrics = metrics
+        self.profiler = profiler
         self.connected = False
 
-        try:
-            tdjson = CDLL("libtdjson.so")
-        except Exception as e:
-            if verbosity_level:
-                print(e)
-                print("using pre-built td")
-            lib_name = "libtdjson_{}_{}.so".format(system(), machine())
-            lib_path = path_join(tdjson_path, lib_name)
-            tdjson = CDLL(lib_path)
+        tdjson = load_tdjson(tdjson_path, verbosity_level)
 
         self.td_json_client_create = tdjson.td_json_client_create
-        self.td_json_client_create.restype = c_void_p
-        self.td_json_client_create.argtypes = []
-
         self.td_json_client_receive = tdjson.td_json_client_receive
-        self.td_json_client_receive.restype = c_char_p
-        self.td_json_client_receive.argtypes = [c_void_p, c_double]
-
         self.td_json_client_send = tdjson.td_json_client_send
-        self.td_json_client_send.restype = None
-        self.td_json_client_send.argtypes = [c_void_p, c_char_p]
-
         self.td_json_client_execute = tdjson.td_json_client_execute
-        self.td_json_client_execute.restype = c_char_p
-        self.td_json_client_execute.argtypes = [c_void_p, c_char_p]
-
         self.destroy = tdjson.td_json_client_destroy
-        self.destroy.restype = None
-        self.destroy.argtypes = [c_void_p]
 
         self.fatal_error_callback_type = CFUNCTYPE(None, c_char_p)
 
@@ -113,9 +140,6 @@ class Td:
         self.c_on_fatal_error_callback = self.fatal_error_callback_type(self.on_fatal_error_callback)
         self.td_set_log_fatal_error_callback(self.c_on_fatal_error_callback)
 
-        self.c_on_fatal_error_callback = self.fatal_error_callback_type(self.on_fatal_error_callback)
-        self.td_set_log_fatal_error_callback(self.c_on_fatal_error_callback)
-
         self.tdlib_parameters = {'@type':"setTdlibParameters", "parameters":{
                                                                "database_directory":"tdlib",
                                                                "use_message_database":True,
@@ -165,7 +189,10 @@ class Td:
         """
         result = self.td_json_client_receive(self.client, 1.0)
         if result:
-            result = json.loads(result.decode('utf-8'))
+            if self.profiler is None:
+                result = json.loads(result.decode('utf-8'))
+            else:
+                result = self.profiler.call('json decode', json.loads, result.decode('utf-8'))
         return result
 
     def execute(self, query):
@@ -291,23 +318,38 @@ class Td:
             if (in_text != None) and (in_text in text):
                 return event['message']
 
-    def downloadFile(self, file_id):
-        self.send({'@type':'downloadFile',
-                   'file_id':file_id,
-                   'priority':1})
+    def downloadFile(self, file_id, priority=1, extra=None):
+        query = {'@type':'downloadFile',
+                 'file_id':file_id,
+                 'priority':priority}
+        if extra is not None:
+            query['@extra'] = extra
+        self.send(query)
 
-    def send_file_message(self, chat_id, file_path, text=''):
+    def deleteFile(self, file_id):
+        self.send({'@type':'deleteFile',
+                   'file_id':file_id})
+
+    def send_file_message(self, chat_id, file_path, text='', extra=None):
         """Send a file to a chat
         
         Args:
             chat_id (int): id of the chat where to send the message
             file_path (str): path of the file to send
+            text (str): caption of the file
+            extra (str): '@extra' of the request, to match its answer
         """
-        self.send({'@type':'sendMessage',
-                   'chat_id':chat_id,
-                   'input_message_content':{'@type':'inputMessageDocument',
-                                            'document':{'@type':'inputFileLocal',
-                                                        'path':file_path} } })
+        content = {'@type':'inputMessageDocument',
+                   'document':{'@type':'inputFileLocal',
+                               'path':file_path} }
+        if text:
+            content['caption'] = {'@type':'formattedText', 'text':text}
+        query = {'@type':'sendMessage',
+                 'chat_id':chat_id,
+                 'input_message_content':content}
+        if extra is not None:
+            query['@extra'] = extra
+        self.send(query)
 
     def send_text_message(self, chat_id, text):
         """Send a text message to a chat
@@ -318,7 +360,7 @@ class Td:
         """
         pass
 
-    def cycle(self, function):
+    def cycle(self, function, tick=False):
         """execute function, managing connection to telegram network
 
         It takes the burden of notifying you if something happens between you and
@@ -330,11 +372,19 @@ class Td:
                             have as arguments:
                             - td, an instance of this class 
                             - event, an event got through 'receive'
+            tick (bool): also call function with a {'@type': 'tick'} event
+                         when nothing is received for a second, for
+                         functions waiting for a time to pass
         """
         if self.verbosity_level >= 2:
             print("cycling", function.__name__)
+        profiler = self.profiler
+        handler = getattr(function, '__qualname__', function.__name__)
         while True:
-            event = self.receive()
+            if profiler is None:
+                event = self.receive()
+            else:
+                event = profiler.call('Td.receive', self.receive)
             # handle an incoming update or an answer to a previously sent request
             
             if self.verbosity_level >= 2 and event != None and event['@type'] != 'updateUser':
@@ -343,11 +393,25 @@ class Td:
                 pass
 
             if event:
-                res = self.signin(event)
+                if self.metrics is not None:
+                    self.metrics.count(event['@type'])
+
+                if profiler is None:
+                    res = self.signin(event)
+                else:
+                    res = profiler.call('Td.signin', self.signin, event, event_type=event['@type'])
                 if self.verbosity_level >= 2 and res: print(res)
 
                 if self.connected:
-                    if function(self, event):
+                    if profiler is None:
+                        done = function(self, event)
+                    else:
+                        done = profiler.call(handler, function, self, event, event_type=event['@type'])
+                    if done:
                         if self.verbosity_level >= 2:
                             print("finished", function.__name__)
                         break
+
+            elif tick and self.connected:
+                if function(self, {'@type': 'tick'}):
+                    break
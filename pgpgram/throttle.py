@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+#    Throttle
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from datetime import datetime
+from time import time
+
+units = {'': 1, 'K': 1000, 'M': 1000000, 'G': 1000000000}
+
+
+def parse_rate(rate):
+    """Parse a rate like 500K, 2M or 1.5G (bytes per second)
+
+    Args:
+        rate (str): the rate; 0 or 'unlimited' for no limit
+    Returns:
+        (float) bytes per second or None for no limit
+    """
+    rate = rate.strip().upper().rstrip("/S").rstrip("B")
+    if rate in ('', '0', 'UNLIMITED'):
+        return None
+    unit = rate[-1] if rate[-1] in units else ''
+    value = float(rate[:len(rate) - len(unit)]) * units[unit]
+    return value if value > 0 else None
+
+
+def minutes(hour):
+    """Minutes since midnight of a HH:MM string"""
+    h, _, m = hour.partition(":")
+    return int(h) * 60 + int(m or 0)
+
+
+class Schedule:
+    """Rate depending on the time of the day
+
+    The schedule is a comma separated list of HH:MM-HH:MM=RATE windows
+    and of a plain RATE used outside of them, e.g.
+    '08:00-20:00=1M,10M' for 1 MB/s by day and 10 MB/s by night.
+    Windows can cross midnight (22:00-06:00=50M).
+
+    Args:
+        schedule (str): the schedule
+    """
+
+    def __init__(self, schedule):
+        self.windows = []
+        self.default = None
+        for item in schedule.split(","):
+            if "=" in item:
+                hours, rate = item.split("=")
+                start, end = hours.split("-")
+                self.windows.append((minutes(start), minutes(end), parse_rate(rate)))
+            else:
+                self.default = parse_rate(item)
+
+    def rate(self, when=None):
+        """Rate in bytes per second at a given time
+
+        Args:
+            when (float): timestamp, default now
+        Returns:
+            (float) bytes per second or None for no limit
+        """
+        now = datetime.fromtimestamp(when if when is not None else time())
+        now = now.hour * 60 + now.minute
+        for start, end, rate in self.windows:
+            if (start <= now < end) if start <= end else (now >= start or now < end):
+                return rate
+        return self.default
+
+
+class TokenBucket:
+    """Token bucket pacing transfers of a process
+
+    Tokens are bytes, refilled at the scheduled rate up to 'burst'
+    seconds of transfer. tdlib sends a file at full speed once asked,
+    so the limit can only pace whole transfers: uploads are split in
+    chunks not bigger than the bucket (see capacity), while a download
+    of a chunk bigger than the bucket is let through leaving the bucket
+    in debt, so that the following ones wait for it to be paid back: on
+    average the rate is respected whatever the chunk size. The bucket
+    never sleeps: callers are told how long to wait, so that they can
+    keep running the telegram client event loop meanwhile.
+
+    Args:
+        schedule (str): rate or schedule (see Schedule)
+    """
+
+    burst = 1
+    """Seconds of transfer at the scheduled rate the bucket holds"""
+
+    def __init__(self, schedule):
+        self.schedule = Schedule(schedule)
+        self.tokens = 0.0
+        self.last = time()
+
+    def capacity(self, when=None):
+        """Most bytes the bucket lets through at once
+
+        Args:
+            when (float): timestamp, default now
+        Returns:
+            (float) bytes or None for no limit
+        """
+        rate = self.schedule.rate(when)
+        return rate * self.burst if rate is not None else None
+
+    def reserve(self, tokens, last, size):
+        """Take size bytes from a bucket state
+
+        The bytes are taken unless the bucket is in debt, even if they
+        leave it in debt.
+
+        Args:
+            tokens (float): tokens in the bucket
+            last (float): last refill time
+            size (int): bytes to transfer
+        Returns:
+            (tuple) new tokens, new refill time and seconds to wait
+            before asking again, 0 if the bytes were taken
+        """
+        now = time()
+        rate = self.schedule.rate(now)
+        if rate is None:
+            return 0.0, now, 0
+        tokens = min(rate * self.burst, tokens + (now - last) * rate)
+        if tokens < 0:
+            return tokens, now, -tokens / rate
+        return tokens - size, now, 0
+
+    def consume(self, size):
+        """Take size bytes, unless the bucket is in debt
+
+        Args:
+            size (int): bytes to transfer
+        Returns:
+            (float) seconds to wait before asking again, 0 if the
+            transfer can start now
+        """
+        self.tokens, self.last, wait = self.reserve(self.tokens, self.last, size)
+        return wait
+
+
+class SharedTokenBucket(TokenBucket):
+    """Token bucket shared by all pgpgram processes
+
+    The bucket state is kept in a file, locked while it is updated,
+    so that concurrent processes reserve their transfers from the
+    same budget.
+
+    Args:
+        schedule (str): rate or schedule (see Schedule)
+        path (str): path of the state file
+    """
+
+    def __init__(self, schedule, path):
+        TokenBucket.__init__(self, schedule)
+        self.path = path
+
+    def consume(self, size):
+        from fcntl import flock, LOCK_EX, LOCK_UN
+        from os import O_CREAT, O_RDWR, open as os_open
+
+        with open(os_open(self.path, O_RDWR | O_CREAT, 0o600), 'r+') as f:
+            flock(f, LOCK_EX)
+            try:
+                state = f.read().split()
+                tokens, last = (float(state[0]), float(state[1])) if len(state) == 2 else (0.0, time())
+                tokens, last, wait = self.reserve(tokens, last, size)
+                f.seek(0)
+                f.truncate()
+                f.write("{} {}".format(tokens, last))
+                f.flush()
+            finally:
+                flock(f, LOCK_UN)
+        return wait
+
+
+class Throttle:
+    """Upload and download limits of a session
+
+    Args:
+        upload (str): upload rate or schedule, None for no limit
+        download (str): download rate or schedule, None for no limit
+        shared_dir (str): if given, limits are shared with the other
+                          pgpgram processes through files in this directory
+    """
+
+    def __init__(self, upload=None, download=None, shared_dir=None):
+        self.upload = self.bucket(upload, shared_dir, "upload")
+        self.download = self.bucket(download, shared_dir, "download")
+
+    def bucket(self, schedule, shared_dir, name):
+        if not schedule:
+            return None
+        if shared_dir:
+            from os.path import join as path_join
+            return SharedTokenBucket(schedule, path_join(shared_dir, "{}.bucket".format(name)))
+        return TokenBucket(schedule)
+
+    def before_upload(self, size):
+        """Pace the dispatch of an upload of size bytes
+
+        Returns:
+            (float) seconds to wait before asking again, 0 if the
+            upload can be sent now
+        """
+        if self.upload is not None:
+            return self.upload.consume(size)
+        return 0
+
+    def upload_burst(self):
+        """Most bytes an upload can send at once now, None for no limit"""
+        if self.upload is not None:
+            return self.upload.capacity()
+        return None
+
+    def before_download(self, size):
+        """Pace a download request of size bytes (see before_upload)"""
+        if self.download is not None:
+            return self.download.consume(size)
+        return 0
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+
+#    Verify
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from os import getcwd
+from os import chdir as cd
+from os.path import getsize, join as path_join
+from time import perf_counter, time
+
+from .color import Color
+from .scheduler import Download, retry_after, scheduler
+
+color = Color()
+
+
+def parse_percent(percent):
+    """Parse a percentage like 5% or 0.5
+
+    Args:
+        percent (str): the percentage, '%' can be omitted
+    Returns:
+        (float) fraction between 0 and 1
+    """
+    return min(1.0, max(0.0, float(str(percent).rstrip("%")) / 100))
+
+
+class Verify:
+    """Check that backed up documents are still on the server
+
+    Messages of the documents are fetched in batches with getMessages,
+    which transfers only their metadata: a chunk is missing if its
+    message is gone and mismatched if the size of its file is not the
+    one recorded at backup time (or, for documents backed up before
+    chunk sizes were recorded, the one seen by the first verification).
+
+    With 'deep' a random sample of the chunks is also downloaded and
+    checked against the manifest of the document, if it has one;
+    chunks of independently encrypted documents have to decrypt (and
+    authenticate, for format versions 5 and 6), and
+    all have to keep the digest they had when first sampled.
+
+    Results are kept in verify.db, so that following runs recheck only
+    documents whose last check is older than 'max age' or failed.
+
+    Args:
+        deep (float): fraction of the chunks to download and check;
+        max_age (float): days after which a check is stale;
+        batch (int): messages asked with every getMessages;
+        verbose (int): integer indicating level of verbose (see Backup);
+        metrics (Metrics): where to record timings of the stages;
+        profiler (Profiler): where to time the telegram client event loop;
+        throttle (Throttle): upload and download rate limits;
+        td (Td): connected telegram client to use instead of creating one.
+    """
+
+    in_flight = 4
+    """Most getMessages requests sent at the same time"""
+
+    download_timeout = 120
+    """Seconds a sampled chunk can go without downloading a byte"""
+
+    def __init__(self, deep=0, max_age=7, batch=100, verbose=0, metrics=None, profiler=None, throttle=None, td=None):
+        from sqlitedict import SqliteDict
+        from . import Db
+        from .metrics import Metrics
+        from .td import Td
+
+        self.metrics = metrics if metrics is not None else Metrics("verify")
+        self.profiler = profiler
+        self.throttle = throttle
+        self.verbose = verbose
+        current_path = getcwd()
+        self.db = Db(verbose=verbose, readonly=True)
+        self.results = SqliteDict(path_join(self.db.data_path, "verify.db"), autocommit=False)
+
+        # Stale documents
+        now = time()
+        self.documents = []
+        for documents in self.db.files.values():
+            for d in documents:
+                result = self.results.get(d['id'])
+                if result is None or result['status'] != 'ok' or now - result['checked'] > max_age * 86400:
+                    self.documents.append(d)
+        print(color.set(color.BLUE, "{} documents to verify".format(len(self.documents))))
+
+        # Messages to fetch, once even if shared by packed documents
+        chats = {}
+        for d in self.documents:
+            chats.setdefault(d['chat id'], set()).update(d['messages id'])
+        self.batches = []
+        for chat_id, messages_id in chats.items():
+            messages_id = sorted(messages_id)
+            for i in range(0, len(messages_id), batch):
+                self.batches.append((chat_id, messages_id[i:i + batch]))
+        self.batches.reverse()
+        self.requested = {}
+        self.remote = {}
+        self.problems = {}
+        self.sent = 0
+        self.window = scheduler.window('messages', self.in_flight)
+
+        shared = td is not None
+        try:
+            if self.batches:
+                if not shared:
+                    cd(self.db.config_path)
+                    td = Td(tdjson_path=self.db.executable_path, db_key=self.db.config["db key"], verbosity_level=verbose, metrics=self.metrics, profiler=self.profiler)
+                with self.metrics.stage('connect'):
+                    if not td.connected:
+                        td.cycle(self.connected)
+                with self.metrics.stage('get messages'):
+                    self.top_up(td)
+                    td.cycle(self.fetched, tick=True)
+
+            for d in self.documents:
+                self.check_sizes(d)
+            if deep and self.documents:
+                self.sample(td, deep)
+
+            # Store results
+            for d in self.documents:
+                if d['id'] in self.problems and self.problems[d['id']] is None:
+                    continue
+                result = self.results.get(d['id'], {})
+                result.update({'checked': now,
+                               'status': self.problems[d['id']][0] if d['id'] in self.problems else 'ok',
+                               'problems': self.problems[d['id']][1] if d['id'] in self.problems else [],
+                               'sizes': [self.remote.get((d['chat id'], m), (None, None))[1]
+                                         for m in d['messages id']]})
+                if result['status'] == 'ok' and result.get('baseline') is None:
+                    result['baseline'] = result['sizes']
+                self.results[d['id']] = result
+            self.results.commit()
+        finally:
+            self.results.close()
+            if td is not None and not shared:
+                td.destroy(td.client)
+            cd(current_path)
+
+        # Report
+        bad = {k: v for k, v in self.problems.items() if v is not None}
+        for d in self.documents:
+            if d['id'] in bad:
+                status, problems = bad[d['id']]
+                print(color.set(color.RED, "{}: {}".format(status, d['path'])) + " " + ", ".join(problems))
+        unknown = sum(1 for v in self.problems.values() if v is None)
+        self.metrics.failures += len(bad)
+        print(color.set(color.BLUE, "{} documents verified, {} ok, {} damaged, {} not checked".format(
+              len(self.documents), len(self.documents) - len(bad) - unknown, len(bad), unknown)))
+
+    def top_up(self, td):
+        """Send getMessages requests while there is room in the window"""
+        while self.batches and self.window.room(len(self.requested)):
+            chat_id, messages_id = self.batches.pop()
+            extra = "verify {}".format(self.sent)
+            self.sent += 1
+            self.requested[extra] = (chat_id, messages_id)
+            td.send({'@type': 'getMessages',
+                     'chat_id': chat_id,
+                     'message_ids': messages_id,
+                     '@extra': extra})
+
+    def fetched(self, td, event):
+        """Collect remote file sizes; finishes when all batches are back"""
+        extra = event.get('@extra')
+        if extra in self.requested:
+            chat_id, messages_id = self.requested.pop(extra)
+            if event['@type'] == 'messages':
+                self.window.success()
+                for message_id, message in zip(messages_id, event['messages']):
+                    file = None
+                    if message and message['content']['@type'] == 'messageDocument':
+                        file = message['content']['document']['document']
+                    self.remote[(chat_id, message_id)] = (file['id'], file['size']) if file else (None, None)
+            elif retry_after(event) is not None:
+                # Rate limited: send it again after the pause
+                self.window.failure(retry_after(event))
+                self.batches.append((chat_id, messages_id))
+            else:
+                self.window.failure()
+                if self.verbose:
+                    print(color.set(color.RED, "getMessages: {}".format(event.get('message'))))
+        self.top_up(td)
+        return not (self.batches or self.requested)
+
+    def check_sizes(self, document):
+        """Compare remote sizes of the chunks of a document with the expected ones"""
+        key = document['chat id']
+        if any((key, m) not in self.remote for m in document['messages id']):
+            # The batch failed, try again next time
+            self.problems[document['id']] = None
+            return
+        expected = [chunk['size'] for chunk in document.get('chunks', [])]
+        if not expected:
+            expected = self.results.get(document['id'], {}).get('baseline') or []
+        problems = []
+        status = 'ok'
+        for i, message_id in enumerate(document['messages id']):
+            file_id, size = self.remote[(key, message_id)]
+            if file_id is None:
+                problems.append("chunk {} missing".format(i))
+                status = 'missing'
+            elif i < len(expected) and expected[i] is not None and size != expected[i]:
+                problems.append("chunk {} is {} bytes instead of {}".format(i, size, expected[i]))
+                if status == 'ok':
+                    status = 'mismatch'
+            elif size == 0:
+                problems.append("chunk {} is empty".format(i))
+                if status == 'ok':
+                    status = 'mismatch'
+        if problems:
+            self.problems[document['id']] = (status, problems)
+
+    def sample(self, td, fraction):
+        """Download and check a random sample of the chunks"""
+        from math import ceil
+        from random import SystemRandom
+
+        chunks = {}
+        for d in self.documents:
+            if not d['id'] in self.problems:
+                for i, message_id in enumerate(d['messages id']):
+                    chunks.setdefault((d['chat id'], message_id), (d, i))
+        if not chunks:
+            return
+        sample = SystemRandom().sample(sorted(chunks, key=str), int(ceil(len(chunks) * fraction)))
+        print(color.set(color.BLUE, "downloading {} chunks".format(len(sample))))
+        digests = {}
+        for key in sample:
+            document, index = chunks[key]
+            file_id = self.remote[key][0]
+            self.pace_download(td, self.remote[key][1])
+            start = perf_counter()
+            try:
+                path = Download(file_id, timeout=self.download_timeout).run(td)
+            except Exception as e:
+                # Not a sign of damage, check the document again next time
+                if self.verbose:
+                    print(color.set(color.RED, "{}: {}".format(document['path'], e)))
+                self.problems.setdefault(document['id'], None)
+                continue
+            self.metrics.add('download', perf_counter() - start, getsize(path), chunk=index, document=document['id'])
+            try:
+                problem = self.check_chunk(document, index, path, digests)
+            finally:
+                td.deleteFile(file_id)
+            if problem:
+                self.problems[document['id']] = ('corrupt', [problem])
+        for document_id, chunk_digests in digests.items():
+            result = self.results.get(document_id, {})
+            result.setdefault('digests', {}).update(chunk_digests)
+            result['deep'] = time()
+            self.results[document_id] = result
+
+    def check_chunk(self, document, index, path, digests):
+        """Check a downloaded chunk
+
+        Returns:
+            (str) the problem found, None if the chunk is fine
+        """
+        from subprocess import run, DEVNULL
+        from . import check_manifest, sha256_digest
+
+        problem = check_manifest(document, index, path)
+        if problem is not None:
+            return problem
+        digest = sha256_digest(path)
+        known = self.results.get(document['id'], {}).get('digests', {}).get(str(index))
+        if known is not None and known != digest:
+            return "chunk {} changed since it was last downloaded".format(index)
+        digests.setdefault(document['id'], {})[str(index)] = digest
+
+        if document.get('format version', 0) >= 5:
+            from .crypto import chunk_aad, unseal, unseal_chunk
+            # Chunks of a pack are authenticated with the pack id
+            sealed_id = document.get('pack id', document['id'])
+            with self.metrics.stage('decrypt', size=getsize(path), chunk=index, document=document['id']):
+                try:
+                    if document['format version'] >= 6:
+                        unseal_chunk(path, document['key'], sealed_id, index,
+                                     segment_size=document['segment size'])
+                    else:
+                        unseal(path, document['key'], chunk_aad(sealed_id, index))
+                except ValueError as e:
+                    return "chunk {} does not decrypt".format(index)
+        elif document.get('format version', 0) >= 4:
+            gpg = ['gpg', '--quiet', '--decrypt', '--batch', '--passphrase', document['passphrase'], path]
+            with self.metrics.stage('decrypt', size=getsize(path), chunk=index, document=document['id']):
+                if run(gpg, stdout=DEVNULL, stderr=DEVNULL).returncode:
+                    return "chunk {} does not decrypt".format(index)
+
+    def connected(self, td, event):
+        """Check if td instance is connected to telegram network"""
+        if td.connected:
+            return True
+
+    def pace_download(self, td, size):
+        """Wait for the download rate limit, receiving updates meanwhile"""
+        from time import monotonic
+
+        if self.throttle is None:
+            return
+        wait = self.throttle.before_download(size)
+        while wait:
+            self.metrics.add('throttle', wait)
+            self.resume_at = monotonic() + wait
+            td.cycle(lambda td, event: monotonic() >= self.resume_at, tick=True)
+            wait = self.throttle.before_download(size)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+#    Watch
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import struct
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+from os import close, getcwd, read, strerror, walk
+from os import chdir as cd
+from os.path import abspath, isdir, isfile, join as path_join
+from select import select
+from time import monotonic
+
+from .color import Color
+
+color = Color()
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO |
+              IN_MOVED_FROM | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+
+event_header = struct.Struct("iIII")
+
+
+class Inotify:
+    """Recursive inotify watch of directory trees
+
+    Every directory of the trees gets its own watch; directories
+    created or moved in while watching are added on the fly.
+
+    Args:
+        directories (list): roots of the trees to watch
+        exclude (list): paths whose subtrees are not watched
+    """
+
+    def __init__(self, directories, exclude=()):
+        self.libc = CDLL(find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(get_errno(), strerror(get_errno()))
+        self.exclude = tuple(abspath(p) for p in exclude)
+        self.watches = {}
+        for directory in directories:
+            self.add_tree(abspath(directory))
+
+    def excluded(self, path):
+        return any(path == p or path.startswith(p + "/") for p in self.exclude)
+
+    def add_tree(self, directory):
+        """Watch a directory tree
+
+        Returns:
+            (list) files found in the tree
+        """
+        files = []
+        for path, directories, names in walk(directory):
+            if self.excluded(path):
+                directories[:] = []
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, path.encode(), WATCH_MASK)
+            if wd < 0:
+                errno = get_errno()
+                print(color.set(color.RED, "{}: {}".format(path, strerror(errno))))
+                continue
+            self.watches[wd] = path
+            files.extend(path_join(path, name) for name in names)
+        return files
+
+    def events(self, timeout):
+        """Wait for events
+
+        Args:
+            timeout (float): seconds to wait, None to wait forever
+        Returns:
+            (list) (path, mask) of the events
+        """
+        ready, _, _ = select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buffer = read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = event_header.unpack_from(buffer, offset)
+            offset += event_header.size
+            name = buffer[offset:offset + length].rstrip(b"\0").decode(errors="surrogateescape")
+            offset += length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None and not mask & IN_Q_OVERFLOW:
+                continue
+            events.append((path_join(directory, name) if name else directory, mask))
+        return events
+
+    def close(self):
+        close(self.fd)
+
+
+def watch(directories, debounce=5, initial=True, verbose=0, **kwargs):
+    """Back up files as soon as they change
+
+    Created, modified and moved in files are backed up once they have
+    not changed for 'debounce' seconds, so that files still being
+    written are uploaded only once; files whose metadata changed
+    (chmod, touch) are looked at too, the stat cache and the duplicate
+    check keep unchanged contents from being uploaded again. All the
+    backups share a single telegram session, opened with the first
+    batch of changes and kept receiving its events while waiting; the
+    catalog is backed up after every batch (see checkpoint.py).
+
+    Args:
+        directories (list): directories to watch
+        debounce (float): seconds a file must be left untouched
+        initial (bool): back up the files already in the directories
+        verbose (int): verbose level
+        kwargs: further arguments of Backup (size, metrics, throttle, ...)
+    """
+    from . import Backup, Db
+    from .checkpoint import auto_checkpoint
+    from .td import Td
+
+    current_path = getcwd()
+    db = Db(verbose)
+    inotify = Inotify(directories, exclude=(db.config_path, db.data_path, db.cache_path))
+    pending = {}
+    now = monotonic()
+    if initial:
+        for directory in directories:
+            for path, _, names in walk(abspath(directory)):
+                if not inotify.excluded(path):
+                    for name in names:
+                        pending[path_join(path, name)] = now - debounce
+    print(color.set(color.BLUE, "watching {} directories".format(len(inotify.watches))))
+
+    td = None
+    try:
+        while True:
+            now = monotonic()
+            ready = sorted(path for path, last in pending.items() if now - last >= debounce)
+            for path in ready:
+                del pending[path]
+            ready = [path for path in ready if isfile(path)]
+
+            if ready:
+                if verbose:
+                    print(color.set(color.BLUE, "backing up {} files".format(len(ready))))
+                if td is None:
+                    cd(db.config_path)
+                    td = Td(tdjson_path=db.executable_path, db_key=db.config["db key"], verbosity_level=verbose,
+                            metrics=kwargs.get('metrics'), profiler=kwargs.get('profiler'))
+                for path in ready:
+                    try:
+                        Backup(path, verbose=verbose, td=td, **kwargs)
+                    except Exception as e:
+                        print(color.set(color.RED, "{}: {}".format(path, e)))
+                        # Try again later
+                        pending[path] = monotonic() + debounce * 10
+                auto_checkpoint(verbose=verbose, metrics=kwargs.get('metrics'), profiler=kwargs.get('profiler'), td=td)
+                continue
+
+            timeout = None
+            if pending:
+                timeout = max(0, min(pending.values()) + debounce - now)
+            if td is not None:
+                # Keep the client going: receiving waits up to a second
+                events = inotify.events(0)
+                if not events:
+                    event = td.receive()
+                    if event:
+                        td.signin(event)
+            else:
+                events = inotify.events(timeout)
+            for path, mask in events:
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost: look at everything again,
+                    # the stat cache keeps unchanged files cheap
+                    for directory in directories:
+                        for f in inotify.add_tree(abspath(directory)):
+                            pending[f] = monotonic()
+                elif mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and isdir(path):
+                        for f in inotify.add_tree(path):
+                            pending[f] = monotonic()
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    pending.pop(path, None)
+                elif mask & (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO):
+                    pending[path] = monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        inotify.close()
+        if td is not None:
+            td.destroy(td.client)
+        cd(current_path)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+#    Tests configuration
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from os import chdir, environ, getcwd
+from os.path import getsize, join as path_join
+from shutil import copyfile, rmtree
+from tempfile import mkdtemp
+
+import pytest
+
+# pgpgram keeps its catalog and configuration in the user directories,
+# which are chosen when it is imported: point them to a temporary home
+home = mkdtemp(prefix="pgpgram-tests-")
+environ['HOME'] = home
+environ['XDG_CONFIG_HOME'] = path_join(home, "config")
+environ['XDG_CACHE_HOME'] = path_join(home, "cache")
+environ['XDG_DATA_HOME'] = path_join(home, "data")
+
+
+@pytest.fixture(autouse=True)
+def clean_home():
+    """Start every test without catalog and configuration
+
+    Commands move to the configuration directory and failing ones can
+    stay there: go back where the test started, before it is removed.
+    """
+    for name in ("config", "cache", "data"):
+        rmtree(path_join(home, name), ignore_errors=True)
+    directory = getcwd()
+    yield
+    chdir(directory)
+
+
+class FakeTd:
+    """Telegram client keeping the sent files in a directory
+
+    Only what backups, restores, verifications, catalog checkpoints and
+    deletions use is answered: sending a file, getting and searching
+    messages, downloading and deleting. Deleted messages are None.
+    """
+
+    connected = True
+    client = None
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.events = []
+        self.messages = []
+        self.files = {}
+        self.deleted = []
+
+    def send_file_message(self, chat_id, file_path, text='', extra=None):
+        message_id = file_id = len(self.messages) + 1
+        self.files[file_id] = path_join(self.directory, "message-{}".format(file_id))
+        copyfile(file_path, self.files[file_id])
+        message = {'id': message_id,
+                   'chat_id': chat_id,
+                   'content': {'@type': 'messageDocument',
+                               'caption': {'text': text},
+                               'document': {'document': self.file(file_id)}}}
+        self.messages.append(message)
+        self.events.append({'@type': 'message', 'id': -message_id, '@extra': extra})
+        self.events.append({'@type': 'updateMessageSendSucceeded', 'old_message_id': -message_id, 'message': message})
+
+    def file(self, file_id):
+        return {'id': file_id,
+                'size': getsize(self.files[file_id]),
+                'remote': {'unique_id': "file{}".format(file_id)},
+                'local': {'path': '', 'is_downloading_completed': False}}
+
+    def send(self, query):
+        if query['@type'] == 'getMessage':
+            message = self.messages[query['message_id'] - 1]
+            self.events.append(dict(message, **{'@type': 'message', '@extra': query['@extra']}))
+        elif query['@type'] == 'getMessages':
+            found = [self.messages[m - 1] if m <= len(self.messages) else None for m in query['message_ids']]
+            self.events.append({'@type': 'messages', 'messages': found, '@extra': query['@extra']})
+        elif query['@type'] == 'searchChatMessages':
+            found = [m for m in reversed(self.messages)
+                     if query['query'] in m['content']['caption']['text'] and
+                     (not query['from_message_id'] or m['id'] <= query['from_message_id'])]
+            self.events.append({'@type': 'messages', 'messages': found[:query['limit']], '@extra': query['@extra']})
+        elif query['@type'] == 'deleteMessages':
+            self.deleted.extend((query['chat_id'], m) for m in query['message_ids'])
+            self.events.append({'@type': 'ok', '@extra': query['@extra']})
+
+    def downloadFile(self, file_id, priority=1, extra=None):
+        path = path_join(self.directory, "download-{}".format(file_id))
+        copyfile(self.files[file_id], path)
+        file = self.file(file_id)
+        file['local'] = {'path': path, 'is_downloading_completed': True}
+        self.events.append(dict(file, **{'@type': 'file'}))
+
+    def deleteFile(self, file_id):
+        pass
+
+    def cycle(self, function, tick=False):
+        while True:
+            if self.events:
+                event = self.events.pop(0)
+            elif tick:
+                event = {'@type': 'tick'}
+            else:
+                raise Exception("waiting for an event which will never come")
+            if function(self, event):
+                return
+
+
+@pytest.fixture
+def td(tmp_path):
+    return FakeTd(str(tmp_path))
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+#    Bulk restore tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from os import makedirs, urandom
+
+import pytest
+
+from pgpgram import Backup, BulkRestore, Db, PackBackup
+
+
+@pytest.fixture
+def chat():
+    db = Db()
+    db.config['backup chat id'] = 1
+    db.save()
+
+
+def write(path, size):
+    data = urandom(size)
+    makedirs(str(path.parent), exist_ok=True)
+    with open(str(path), 'wb') as f:
+        f.write(data)
+    return data
+
+
+def read(path):
+    with open(str(path), 'rb') as f:
+        return f.read()
+
+
+def test_tree_is_restored_with_latest_versions(chat, td, tmp_path):
+    tree = tmp_path / "tree"
+    write(tree / "big", 2500000)
+    Backup(str(tree / "big"), size='1', td=td)
+    expected = {"big": write(tree / "big", 2600000)}
+    Backup(str(tree / "big"), size='1', td=td)
+    expected["sub/small"] = write(tree / "sub" / "small", 1000)
+    expected["sub/other"] = write(tree / "sub" / "other", 2000)
+    PackBackup([str(tree / "sub" / "small"), str(tree / "sub" / "other")], size='1', td=td)
+    write(tmp_path / "outside", 10)
+    Backup(str(tmp_path / "outside"), size='1', td=td)
+
+    output = tmp_path / "out"
+    downloads = []
+    download = td.downloadFile
+    td.downloadFile = lambda file_id, *args, **kwargs: downloads.append(file_id) or download(file_id, *args, **kwargs)
+    BulkRestore(str(tree), download_directory=str(output), concurrency=2, workers=2, td=td)
+    for name, data in expected.items():
+        assert read(output / name) == data
+    assert sorted(p.name for p in output.rglob("*") if p.is_file()) == ["big", "other", "small"]
+    # Three chunks of the latest big file, the pack once
+    assert len(downloads) == 4
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+#    Chunk cache tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from os import listdir
+from os.path import join as path_join
+
+from pgpgram.cache import ChunkCache, parse_size
+
+
+def download(tmp_path, name, size):
+    path = str(tmp_path / "download-{}".format(name))
+    with open(path, 'wb') as f:
+        f.write(bytes(size))
+    return path
+
+
+def put(cache, tmp_path, key, size):
+    """Put a chunk and be done with it"""
+    path = cache.put(key, download(tmp_path, key, size))
+    cache.discard(path)
+    return path
+
+
+def test_parse_size():
+    assert parse_size("500M") == 500000000
+    assert parse_size("2GB") == 2000000000
+    assert parse_size("100") == 100
+
+
+def test_put_evicts_least_recently_used(tmp_path):
+    cache = ChunkCache(str(tmp_path / "chunks"), 250)
+    for key in ("a", "b"):
+        put(cache, tmp_path, key, 100)
+    cache.discard(cache.get("a"))
+    put(cache, tmp_path, "c", 100)
+    assert sorted(listdir(cache.directory)) == ["a", "c"]
+    assert cache.total == 200
+
+
+def test_chunks_in_use_are_spared(tmp_path):
+    cache = ChunkCache(str(tmp_path / "chunks"), 150)
+    first = cache.put("a", download(tmp_path, "a", 100))
+    put(cache, tmp_path, "b", 100)
+    assert sorted(listdir(cache.directory)) == ["a"]
+    cache.discard(first)
+    put(cache, tmp_path, "c", 100)
+    assert sorted(listdir(cache.directory)) == ["c"]
+
+
+def test_damaged_chunks_are_removed(tmp_path):
+    cache = ChunkCache(str(tmp_path / "chunks"), 1000)
+    path = cache.put("a", download(tmp_path, "a", 100))
+    cache.discard(path, damaged=True)
+    assert listdir(cache.directory) == []
+    assert cache.total == 0
+
+
+def test_trim_counts_other_processes(tmp_path):
+    cache = ChunkCache(str(tmp_path / "chunks"), 150)
+    put(cache, tmp_path, "a", 100)
+    with open(path_join(cache.directory, "b"), 'wb') as f:
+        f.write(bytes(100))
+    cache.trim()
+    assert listdir(cache.directory) == ["b"]
+
+
+def test_threads_keep_the_accounting(tmp_path):
+    from threading import Thread
+
+    cache = ChunkCache(str(tmp_path / "chunks"), 1000)
+    paths = [cache.put("held-{}".format(i), download(tmp_path, "held-{}".format(i), 10))
+             for i in range(200)]
+
+    def discard(paths):
+        for path in paths:
+            cache.discard(path)
+
+    def put():
+        for i in range(200):
+            key = "new-{}".format(i)
+            cache.discard(cache.put(key, download(tmp_path, key, 10)))
+
+    threads = [Thread(target=discard, args=(paths[i::4],)) for i in range(4)]
+    threads.append(Thread(target=put))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.in_use == set()
+    assert cache.total == sum(cache.entries.values())
+    assert cache.total <= 1000
+    assert sorted(listdir(cache.directory)) == sorted(cache.entries)
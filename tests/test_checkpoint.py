@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+#    Catalog checkpoint tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import sqlite3
+
+import pytest
+
+from pgpgram import Db
+from pgpgram.checkpoint import CatalogRestore, Checkpoint, load_state, setup
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    monkeypatch.setenv('PGPGRAM_CATALOG_PASSPHRASE', "secret")
+    db = Db()
+    db.config['backup chat id'] = 1
+    db.save()
+    setup()
+    return Db()
+
+
+def state(db):
+    conn = sqlite3.connect(db.files_db_path)
+    try:
+        return load_state(conn)
+    finally:
+        conn.close()
+
+
+def document(name):
+    return [{'name': name, 'path': "/{}".format(name), 'size': 1}]
+
+
+def test_snapshot_and_deltas_restore(catalog, td):
+    catalog.files['a'] = document("a")
+    catalog.files['b'] = document("b")
+    catalog.save()
+    Checkpoint(snapshot=True, td=td)
+    assert state(catalog) == {'sequence': 1, 'snapshot': 1, 'deltas': 0}
+
+    del catalog.files['a']
+    catalog.files['c'] = document("c")
+    catalog.save()
+    Checkpoint(td=td)
+    assert state(catalog) == {'sequence': 2, 'snapshot': 1, 'deltas': 1}
+    assert [m['content']['caption']['text'] for m in td.messages] == [
+        "pgpgram catalog 1 snapshot", "pgpgram catalog 2 delta"]
+
+    CatalogRestore(td=td)
+    restored = Db(readonly=True)
+    assert sorted(restored.files.keys()) == ['b', 'c']
+    assert sorted(restored.file_names.keys()) == ['b', 'c']
+    assert state(restored) == {'sequence': 2, 'snapshot': 1, 'deltas': 1}
+
+
+def test_nothing_changed(catalog, td):
+    catalog.files['a'] = document("a")
+    catalog.save()
+    Checkpoint(td=td)
+    assert Checkpoint(td=td).sequence is None
+    assert len(td.messages) == 1
+
+
+def test_state_survives_configuration_writers(catalog, td):
+    other = Db()
+    catalog.files['a'] = document("a")
+    catalog.save()
+    Checkpoint(td=td)
+    other.config['unrelated'] = True
+    other.save()
+    catalog.files['b'] = document("b")
+    catalog.save()
+    Checkpoint(td=td)
+    assert state(catalog)['sequence'] == 2
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+#    Chunk size tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import pytest
+
+from pgpgram import Backup, Db, auto_chunk_size
+
+
+def test_small_files_fill_the_window():
+    assert auto_chunk_size(10000000, window=4) == 3000000
+    assert auto_chunk_size(1000, window=4) == 1000000
+
+
+def test_big_files_follow_the_throughput():
+    assert auto_chunk_size(10 ** 10) == 100000000
+    assert auto_chunk_size(10 ** 10, {'throughput': 1000000, 'failure rate': 0}) == 60000000
+    assert auto_chunk_size(10 ** 10, {'throughput': 1000000, 'failure rate': 0.5}) == 30000000
+    assert auto_chunk_size(10 ** 11, {'throughput': 10 ** 9, 'failure rate': 0}) == 2000000000
+
+
+def test_pack_size():
+    assert auto_chunk_size(None, {'throughput': 500000, 'failure rate': 0}) == 30000000
+
+
+def test_upload_stats_are_averaged():
+    backup = Backup.__new__(Backup)
+    backup.db = Db(readonly=True)
+    backup.db.config = {}
+    backup.update_upload_stats(10000000, 10)
+    assert backup.db.config['upload stats'] == {'throughput': 1000000, 'failure rate': 0.0}
+    backup.update_upload_stats(0, 5, failed=True)
+    backup.update_upload_stats(20000000, 10)
+    stats = backup.db.config['upload stats']
+    assert stats['throughput'] == pytest.approx(1200000)
+    assert stats['failure rate'] == pytest.approx(0.16)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+#    Configuration tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from pgpgram import Db
+
+
+def test_save_keeps_keys_of_other_processes():
+    first = Db()
+    second = Db()
+    first.config['first'] = 1
+    first.save()
+    second.config['second'] = 2
+    second.save()
+    assert Db(readonly=True).config['first'] == 1
+    assert Db(readonly=True).config['second'] == 2
+    assert second.config['first'] == 1
+
+
+def test_save_removes_deleted_keys():
+    first = Db()
+    first.config['key'] = 1
+    first.save()
+    second = Db()
+    del first.config['key']
+    first.save()
+    second.save()
+    assert not 'key' in Db(readonly=True).config
+
+
+def test_update_config_from_saved_value():
+    first = Db()
+    second = Db()
+    first.update_config('list', lambda value: (value or []) + [1])
+    second.update_config('list', lambda value: (value or []) + [2])
+    assert Db(readonly=True).config['list'] == [1, 2]
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+#    Data key encryption tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from os import urandom
+
+import pytest
+
+from pgpgram import Backup, Db, crypto
+from pgpgram.crypto import chunk_aad, new_key, seal, unseal
+
+pytestmark = pytest.mark.skipif(not crypto.available, reason="cryptography is not installed")
+
+
+@pytest.fixture
+def sealed(tmp_path):
+    data = urandom(3000000)
+    with open(str(tmp_path / "file"), 'wb') as f:
+        f.write(data)
+    key = new_key()
+    output = str(tmp_path / "chunk")
+    seal(str(tmp_path / "file"), key, chunk_aad("doc", 1), 1000000, 1500000, output, block_size=65536)
+    return data[1000000:2500000], key, output
+
+
+def test_round_trip(sealed, tmp_path):
+    data, key, path = sealed
+    with open(str(tmp_path / "out"), 'wb') as out:
+        unseal(path, key, chunk_aad("doc", 1), out, block_size=65536)
+    with open(str(tmp_path / "out"), 'rb') as f:
+        assert f.read() == data
+    with open(str(tmp_path / "slice"), 'wb') as out:
+        unseal(path, key, chunk_aad("doc", 1), out, skip=100000, length=200000)
+    with open(str(tmp_path / "slice"), 'rb') as f:
+        assert f.read() == data[100000:300000]
+
+
+def test_chunks_can_not_be_moved(sealed):
+    data, key, path = sealed
+    for aad in (chunk_aad("doc", 2), chunk_aad("other", 1)):
+        with pytest.raises(ValueError):
+            unseal(path, key, aad)
+    with pytest.raises(ValueError):
+        unseal(path, new_key(), chunk_aad("doc", 1))
+
+
+def test_truncated_chunk(sealed):
+    data, key, path = sealed
+    with open(path, 'r+b') as f:
+        f.truncate(10)
+    with pytest.raises(ValueError):
+        unseal(path, key, chunk_aad("doc", 1))
+
+
+def test_every_backup_has_its_own_key(td, tmp_path):
+    db = Db()
+    db.config['backup chat id'] = 1
+    db.save()
+    for name in ("a", "b"):
+        with open(str(tmp_path / name), 'wb') as f:
+            f.write(urandom(100))
+        Backup(str(tmp_path / name), size='1', td=td)
+    catalog = Db(readonly=True)
+    documents = [d for k in catalog.files for d in catalog.files[k]]
+    assert all(d['format version'] >= 5 and not 'passphrase' in d for d in documents)
+    assert len({d['key'] for d in documents}) == 2
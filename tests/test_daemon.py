@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+#    Daemon tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import json
+from argparse import Namespace
+from io import StringIO
+
+from pgpgram import Db
+from pgpgram.daemon import Daemon, arguments
+
+
+def idle_daemon():
+    """A daemon which does not listen, to call its methods"""
+    daemon = Daemon.__new__(Daemon)
+    daemon.verbose = 0
+    daemon.catalog = None
+    daemon.catalog_version = None
+    daemon.files_conn = None
+    return daemon
+
+
+def test_arguments_forward_verbose():
+    args = Namespace(command="list", pattern="/a", verbose=True)
+    assert arguments(args) == {'pattern': "/a", 'verbose': 2}
+    args = Namespace(command="info", filename="a", verbose=False)
+    assert arguments(args) == {'file': "a", 'verbose': 0}
+
+
+def test_catalog_is_opened_again_after_changes():
+    db = Db()
+    daemon = idle_daemon()
+    catalog = daemon.refresh_catalog()
+    assert daemon.refresh_catalog() is catalog
+
+    db.files['a'] = [{'name': "a", 'path': "/a"}]
+    db.config['backup chat id'] = 1
+    db.save()
+    changed = daemon.refresh_catalog()
+    assert changed is not catalog
+    assert changed.config['backup chat id'] == 1
+    assert list(changed.files.keys()) == ['a']
+    assert daemon.refresh_catalog() is changed
+
+
+def test_interactive_commands_run_in_place():
+    backup = Namespace(command="backup", filename=["a"], youtube=False, pack=False, pack_threshold=[None],
+                       duplicate=False, size=['100'], verbose=False)
+    assert arguments(backup) is None
+    db = Db()
+    db.config['backup chat id'] = 1
+    db.files['h1'] = [{'name': "a", 'path': "/x/a"}]
+    db.files['h2'] = [{'name': "a", 'path': "/y/a"}]
+    db.save()
+    assert arguments(backup)['filenames'][0].endswith("/a")
+    restore = Namespace(command="restore", filename=["a"], prefix=[None], concurrency=8, download_dir=["."],
+                        cache_size=[None], range=[None], verbose=False)
+    assert arguments(restore) is None
+    restore.filename = ["/x/a"]
+    assert arguments(restore)['filenames'] == ["/x/a"]
+
+
+def test_input_fails_the_command():
+    daemon = idle_daemon()
+    daemon.run = lambda command, arguments: input("Pick one: ")
+    stream = StringIO(json.dumps({'command': "restore", 'arguments': {}}) + "\n")
+    daemon.serve(stream)
+    answers = [json.loads(line) for line in stream.getvalue().splitlines()[1:]]
+    assert answers[0] == {'output': "Pick one: "}
+    assert answers[-1]['exit'] == 1
+    assert "--no-daemon" in answers[-1]['error']
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+#    Job queue tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from subprocess import Popen
+from time import time
+
+import pytest
+
+from pgpgram.jobs import JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.db"))
+    yield queue
+    queue.conn.close()
+
+
+def dead_pid():
+    process = Popen(["true"])
+    process.wait()
+    return process.pid
+
+
+def test_claim_by_priority(queue):
+    first = queue.add('backup', "/a")
+    urgent = queue.add('backup', "/b", priority=5)
+    assert queue.add('backup', "/a") == first
+    assert queue.claim()['id'] == urgent
+    assert queue.claim()['id'] == first
+    assert queue.claim() is None
+
+
+def test_failed_jobs_back_off(queue):
+    job_id = queue.add('restore', "a", max_attempts=2)
+    queue.claim()
+    queue.fail(job_id, "boom")
+    assert queue.claim() is None
+    assert queue.next_time() > time()
+    queue.conn.execute("UPDATE jobs SET not_before = 0")
+    assert queue.claim()['id'] == job_id
+    queue.fail(job_id, "boom")
+    assert queue.counts() == {'failed': 1}
+
+
+def test_recover_only_dead_or_stale_workers(queue):
+    live = queue.add('backup', "/live")
+    dead = queue.add('backup', "/dead")
+    stale = queue.add('backup', "/stale")
+    for _ in range(3):
+        queue.claim()
+    queue.conn.execute("UPDATE jobs SET worker = ? WHERE id = ?", (dead_pid(), dead))
+    queue.conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?", (time() - 2 * queue.stale, stale))
+    assert queue.recover() == 2
+    states = {job['id']: job['state'] for job in queue.jobs()}
+    assert states == {live: 'running', dead: 'queued', stale: 'queued'}
+
+
+def test_beat_keeps_a_job(queue):
+    job_id = queue.add('backup', "/a")
+    queue.claim()
+    queue.conn.execute("UPDATE jobs SET heartbeat = 0")
+    queue.beat(job_id)
+    assert queue.recover() == 0
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+#    Low impact tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import os
+
+import pytest
+
+from pgpgram import Backup
+from pgpgram import lowimpact
+from pgpgram.lowimpact import renice
+
+
+def test_renice_without_permission(monkeypatch, capsys):
+    def setpriority(which, who, priority):
+        raise PermissionError(1, "Operation not permitted")
+
+    monkeypatch.setattr(os, 'setpriority', setpriority)
+    renice(nice=-5)
+    assert "can not set the CPU priority" in capsys.readouterr().out
+
+
+@pytest.mark.skipif(lowimpact.posix_fadvise is None, reason="posix_fadvise is not available")
+def test_low_impact_hash_is_the_same(monkeypatch, tmp_path):
+    path = str(tmp_path / "a")
+    with open(path, 'wb') as f:
+        f.write(os.urandom(3000000))
+    backup = Backup.__new__(Backup)
+    expected = backup.hash(path)
+    monkeypatch.setenv(lowimpact.environment, "1")
+    assert backup.hash(path) == expected
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+#    Chunk manifest tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from hashlib import sha256
+from os import urandom
+
+import pytest
+
+from pgpgram import Backup, Db, Restore, check_manifest
+
+
+@pytest.fixture
+def chat():
+    db = Db()
+    db.config['backup chat id'] = 1
+    db.save()
+
+
+@pytest.fixture
+def document(chat, td, tmp_path):
+    with open(str(tmp_path / "file"), 'wb') as f:
+        f.write(urandom(2500000))
+    Backup(str(tmp_path / "file"), size='1', td=td)
+    catalog = Db(readonly=True)
+    document, = [d for k in catalog.files for d in catalog.files[k]]
+    return document
+
+
+def damage(path):
+    with open(path, 'r+b') as f:
+        f.seek(10)
+        f.write(bytes(b ^ 0xff for b in f.read(1)))
+
+
+def test_manifest_of_the_sent_chunks(td, document):
+    assert len(document['chunks']) == 3
+    for index, chunk in enumerate(document['chunks']):
+        with open(td.files[index + 1], 'rb') as f:
+            data = f.read()
+        assert chunk == {'size': len(data), 'sha256': sha256(data).hexdigest()}
+        assert check_manifest(document, index, td.files[index + 1]) is None
+
+
+def test_damaged_chunks_are_found(td, document):
+    damage(td.files[2])
+    assert "does not match its digest" in check_manifest(document, 1, td.files[2])
+    with open(td.files[3], 'ab') as f:
+        f.write(b"x")
+    assert "bytes instead of" in check_manifest(document, 2, td.files[3])
+    # Documents backed up before manifests are not checked
+    assert check_manifest(dict(document, chunks=[]), 1, td.files[2]) is None
+
+
+def test_restore_refuses_damaged_chunks(td, document, tmp_path):
+    damage(td.files[2])
+    output = tmp_path / "out"
+    output.mkdir()
+    with pytest.raises(Exception, match="damaged"):
+        Restore(document['path'], download_directory=str(output), verbose=0, td=td)
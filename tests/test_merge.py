@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+#    Catalog merge tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from sqlitedict import SqliteDict
+
+from pgpgram.catalog import ReadOnlySqliteDict, merge
+
+
+def catalog(path, rows):
+    db = SqliteDict(str(path), autocommit=False)
+    for key, value in rows.items():
+        db[key] = value
+    db.commit()
+    db.close()
+    return str(path)
+
+
+def test_merge(tmp_path):
+    target = catalog(tmp_path / "files.db", {'same': [1], 'changed': [2], 'ours': [3]})
+    source = catalog(tmp_path / "import.db", {'same': [1], 'changed': [20], 'a': [4], 'b': [5], 'c': [6]})
+    added, conflicting = [], []
+    counts = merge(target, source, added.extend, conflicting.extend, page=2)
+    assert counts == (3, 1, 1)
+    assert sorted(added) == [('a', [4]), ('b', [5]), ('c', [6])]
+    assert conflicting == [('changed', [20], [2])]
+    merged = ReadOnlySqliteDict(target)
+    assert dict(merged.items()) == {'same': [1], 'changed': [2], 'ours': [3], 'a': [4], 'b': [5], 'c': [6]}
+    merged.close()
+
+
+def test_merge_again_adds_nothing(tmp_path):
+    target = catalog(tmp_path / "files.db", {})
+    source = catalog(tmp_path / "import.db", {'a': [1]})
+    merge(target, source, lambda rows: None, lambda rows: None)
+    assert merge(target, source, lambda rows: None, lambda rows: None) == (0, 1, 0)
+
+
+def test_merge_empty_source(tmp_path):
+    target = catalog(tmp_path / "files.db", {'a': [1]})
+    source = str(tmp_path / "empty.db")
+    assert merge(target, source, lambda rows: None, lambda rows: None) == (0, 0, 0)
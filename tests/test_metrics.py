@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+#    Metrics tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import json
+
+import pytest
+
+from pgpgram.metrics import Metrics
+
+
+def test_stages_and_chunks():
+    metrics = Metrics("backup")
+    metrics.add('upload', 2.0, 4000000, chunk=0, document="d")
+    metrics.add('upload', 2.0, 4000000, chunk=1, document="d")
+    with metrics.stage('hash', 100):
+        pass
+    report = metrics.report()
+    assert report['command'] == "backup"
+    assert report['stages']['upload'] == {'count': 2, 'seconds': 4.0, 'bytes': 8000000, 'MB/s': 2.0}
+    assert report['stages']['hash']['count'] == 1
+    assert [c['chunk'] for c in report['chunks']] == [0, 1]
+    assert report['chunks'][0]['MB/s'] == 2.0
+
+
+def test_failed_stage_is_timed():
+    metrics = Metrics()
+    with pytest.raises(ValueError):
+        with metrics.stage('decrypt'):
+            raise ValueError
+    assert metrics.stages['decrypt']['count'] == 1
+
+
+def test_exports(tmp_path):
+    metrics = Metrics("restore")
+    metrics.add('download', 1.0, 1000000)
+    metrics.count('updateFile')
+    metrics.count('updateFile')
+    metrics.files = 3
+    path = str(tmp_path / "run.json")
+    metrics.save_json(path)
+    with open(path) as f:
+        report = json.load(f)
+    assert report['files'] == 3
+    assert report['events'] == {'updateFile': 2}
+
+    path = str(tmp_path / "run.prom")
+    metrics.save_prometheus(path)
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert '# TYPE pgpgram_stage_bytes gauge' in lines
+    assert 'pgpgram_stage_bytes{command="restore",stage="download"} 1000000' in lines
+    assert 'pgpgram_td_events{command="restore",type="updateFile"} 2' in lines
+    assert 'pgpgram_run_files{command="restore"} 3' in lines
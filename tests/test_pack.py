@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+#    Pack tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from os import urandom
+
+import pytest
+
+from pgpgram import Db, PackBackup, backup_files, pack_batches
+
+
+@pytest.fixture
+def chat():
+    db = Db()
+    db.config['backup chat id'] = 1
+    db.save()
+
+
+def write(path, size):
+    with open(str(path), 'wb') as f:
+        f.write(urandom(size))
+    return str(path)
+
+
+def test_pack_batches(tmp_path):
+    files = [write(tmp_path / "f{}".format(i), size) for i, size in enumerate((40, 50, 30, 100, 10))]
+    assert pack_batches(files, 100) == [files[:2], files[2:3], files[3:4], files[4:]]
+    # A file bigger than a pack gets a batch of its own
+    assert pack_batches(files, 20) == [[f] for f in files]
+
+
+def test_packed_files_share_messages(chat, td, tmp_path):
+    files = [write(tmp_path / "f{}".format(i), size) for i, size in enumerate((10, 20, 30))]
+    PackBackup(files, size='1', td=td)
+    assert len(td.messages) == 1
+    db = Db(readonly=True)
+    documents = [d for k in db.files for d in db.files[k]]
+    assert len(documents) == 3
+    assert len({d['pack id'] for d in documents}) == 1
+    assert sorted((d['pack offset'], d['pack length']) for d in documents) == [(0, 10), (10, 20), (30, 30)]
+    assert all(d['messages id'] == documents[0]['messages id'] for d in documents)
+
+
+def test_backup_packs_only_small_files(chat, td, tmp_path):
+    small = [write(tmp_path / "s{}".format(i), 100) for i in range(3)]
+    big = write(tmp_path / "big", 2000000)
+    backup_files(small + [big], pack_threshold='1', size='1', td=td)
+    # One pack message, two chunks of the big file
+    assert len(td.messages) == 3
+    db = Db(readonly=True)
+    packed = [d for k in db.files for d in db.files[k] if 'pack id' in d]
+    assert sorted(d['path'] for d in packed) == sorted(small)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+#    Profiler tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from time import sleep
+
+import pytest
+
+from pgpgram.metrics import Metrics
+from pgpgram.profiler import Profiler
+
+
+def test_calls_are_accounted():
+    profiler = Profiler()
+    assert profiler.call('handler', lambda a, b: a + b, 1, 2, event_type='updateFile') == 3
+    with pytest.raises(ZeroDivisionError):
+        profiler.call('handler', lambda: 1 / 0)
+    calls, total, longest = profiler.handlers['handler']
+    assert calls == 2
+    assert longest <= total
+    assert profiler.events['updateFile'][0] == 1
+
+
+def test_table():
+    profiler = Profiler()
+    profiler.call('Td.receive', lambda: None)
+    metrics = Metrics()
+    metrics.add('upload', 1.5, 10)
+    lines = profiler.table(metrics).splitlines()
+    assert lines[0].split()[:2] == ["handler", "calls"]
+    assert any(line.startswith("Td.receive") for line in lines)
+    assert any(line.startswith("upload") and "-" in line.split() for line in lines)
+
+
+def test_dump(tmp_path):
+    def busy():
+        sleep(0.2)
+
+    profiler = Profiler(cprofile=True, sample_interval=0.01)
+    profiler.start()
+    busy()
+    profiler.stop()
+    prefix = str(tmp_path / "run")
+    profiler.dump(prefix)
+    with open(prefix + ".folded") as f:
+        stacks = f.read().splitlines()
+    assert any("test_profiler.py:busy" in line for line in stacks)
+    assert (tmp_path / "run.pstats").exists()
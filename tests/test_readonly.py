@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+#    Read-only catalog tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import sqlite3
+from os.path import exists
+
+from pgpgram import Db
+from pgpgram.catalog import ReadOnlySqliteDict, Writer
+
+
+def test_nothing_is_created():
+    db = Db(readonly=True)
+    assert list(db.files.keys()) == []
+    assert 'a' not in db.files
+    assert db.config == {}
+    assert db.file_names == {}
+    assert not exists(Db.files_db_path)
+
+
+def test_catalog_is_read_lazily():
+    db = Db()
+    db.add_document({'name': "a", 'path': "/a", 'hash': "h"})
+    db.config['backup chat id'] = 1
+    db.save()
+    catalog = Db(readonly=True)
+    assert not 'files' in catalog.__dict__
+    assert catalog.files['h'] == [{'name': "a", 'path': "/a", 'hash': "h"}]
+    assert catalog.file_names['a'] == [{'name': "a", 'path': "/a", 'hash': "h"}]
+    assert catalog.config['backup chat id'] == 1
+
+
+def test_paged_reads_during_a_write(tmp_path):
+    path = str(tmp_path / "files.db")
+    writer = Writer(path)
+    writer.update({str(i): (lambda i: lambda value: i)(i) for i in range(5)})
+    reader = ReadOnlySqliteDict(path, page=2)
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        assert list(reader.items()) == [(str(i), i) for i in range(5)]
+        assert len(reader) == 5
+        assert reader.get("9") is None
+    finally:
+        conn.execute("ROLLBACK")
+        conn.close()
+        reader.close()
+        writer.close()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+#    Restore tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from os import urandom
+
+import pytest
+
+from pgpgram import Backup, Db, PackBackup, Restore, parse_range
+
+
+@pytest.fixture
+def chat():
+    db = Db()
+    db.config['backup chat id'] = 1
+    db.save()
+
+
+def write(path, size):
+    data = urandom(size)
+    with open(str(path), 'wb') as f:
+        f.write(data)
+    return data
+
+
+def read(path):
+    with open(str(path), 'rb') as f:
+        return f.read()
+
+
+def test_parse_range():
+    assert parse_range(None) is None
+    assert parse_range("10:20") == (10, 20)
+    assert parse_range("10:") == (10, None)
+    assert parse_range(":20") == (0, 20)
+    with pytest.raises(ValueError):
+        parse_range("20:10")
+    with pytest.raises(ValueError):
+        parse_range("-1:10")
+
+
+def test_range_restore_downloads_only_its_chunks(chat, td, tmp_path):
+    data = write(tmp_path / "file", 3500000)
+    Backup(str(tmp_path / "file"), size='1', td=td)
+    assert len(td.messages) == 4
+
+    output = tmp_path / "out"
+    output.mkdir()
+    downloads = []
+    download = td.downloadFile
+    td.downloadFile = lambda file_id, *args, **kwargs: downloads.append(file_id) or download(file_id, *args, **kwargs)
+    Restore(str(tmp_path / "file"), download_directory=str(output), verbose=0,
+            byte_range=(1500000, 2500000), td=td)
+    assert read(output / "file.1500000-2500000") == data[1500000:2500000]
+    assert downloads == [2, 3]
+
+    Restore(str(tmp_path / "file"), download_directory=str(output), verbose=0, td=td)
+    assert read(output / "file") == data
+
+
+def test_pack_member_restore(chat, td, tmp_path):
+    files = []
+    for i, size in enumerate((10, 0, 1500000, 300)):
+        files.append((tmp_path / "f{}".format(i), write(tmp_path / "f{}".format(i), size)))
+    PackBackup([str(path) for path, data in files], size='1', td=td)
+    assert len(td.messages) == 2
+
+    output = tmp_path / "out"
+    output.mkdir()
+    for path, data in files:
+        Restore(str(path), download_directory=str(output), verbose=0, td=td)
+        assert read(output / path.name) == data
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+#    Retention tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from pgpgram import Db
+from pgpgram.retention import Deletion, expired
+
+now = datetime(2021, 6, 1)
+
+
+def document(number, path, days, messages):
+    return {'id': "d{}".format(number), 'hash': "h{}".format(number), 'name': path.split("/")[-1], 'path': path,
+            'date backed up': now - timedelta(days=days), 'chat id': 1, 'messages id': messages}
+
+
+def test_expired_keeps_last_versions():
+    documents = [document(i, "/a", days, [i]) for i, days in enumerate((1, 2, 3))]
+    assert [d['id'] for d in expired(documents, keep=2, now=now)] == ['d2']
+
+
+def test_expired_never_drops_the_last_version_for_age():
+    documents = [document(0, "/a", 10, [0]), document(1, "/a", 20, [1]), document(2, "/b", 30, [2])]
+    assert [d['id'] for d in expired(documents, older_than=5, now=now)] == ['d1']
+
+
+def test_expired_keeps_at_least_one_version():
+    documents = [document(0, "/a", 1, [0])]
+    for keep in (0, -1):
+        with pytest.raises(ValueError):
+            expired(documents, keep=keep, now=now)
+
+
+def test_gc_rejects_keeping_no_version(monkeypatch, capsys):
+    import pgpgram
+
+    monkeypatch.setattr('sys.argv', ["pgpgram", "gc", "--keep", "0"])
+    with pytest.raises(SystemExit):
+        pgpgram.main()
+    assert "at least one version" in capsys.readouterr().err
+
+
+def test_deletion_keeps_shared_messages(td):
+    db = Db()
+    first = document(0, "/a", 1, [1, 2])
+    second = document(1, "/b", 1, [2, 3])
+    db.files['h0'] = [first]
+    db.files['h1'] = [second]
+    db.config['pending deletions'] = [(1, 9)]
+    db.save()
+    Deletion([first], td=td)
+    assert sorted(td.deleted) == [(1, 1), (1, 9)]
+    catalog = Db(readonly=True)
+    assert list(catalog.files.keys()) == ['h1']
+    assert catalog.config['pending deletions'] == []
+
+
+def run_delete(monkeypatch, *arguments):
+    import pgpgram
+
+    monkeypatch.setattr('sys.argv', ["pgpgram", "delete", "--dry-run"] + list(arguments))
+    pgpgram.main()
+
+
+def test_delete_selects_paths_and_hashes(monkeypatch, capsys):
+    db = Db()
+    for i, path in enumerate(("/x/a", "/y/a", "/y/b")):
+        db.add_document(document(i, path, 1, [i]))
+    db.save()
+
+    with pytest.raises(SystemExit):
+        run_delete(monkeypatch, "a")
+    output = capsys.readouterr()
+    assert "/x/a" in output.out and "/y/a" in output.out
+    assert "give their paths or --all" in output.err
+
+    run_delete(monkeypatch, "/x/a", "h2")
+    assert "2 documents, 2 messages to delete" in capsys.readouterr().out
+    run_delete(monkeypatch, "a", "--all")
+    assert "2 documents, 2 messages to delete" in capsys.readouterr().out
+    assert len(list(Db(readonly=True).files.keys())) == 3
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+#    Scheduler tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import pytest
+
+from pgpgram import scheduler as scheduler_module
+from pgpgram.scheduler import Download, Scheduler, Window, retry_after
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Time of the windows, moved by hand"""
+    now = [1000.0]
+    monkeypatch.setattr(scheduler_module, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_retry_after():
+    assert retry_after({'@type': 'error', 'code': 429, 'message': "Too Many Requests: retry after 7"}) == 7
+    assert retry_after({'@type': 'error', 'code': 420, 'message': "FLOOD_WAIT_30"}) == 30
+    assert retry_after({'@type': 'updateMessageSendFailed', 'error_code': 429, 'error_message': "slow down"}) == 1
+    assert retry_after({'@type': 'error', 'code': 400, 'message': "Bad Request"}) is None
+
+
+def test_window_grows_and_halves(clock):
+    window = Window(8, initial=4)
+    for _ in range(4):
+        window.success()
+    assert window.size == pytest.approx(5, abs=0.2)
+    window.failure()
+    assert window.room(0) == 2
+    assert window.room(2) == 0
+    for _ in range(3):
+        window.failure()
+    assert window.size == 1
+
+
+def test_rate_limit_pauses_the_window(clock):
+    window = Window(8)
+    window.failure(retry=10)
+    assert window.room(0) == 0
+    assert window.paused() == 10
+    clock[0] += 10
+    assert window.room(0) == 2
+
+
+def test_windows_are_kept_by_name():
+    windows = Scheduler()
+    window = windows.window('download', 8)
+    window.failure()
+    assert windows.window('download', 8) is window
+    assert windows.window('download', 2).size == 2
+
+
+class Files:
+    """Telegram client answering downloads with a script of events"""
+
+    def __init__(self, script):
+        self.script = script
+        self.asked = 0
+
+    def downloadFile(self, file_id, priority=1, extra=None):
+        self.asked += 1
+
+    def send(self, query):
+        pass
+
+    def cycle(self, function, tick=False):
+        while True:
+            event = self.script.pop(0) if self.script else {'@type': 'tick'}
+            if function(self, event):
+                return
+
+
+def downloaded(file_id):
+    return {'@type': 'updateFile',
+            'file': {'id': file_id, 'local': {'path': "/downloaded", 'is_downloading_completed': True}}}
+
+
+def test_download_waits_out_rate_limits(clock):
+    td = Files([{'@type': 'error', '@extra': "download 7", 'message': "FLOOD_WAIT_0"},
+                {'@type': 'tick'},
+                downloaded(7)])
+    assert Download(7).run(td) == "/downloaded"
+    assert td.asked == 2
+
+
+def test_download_gives_up(clock):
+    td = Files([{'@type': 'error', '@extra': "download 7", 'message': "Bad Request"},
+                {'@type': 'error', '@extra': "download 7", 'message': "Bad Request"}])
+    with pytest.raises(Exception):
+        Download(7, attempts=2).run(td)
+    assert td.asked == 2
+
+
+def test_stalled_download_is_tried_again(clock):
+    class Stalled(Files):
+        def cycle(self, function, tick=False):
+            clock[0] += 100
+            return Files.cycle(self, function, tick)
+
+    td = Stalled([{'@type': 'tick'}, downloaded(7)])
+    assert Download(7, timeout=50).run(td) == "/downloaded"
+    assert td.asked == 2
+
+
+def test_failures_keep_the_maximum(clock):
+    windows = Scheduler()
+    window = windows.window('download', 8)
+    windows.failure('download', 10)
+    assert window.maximum == 8
+    assert window.paused() == 10
+    windows.failure('upload')
+    assert windows.window('upload', 4).maximum == 4
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+#    Segmented chunk tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from os import urandom
+
+import pytest
+
+from pgpgram import crypto
+from pgpgram.crypto import OVERHEAD, new_key, seal_chunk, unseal_chunk
+
+pytestmark = pytest.mark.skipif(not crypto.available, reason="cryptography is not installed")
+
+segment = 1000
+
+
+@pytest.fixture
+def sealed(tmp_path):
+    data = urandom(10000)
+    with open(str(tmp_path / "file"), 'wb') as f:
+        f.write(data)
+    key = new_key()
+    output = str(tmp_path / "chunk")
+    seal_chunk(str(tmp_path / "file"), key, "doc", 3, 2000, 4500, output, segment_size=segment)
+    return data[2000:6500], key, output
+
+
+def unsealed(tmp_path, path, key, **kwargs):
+    output = str(tmp_path / "out")
+    open(output, 'wb').close()
+    written = unseal_chunk(path, key, "doc", 3, output=output, segment_size=segment, **kwargs)
+    with open(output, 'rb') as f:
+        data = f.read()
+    assert written == len(data)
+    return data
+
+
+def test_round_trip(sealed, tmp_path):
+    data, key, path = sealed
+    with open(path, 'rb') as f:
+        assert len(f.read()) == len(data) + 5 * OVERHEAD
+    assert unsealed(tmp_path, path, key) == data
+
+
+def test_slices_across_segments(sealed, tmp_path):
+    data, key, path = sealed
+    assert unsealed(tmp_path, path, key, skip=900, length=1200) == data[900:2100]
+    assert unsealed(tmp_path, path, key, skip=4000) == data[4000:]
+
+
+def test_only_the_segments_of_the_slice_are_read(sealed, tmp_path):
+    data, key, path = sealed
+    # Damage the last segment: slices before it still decrypt
+    with open(path, 'r+b') as f:
+        f.seek(4 * (segment + OVERHEAD) + 20)
+        f.write(b"\0")
+    assert unsealed(tmp_path, path, key, length=2500) == data[:2500]
+    with pytest.raises(ValueError):
+        unseal_chunk(path, key, "doc", 3, segment_size=segment)
+
+
+def test_segments_can_not_be_moved(sealed, tmp_path):
+    data, key, path = sealed
+    with open(path, 'rb') as f:
+        sealed = f.read()
+    size = segment + OVERHEAD
+    swapped = sealed[size:2 * size] + sealed[:size] + sealed[2 * size:]
+    dropped = sealed[:4 * size]
+    for tampered in (swapped, dropped):
+        with open(path, 'wb') as f:
+            f.write(tampered)
+        with pytest.raises(ValueError):
+            unseal_chunk(path, key, "doc", 3, segment_size=segment)
+    with open(path, 'wb') as f:
+        f.write(sealed)
+    with pytest.raises(ValueError):
+        unseal_chunk(path, key, "doc", 4, segment_size=segment)
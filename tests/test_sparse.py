@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+#    Sparse files tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from os import truncate
+
+import pytest
+
+from pgpgram.sparse import ZERO_BLOCK, data_extents, data_size, gather, scatter, slices, to_data
+
+extents = [[0, 10], [100, 20], [200, 5]]
+
+
+def test_to_data():
+    assert to_data(extents, 0) == 0
+    assert to_data(extents, 5) == 5
+    assert to_data(extents, 50) == 10
+    assert to_data(extents, 110) == 20
+    assert to_data(extents, 1000) == 35
+
+
+def test_slices():
+    assert list(slices(extents, 0, 35)) == [(0, 0, 10), (100, 10, 20), (200, 30, 5)]
+    assert list(slices(extents, 5, 15)) == [(5, 5, 5), (100, 10, 5)]
+    assert data_size(extents) == 35
+
+
+def sparse_file(path):
+    """File of 8 blocks: data, hole, zeros, data, hole"""
+    size = 8 * ZERO_BLOCK
+    with open(path, 'wb') as f:
+        f.write(b"a" * ZERO_BLOCK)
+        f.seek(3 * ZERO_BLOCK)
+        f.write(bytes(ZERO_BLOCK))
+        f.write(b"b" * (ZERO_BLOCK + 100))
+    truncate(path, size)
+    return size
+
+
+def test_round_trip(tmp_path):
+    source = str(tmp_path / "image")
+    size = sparse_file(source)
+    found = data_extents(source)
+    if found is None:
+        pytest.skip("the filesystem does not report holes")
+    # The allocated block of zeros is dropped, the end of the data is
+    # rounded to the blocks of the filesystem
+    assert found[0] == [0, ZERO_BLOCK]
+    assert found[1][0] == 4 * ZERO_BLOCK and found[1][1] >= ZERO_BLOCK + 100
+    assert len(found) == 2
+
+    # Chunks of the data stream, restored at their place
+    chunk = ZERO_BLOCK // 2 + 7
+    output = str(tmp_path / "restored")
+    open(output, 'wb').close()
+    truncate(output, size)
+    for start in range(0, data_size(found), chunk):
+        length = min(chunk, data_size(found) - start)
+        part = str(tmp_path / "chunk")
+        gather(source, found, start, length, part)
+        scatter(part, found, start, start + length, output)
+    with open(source, 'rb') as a, open(output, 'rb') as b:
+        assert a.read() == b.read()
+
+
+def test_files_without_holes(tmp_path):
+    path = str(tmp_path / "plain")
+    with open(path, 'wb') as f:
+        f.write(b"a" * 4096)
+    assert data_extents(path) is None
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+#    Start-up tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from os.path import abspath, dirname, join as path_join
+from subprocess import run, PIPE
+from sys import executable
+
+root = dirname(dirname(abspath(__file__)))
+
+
+def test_import_loads_no_command_modules():
+    # The time budget is left to the benchmark, machines running tests vary
+    process = run([executable, path_join(root, "benchmarks", "importtime.py"), "--budget", "10000"],
+                  stdout=PIPE, universal_newlines=True, cwd=root)
+    assert not "error:" in process.stdout
+    assert process.returncode == 0
+
+
+def test_help_runs_without_telegram():
+    process = run([executable, "-c", "import sys; sys.argv = ['pgpgram', '--help']; import pgpgram; pgpgram.main()"],
+                  stdout=PIPE, universal_newlines=True, cwd=root)
+    assert process.returncode == 0
+    assert "backup" in process.stdout
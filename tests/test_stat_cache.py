@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+#    Stat cache tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from os import link
+
+import pytest
+
+from pgpgram import Backup, Db
+from pgpgram.metrics import Metrics
+
+
+@pytest.fixture
+def backup():
+    """A backup to call the hashing methods of"""
+    backup = Backup.__new__(Backup)
+    backup.db = Db()
+    backup.metrics = Metrics("backup")
+    return backup
+
+
+def write(path, data):
+    with open(str(path), 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def digest(backup, data):
+    """Hash of data as the catalog keeps it"""
+    from hashlib import sha256
+    return "b'" + sha256(data).hexdigest()
+
+
+def hashed(backup):
+    return backup.metrics.stages.get('hash', {}).get('count', 0)
+
+
+def test_unchanged_files_are_not_read_again(backup, tmp_path):
+    path = write(tmp_path / "a", b"first")
+    assert backup.cached_hash(path) == digest(backup, b"first")
+    assert backup.cached_hash(path) == digest(backup, b"first")
+    assert hashed(backup) == 1
+
+    write(tmp_path / "a", b"second")
+    assert backup.cached_hash(path) == digest(backup, b"second")
+    assert hashed(backup) == 2
+
+
+def test_hardlinks_share_the_hash(backup, tmp_path):
+    path = write(tmp_path / "a", b"data")
+    link(path, str(tmp_path / "b"))
+    backup.cached_hash(path)
+    assert backup.cached_hash(str(tmp_path / "b")) == digest(backup, b"data")
+    assert hashed(backup) == 1
+
+
+def test_the_cache_is_kept_between_runs(backup, tmp_path):
+    path = write(tmp_path / "a", b"data")
+    backup.cached_hash(path)
+    backup.db = Db()
+    backup.cached_hash(path)
+    assert hashed(backup) == 1
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+#    Throttle tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from datetime import datetime
+
+import pytest
+
+from pgpgram import throttle
+from pgpgram.throttle import Schedule, SharedTokenBucket, Throttle, TokenBucket, parse_rate
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Time of the buckets, moved by hand"""
+    now = [1000.0]
+    monkeypatch.setattr(throttle, 'time', lambda: now[0])
+    return now
+
+
+def at(hour, minute=0):
+    return datetime(2021, 6, 1, hour, minute).timestamp()
+
+
+def test_parse_rate():
+    assert parse_rate("500K") == 500000
+    assert parse_rate("2MB/s") == 2000000
+    assert parse_rate("1.5G") == 1500000000
+    assert parse_rate("0") is None
+    assert parse_rate("unlimited") is None
+
+
+def test_schedule():
+    schedule = Schedule("08:00-20:00=1M,22:00-06:00=50M,10M")
+    assert schedule.rate(at(12)) == 1000000
+    assert schedule.rate(at(21)) == 10000000
+    assert schedule.rate(at(23)) == 50000000
+    assert schedule.rate(at(3)) == 50000000
+    assert schedule.rate(at(7, 59)) == 10000000
+
+
+def test_debt_is_paid_by_the_next_transfer(clock):
+    bucket = TokenBucket("1M")
+    # A transfer bigger than the bucket goes through and leaves a debt
+    assert bucket.consume(3000000) == 0
+    assert bucket.consume(1000) == pytest.approx(3)
+    clock[0] += 1
+    assert bucket.consume(1000) == pytest.approx(2)
+    clock[0] += 2
+    assert bucket.consume(1000) == 0
+
+
+def test_burst_is_one_second(clock):
+    bucket = TokenBucket("1M")
+    clock[0] += 60
+    assert bucket.consume(1000000) == 0
+    assert bucket.consume(1000000) == 0
+    assert bucket.consume(1) == pytest.approx(1)
+
+
+def test_shared_bucket(clock, tmp_path):
+    path = str(tmp_path / "upload.bucket")
+    first, second = SharedTokenBucket("1M", path), SharedTokenBucket("1M", path)
+    assert first.consume(2000000) == 0
+    assert second.consume(1000) == pytest.approx(2)
+
+
+def test_throttle_without_limits():
+    limits = Throttle(upload="1M")
+    assert limits.before_download(10 ** 9) == 0
+    assert limits.before_upload(10) == 0
+
+
+def test_upload_chunks_fit_the_bucket(clock):
+    from pgpgram import Backup
+
+    backup = Backup.__new__(Backup)
+    backup.throttle = Throttle(upload="5M")
+    assert backup.paced_chunk_size(100000000) == 5000000
+    assert backup.paced_chunk_size(2000000) == 2000000
+    backup.throttle = Throttle(upload="300K")
+    assert backup.paced_chunk_size(100000000) == 1000000
+    backup.throttle = Throttle(download="300K")
+    assert backup.paced_chunk_size(100000000) == 100000000
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+#    Verify tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from os import urandom
+from os.path import join as path_join
+
+import pytest
+from sqlitedict import SqliteDict
+
+from pgpgram import Backup, Db
+from pgpgram.verify import Verify, parse_percent
+
+
+@pytest.fixture
+def chat():
+    db = Db()
+    db.config['backup chat id'] = 1
+    db.save()
+
+
+def backup(td, path, size):
+    with open(str(path), 'wb') as f:
+        f.write(urandom(size))
+    Backup(str(path), size='1', td=td)
+
+
+def results():
+    verify = SqliteDict(path_join(Db.data_path, "verify.db"))
+    try:
+        catalog = Db(readonly=True)
+        return {d['name']: verify[d['id']]['status'] for k in catalog.files for d in catalog.files[k]}
+    finally:
+        verify.close()
+
+
+def test_parse_percent():
+    assert parse_percent("5%") == 0.05
+    assert parse_percent("50") == 0.5
+    assert parse_percent("200%") == 1.0
+
+
+def test_missing_and_mismatched_chunks(chat, td, tmp_path):
+    for name in ("fine", "missing", "mismatch"):
+        backup(td, tmp_path / name, 1500000)
+    td.messages[2] = None
+    td.messages[5]['content']['document']['document']['size'] += 1
+    Verify(td=td)
+    assert results() == {'fine': 'ok', 'missing': 'missing', 'mismatch': 'mismatch'}
+
+
+def test_deep_verify_downloads_and_decrypts(chat, td, tmp_path):
+    for name in ("fine", "corrupt"):
+        backup(td, tmp_path / name, 1500000)
+    with open(td.files[3], 'r+b') as f:
+        f.seek(100)
+        f.write(bytes(b ^ 0xff for b in f.read(10)))
+    Verify(deep=1, td=td)
+    assert results() == {'fine': 'ok', 'corrupt': 'corrupt'}
+
+
+def test_fresh_checks_are_skipped(chat, td, tmp_path):
+    backup(td, tmp_path / "a", 100)
+    Verify(td=td)
+    sent = []
+    td.send = sent.append
+    Verify(td=td)
+    assert sent == []
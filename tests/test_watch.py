@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+#    Watch tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from os import chmod, mkdir
+
+import pytest
+
+import pgpgram
+from pgpgram import checkpoint, td as td_module
+from pgpgram.watch import IN_ATTRIB, IN_ISDIR, Inotify, watch
+
+
+@pytest.fixture
+def inotify(tmp_path):
+    try:
+        inotify = Inotify([str(tmp_path / "tree")], exclude=[str(tmp_path / "tree" / "skip")])
+    except (OSError, AttributeError) as e:
+        pytest.skip("inotify is not available")
+    yield inotify
+    inotify.close()
+
+
+@pytest.fixture(autouse=True)
+def tree(tmp_path):
+    mkdir(str(tmp_path / "tree"))
+    mkdir(str(tmp_path / "tree" / "skip"))
+
+
+def paths(events):
+    return {path for path, mask in events}
+
+
+def test_changes_are_reported(inotify, tmp_path):
+    path = str(tmp_path / "tree" / "a")
+    with open(path, 'w') as f:
+        f.write("a")
+    assert paths(inotify.events(1)) == {path}
+    chmod(path, 0o600)
+    assert [mask & IN_ATTRIB for p, mask in inotify.events(1)] == [IN_ATTRIB]
+
+
+def test_new_directories_are_watched(inotify, tmp_path):
+    directory = str(tmp_path / "tree" / "new")
+    mkdir(directory)
+    (path, mask), = inotify.events(1)
+    assert path == directory and mask & IN_ISDIR
+    assert inotify.add_tree(directory) == []
+    with open(directory + "/b", 'w') as f:
+        f.write("b")
+    assert paths(inotify.events(1)) == {directory + "/b"}
+
+
+def test_excluded_trees_are_not_watched(inotify, tmp_path):
+    with open(str(tmp_path / "tree" / "skip" / "c"), 'w') as f:
+        f.write("c")
+    assert inotify.events(0.1) == []
+
+
+def test_watch_backs_up_existing_files_once(monkeypatch, tmp_path):
+    class Td:
+        client = None
+
+        def __init__(self, **kwargs):
+            pass
+
+        def destroy(self, client):
+            pass
+
+    backed_up = []
+
+    def backup(path, **kwargs):
+        backed_up.append(path)
+        if len(backed_up) == 2:
+            raise KeyboardInterrupt
+
+    for name in ("a", "b"):
+        with open(str(tmp_path / "tree" / name), 'w') as f:
+            f.write(name)
+    monkeypatch.setattr(td_module, 'Td', Td)
+    monkeypatch.setattr(pgpgram, 'Backup', backup)
+    monkeypatch.setattr(checkpoint, 'auto_checkpoint', lambda **kwargs: None)
+    watch([str(tmp_path / "tree")], debounce=0)
+    assert backed_up == [str(tmp_path / "tree" / "a"), str(tmp_path / "tree" / "b")]
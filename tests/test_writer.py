@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+#    Catalog writer tests
+#
+#    ----------------------------------------------------------------------
+#    Copyright © 2018, 2019, 2020, 2021  Pellegrino Prevete
+#
+#    All rights reserved
+#    ----------------------------------------------------------------------
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from multiprocessing import Process
+
+from pgpgram.catalog import ReadOnlySqliteDict, Writer
+
+
+def append(path, worker, times):
+    writer = Writer(path)
+    try:
+        for i in range(times):
+            writer.update({'shared': lambda value: (value or []) + [(worker, i)]})
+    finally:
+        writer.close()
+
+
+def test_concurrent_appends_are_not_lost(tmp_path):
+    path = str(tmp_path / "files.db")
+    workers = [Process(target=append, args=(path, worker, 25)) for worker in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert all(worker.exitcode == 0 for worker in workers)
+    catalog = ReadOnlySqliteDict(path)
+    assert sorted(catalog['shared']) == [(worker, i) for worker in range(4) for i in range(25)]
+    catalog.close()
+
+
+def test_update_removes_rows(tmp_path):
+    path = str(tmp_path / "files.db")
+    writer = Writer(path)
+    writer.update({'a': lambda value: [1], 'b': lambda value: [2]})
+    writer.update({'a': lambda value: None})
+    writer.close()
+    catalog = ReadOnlySqliteDict(path)
+    assert dict(catalog.items()) == {'b': [2]}
+    catalog.close()